@@ -168,6 +168,81 @@ SIMPLE_JWT = {
     'SLIDING_TOKEN_LIFETIME': timedelta(minutes=5),
     'SLIDING_TOKEN_REFRESH_LIFETIME': timedelta(days=1),
 }
+# Recommendation service (src/) tuning
+RECOMMENDER = {
+    # Where load_orders gets order lines: "python" (explode Order.items),
+    # "sql" (database unnests Order.items) or "table" (slice_orderline)
+    'ORDER_LINES_MODE': 'python',
+    # Shared SQLAlchemy pool used by src.data_loader (one per worker process)
+    'DB_POOL_SIZE': 5,
+    'DB_MAX_OVERFLOW': 10,
+    'DB_POOL_TIMEOUT': 30,
+    'DB_POOL_RECYCLE': 300,
+    'DB_POOL_PRE_PING': True,
+    # Serve load_orders from an in-process snapshot refreshed by watermark
+    'ORDER_SNAPSHOT': False,
+    'ORDER_SNAPSHOT_REFRESH_SECONDS': 1.0,
+    'ORDER_SNAPSHOT_FULL_RELOAD_SECONDS': 3600,  # reconciles hard deletes
+    # Published by `python -m src.columnar_snapshot publish`; None reads the database.
+    # Seeds the order snapshot (which then catches up by watermark) and serves
+    # users/items until it is COLUMNAR_SNAPSHOT_MAX_AGE_SECONDS old; publish more often than that
+    'COLUMNAR_SNAPSHOT_DIR': None,
+    'COLUMNAR_SNAPSHOT_MAX_AGE_SECONDS': 300,
+    'CF_BACKEND': 'sparse',  # 'sparse' (CSR, float32) or 'dense' (pivot table)
+    # Written by `python -m src.core.cf_model build`; None builds the model in-process
+    'CF_MODEL_PATH': None,
+    'CF_MODEL_MAX_AGE_SECONDS': 300,  # in-process model rebuild period without the order snapshot
+    'CF_MODEL_COMPACT_ENTRIES': 200_000,  # pending co-occurrence updates before folding them in
+    'CF_NEIGHBOURS': 30,  # most similar items kept per item; None scores from the full similarity
+    'CF_NEIGHBOURS_REFRESH_SECONDS': 60,
+    'CF_BATCH_CHUNK_SIZE': 2048,  # users scored per matrix multiply in cf_scores_for_users
+    'CF_SOURCE': 'item_cf',  # CF used by recommend_hybrid: 'item_cf' or 'als'
+    # Written by `python -m src.core.als train`; None trains in-process
+    'ALS_MODEL_PATH': None,
+    'ALS_MAX_AGE_SECONDS': 3600,
+    'ALS_FACTORS': 32,
+    'ALS_ITERATIONS': 15,
+    'ALS_REGULARIZATION': 0.1,
+    'ALS_ALPHA': 10.0,
+    # Item ANN index (IVF over ALS item factors); None builds it in-process
+    'ANN_INDEX_PATH': None,
+    'ANN_LISTS': None,  # None: sqrt(number of items)
+    'ANN_PROBES': 8,
+    'ANN_MIN_ITEMS': 20000,  # from this many items ALS scores only ANN candidates
+    'ANN_CANDIDATES': 500,
+    'FAVORITES_MAX_AGE_SECONDS': 300,  # rebuild interval of the favourites engine without the order snapshot
+    # Base popularity in recommend_hybrid: 'orders' (decay over the loaded orders) or 'state'
+    # (running decayed counters, see src/core/popularity.py)
+    'POPULARITY_SOURCE': 'orders',
+    'POPULARITY_HALF_LIFE_DAYS': 30,
+    'POPULARITY_STATE_PATH': None,  # written by `python -m src.core.popularity build` and every POPULARITY_SAVE_SECONDS
+    'POPULARITY_SAVE_SECONDS': 300,
+    'POPULARITY_MAX_AGE_SECONDS': 300,  # rebuild interval without the order snapshot
+    # load_all joins popularity_score / budget_sensitivity from aggregates over all orders
+    'ORDER_AGGREGATES': False,
+    'ORDER_AGGREGATES_MAX_AGE_SECONDS': 300,  # rebuild interval without the order snapshot
+    'RECENT_HISTORY_SIZE': 10,  # order lines kept per user for the recent-purchase penalty (with ORDER_SNAPSHOT)
+    # Diversity re-ranking: 'cap' (at most top_k // 3 per category past the first top_k) or 'mmr'
+    'RERANK_MODE': 'cap',
+    'RERANK_MMR_LAMBDA': 0.7,  # relevance weight against similarity to already picked items
+    'RERANK_MMR_POOL': 100,  # best-scored candidates considered by MMR
+    # SmartRecommender response cache (LRU, bounded by entries and pickled bytes)
+    'RECOMMENDATION_CACHE_MAX_ENTRIES': 1024,
+    'RECOMMENDATION_CACHE_MAX_BYTES': 64 * 2**20,
+    'RECOMMENDATION_CACHE_TTL_SECONDS': 300,
+    'RECOMMENDATION_CACHE_POLL_SECONDS': 2.0,  # changed-order poll that invalidates users (without ORDER_SNAPSHOT)
+    # src.api.executors: blocking route work runs on a 'cpu' or 'db' lane; requests past
+    # workers + queue on a lane get 503 with Retry-After
+    'API_CPU_WORKERS': None,  # None: os.cpu_count()
+    'API_CPU_QUEUE': 64,
+    'API_DB_WORKERS': None,  # None: DB_POOL_SIZE
+    'API_DB_QUEUE': 32,
+    'API_RETRY_AFTER_SECONDS': 1,  # lower bound of the Retry-After estimate
+    'API_BATCH_MAX_USERS': 5000,  # requests accepted by POST /recommendations/batch
+    'API_EXPORT_MAX_CONCURRENT': 1,  # concurrent GET /export/recommendations streams
+    'EXPORT_CHUNK_SIZE': 1000,  # users loaded and scored together by src.export
+}
+
 CORS_ALLOW_ALL_ORIGINS = True
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:3000",
@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from slice.models import Order, OrderLine
+
+
+class Command(BaseCommand):
+    help = "Populate OrderLine from Order.items for existing orders, in batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000, help="Orders per transaction")
+        parser.add_argument('--rebuild', action='store_true', help="Also rewrite orders that already have lines")
+
+    def handle(self, *args, **options):
+        batch_size = max(1, options['batch_size'])
+        orders = Order.objects.order_by('id')
+        if not options['rebuild']:
+            orders = orders.filter(lines__isnull=True)
+
+        last_id = 0
+        converted = lines_written = 0
+        while True:
+            batch = list(orders.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            lines = [line for order in batch for line in OrderLine.from_order(order)]
+            with transaction.atomic():
+                if options['rebuild']:
+                    OrderLine.objects.filter(order__in=batch).delete()
+                OrderLine.objects.bulk_create(lines, batch_size=batch_size)
+            last_id = batch[-1].id
+            converted += len(batch)
+            lines_written += len(lines)
+            self.stdout.write(f"Converted {converted} orders ({lines_written} lines), last id {last_id}")
+
+        self.stdout.write(self.style.SUCCESS(f"Backfill complete: {converted} orders, {lines_written} lines"))
@@ -0,0 +1,36 @@
+# Generated by Django 5.2.6 on 2026-10-18 08:16
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('slice', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OrderLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created_at', models.DateTimeField()),
+                ('position', models.PositiveIntegerField(default=0)),
+                ('name', models.CharField(default='Unknown', max_length=100)),
+                ('qty', models.PositiveIntegerField(default=1)),
+                ('size', models.CharField(default='regular', max_length=20)),
+                ('price', models.FloatField(default=0)),
+                ('added_ingredients', models.JSONField(default=list)),
+                ('removed_ingredients', models.JSONField(default=list)),
+                ('item', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='order_lines', to='slice.menuitem')),
+                ('order', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='slice.order')),
+                ('store', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='order_lines', to='slice.store')),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='order_lines', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['item', 'created_at'], name='slice_order_item_id_f76492_idx'), models.Index(fields=['user', 'created_at'], name='slice_order_user_id_fce387_idx')],
+            },
+        ),
+    ]
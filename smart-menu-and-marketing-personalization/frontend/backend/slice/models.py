@@ -1,5 +1,7 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import AbstractUser
+import json
+import math
 import uuid
 
 # ----------------------------
@@ -142,6 +144,7 @@ class Order(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="orders", null=True, blank=True)
     display_id = models.CharField(max_length=100, blank=True, null=True, unique=True, default=uuid.uuid4)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)  # lets readers fetch changed orders incrementally
     pickup_type = models.CharField(max_length=20, choices=PickupType.choices)
     status = models.CharField(max_length=20, choices=Status.choices, default=Status.PENDING)
     items = models.JSONField(default=list, null=False, blank=False)  # [{itemId, name, qty, size, price, addedIngredients, removedIngredients}]
@@ -150,4 +153,113 @@ class Order(models.Model):
     source = models.CharField(max_length=50, choices=Source.choices, null=True, blank=True)
     meta = models.JSONField(null=True, blank=True) # for extra info like coupon code, delivery address, special instructions, etc.
     def __str__(self):
-        return f"Order {self.display_id}"
\ No newline at end of file
+        return f"Order {self.display_id}"
+
+
+# ----------------------------
+# ORDER LINES
+# ----------------------------
+def _line_field(raw: dict, *keys):
+    """The first of the alternative keys (e.g. ``itemId``/``item_id``) with a non-null value"""
+    for key in keys:
+        if raw.get(key) is not None:
+            return raw[key]
+    return None
+
+
+def _line_number(value, default):
+    """``value`` as a float: ``default`` when missing, None when not a finite number"""
+    if value is None:
+        return default
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+
+def _ingredient_list(value) -> list:
+    """Ingredients as a list; a JSON array stored as text is decoded"""
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return []
+    return value if isinstance(value, list) else []
+
+
+class OrderLine(models.Model):
+    """One line of ``Order.items``, normalized so aggregates can use plain indexed SQL.
+
+    ``user``, ``store`` and ``created_at`` are copied from the order to back the
+    per-item and per-user indexes. ``item`` keeps the raw id from the JSON even
+    when the menu item no longer exists, hence no database constraint.
+    """
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name="lines")
+    item = models.ForeignKey(MenuItem, on_delete=models.DO_NOTHING, db_constraint=False, related_name="order_lines")
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="order_lines", null=True, blank=True)
+    store = models.ForeignKey(Store, on_delete=models.CASCADE, related_name="order_lines")
+    created_at = models.DateTimeField()
+    position = models.PositiveIntegerField(default=0)  # index of the line in Order.items
+    name = models.CharField(max_length=100, default="Unknown")
+    qty = models.PositiveIntegerField(default=1)
+    size = models.CharField(max_length=20, default="regular")
+    price = models.FloatField(default=0)
+    added_ingredients = models.JSONField(default=list)
+    removed_ingredients = models.JSONField(default=list)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["item", "created_at"]),
+            models.Index(fields=["user", "created_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.order} #{self.position}"
+
+    @classmethod
+    def from_order(cls, order: Order) -> list:
+        """Build (unsaved) lines from ``order.items``, skipping malformed entries.
+
+        Fields are read as ``src.data_loader`` reads them from the JSON, so
+        table mode loads the lines python mode would: the first non-null of
+        the alternative keys, a missing qty as 1 and a missing price as 0,
+        qty clamped to at least 1 and price to at least 0. Lines whose item
+        id, qty or price is not a number are dropped.
+        """
+        lines = []
+        items = order.items if isinstance(order.items, list) else []
+        for position, raw in enumerate(items):
+            if not isinstance(raw, dict):
+                continue
+            item_id = _line_number(_line_field(raw, 'itemId', 'item_id', 'id'), None)
+            qty = _line_number(_line_field(raw, 'qty', 'quantity'), 1)
+            price = _line_number(raw.get('price'), 0)
+            if item_id is None or qty is None or price is None:
+                continue
+            name = raw.get('name')
+            size = raw.get('size')
+            lines.append(cls(
+                order=order,
+                item_id=int(item_id),
+                user_id=order.user_id,
+                store_id=order.store_id,
+                created_at=order.created_at,
+                position=position,
+                name=str(name if name is not None else 'Unknown')[:100],
+                qty=int(max(1.0, qty)),
+                size=str(size if size is not None else 'regular')[:20],
+                price=max(0.0, price),
+                added_ingredients=_ingredient_list(_line_field(raw, 'addedIngredients', 'added_ingredients')),
+                removed_ingredients=_ingredient_list(_line_field(raw, 'removedIngredients', 'removed_ingredients')),
+            ))
+        return lines
+
+    @classmethod
+    def sync_order(cls, order: Order) -> int:
+        """Replace the stored lines of ``order`` with the current ``order.items``"""
+        lines = cls.from_order(order)
+        with transaction.atomic():
+            cls.objects.filter(order=order).delete()
+            cls.objects.bulk_create(lines)
+        return len(lines)
@@ -1,3 +1,1015 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import json
+import pickle
+import tempfile
+import threading
+import time
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase, override_settings
+from fastapi.testclient import TestClient
+
+from src.core.collaborative import (SparseUserItemMatrix, TopKNeighbours, cf_scores_for_user, item_similarity,
+                                    user_item_matrix)
+from src.api.api import app
+from src.compact_orders import CompactOrderLines
+from src.core.cf_model import ItemCFModel
+from src.core.contextual import Context
+from src.core.favorites import FavoritesEngine, favorites_for_user, user_favorites
+from src.core.hybrid import _popularity, score_items
+from src.core.popularity import DecayedPopularity
+from src.core.recent import RecentPurchases
+from src.core.rerank import category_codes, category_similarity, mmr, rerank
+from src import export
+from src.data_loader import budget_categories, load_all, load_orders
+from src.order_aggregates import OrderAggregates
+from src.order_snapshot import OrderSnapshot
+from src.recommendation_cache import AsyncSingleFlight, OrderChangeWatcher, RecommendationCache, SingleFlight
+from src.smart_recommender import SmartRecommender, get_smart_recommender
+
+from .models import Menu, MenuItem, Order, OrderLine, Store, User
+
+
+def _orders() -> pd.DataFrame:
+    """Small fixed order-lines frame, in the layout returned by ``load_orders``"""
+    return pd.DataFrame({
+        'order_id': [10, 10, 11, 12, 13, 14, 15, 16, 17],
+        'user_id': [1, 1, 1, 2, 2, 1, 2, 3, 3],
+        'store_id': [1, 1, 1, 1, 2, 2, 1, 1, 1],
+        'item_id': [1, 4, 1, 2, 3, 6, 2, 1, 5],
+        'quantity': [2, 1, 1, 1, 3, 1, 2, 1, 4],
+        'timestamp': pd.to_datetime([
+            '2025-01-02 19:00', '2025-01-02 19:00', '2025-01-20 12:30', '2025-01-05 13:00', '2025-01-25 20:00',
+            '2025-01-28 18:45', '2025-01-30 12:10', '2025-01-31 09:00', '2025-01-31 09:05',
+        ]),
+        'added_ingredients': [['olives'], [], None, ['egg', 'bacon'], [], ['basil'], [], ['ham'], []],
+        'removed_ingredients': [[], [], ['onion'], [], ['croutons'], [], None, [], ['ice']],
+    })
+
+
+def _items() -> pd.DataFrame:
+    return pd.DataFrame({
+        'item_id': [1, 2, 3, 4, 5, 6],
+        'name': ['Margherita', 'Carbonara', 'Caesar', 'Tiramisu', 'Cola', 'Veggie'],
+        'category': ['Pizza', 'Pasta', 'Salad', 'Dessert', 'Cold Drink', 'Pizza'],
+        'price': [9.0, 12.0, 8.5, 6.0, 2.5, 10.0],
+        'dietary_tags': [['vegetarian'], ['meat'], ['cheese'], [], None, ['vegan', 'vegetarian']],
+        'time_preference': ['dinner', 'lunch', 'any', None, 'all', 'dinner'],
+        'seasonal': ['all', 'winter', None, 'summer', 'any', 'autumn'],
+        'budget_category': ['mid', 'high', 'low', None, 'low', 'mid'],
+    })
+
+
+def _users() -> pd.DataFrame:
+    return pd.DataFrame({
+        'user_id': [1, 2, 3],
+        'diet': ['vegetarian', 'none', 'vegan'],
+        'budget_sensitivity': ['low', 'high', 'medium'],
+        'favorite_categories': [['Italian'], ['salad'], []],
+        'allergies': [['cheese'], [], []],
+        'time_preferences': [[], [], []],
+    })
+
+
+def _read_through_test_connection():
+    """Send ``safe_read_sql`` through Django's connection, which sees the test's transaction"""
+    return mock.patch('src.data_loader._engine', connection)
+
+
+def _create_store_and_users(count: int = 2) -> tuple:
+    store = Store.objects.create(name='Central', city='Rome', country='Italy', timezone='UTC',
+                                 open_at=datetime.time(10), close_at=datetime.time(23))
+    return store, [User.objects.create(username=f'user{i}') for i in range(count)]
+
+
+def _create_order(store: Store, user: User, items: list) -> Order:
+    return Order.objects.create(store=store, user=user, pickup_type=Order.PickupType.DELIVERY, items=items,
+                                total=sum(item['price'] * item['qty'] for item in items))
+
+
+def _by_order(lines: pd.DataFrame) -> pd.DataFrame:
+    return lines.sort_values('order_id', kind='stable').reset_index(drop=True)
+
+
+class _RecordingListener:
+    def __init__(self):
+        self.resets = []
+        self.applies = []
+
+    def reset(self, lines):
+        self.resets.append(lines)
+
+    def apply(self, added, removed):
+        self.applies.append((added, removed))
+
+
+def _nested_loop_user_item_matrix(orders: pd.DataFrame) -> pd.DataFrame:
+    """``user_item_matrix`` as it was computed before the grouped aggregation"""
+    mat = orders.pivot_table(
+        index="user_id", columns="item_id", values="quantity", aggfunc="sum", fill_value=0,
+    ).astype(float)
+    for user_id in mat.index:
+        user_orders = orders[orders["user_id"] == user_id]
+        for item_id in mat.columns:
+            item_orders = user_orders[user_orders["item_id"] == item_id]
+            if not item_orders.empty:
+                modifications = sum(
+                    len(mods) if isinstance(mods, list) else 0
+                    for mods in item_orders["added_ingredients"].tolist() + item_orders["removed_ingredients"].tolist()
+                )
+                mat.loc[user_id, item_id] += modifications * 0.2
+    return mat
+
+
+class UserItemMatrixTests(TestCase):
+    def test_matches_nested_loop(self):
+        orders = _orders()
+        pd.testing.assert_frame_equal(user_item_matrix(orders), _nested_loop_user_item_matrix(orders),
+                                      check_names=False)
+
+    def test_empty_orders(self):
+        self.assertTrue(user_item_matrix(_orders().iloc[:0]).empty)
+
+
+class ScoreItemsTests(TestCase):
+    # (user_id, time_of_day, budget_level) -> (score by item_id 1..6, ranking), from the per-row
+    # score_items that preceded ItemFeatures (with its favourites grouped without group keys,
+    # so the favourite boost applies as it did on pandas 1.x)
+    EXPECTED = {
+        (1, None, None): ([2.755576, 0.0, 0.0, 0.0, 1e-06, 1e-06], [1, 6, 5, 2, 4, 3]),
+        (2, 'lunch', None): ([0.955382, 1.004807, 0.0, 0.0, 1e-06, 1e-06], [2, 1, 5, 6, 3, 4]),
+        (3, 'morning', 'low'): ([0.781998, 0.0, 0.0, 0.0, 1e-06, 1e-06], [1, 5, 6, 2, 4, 3]),
+        (7, 'dinner', 'high'): ([1.379997, 0.689999, 1e-06, 0.0, 1e-06, 1e-06], [1, 2, 5, 6, 3, 4]),
+    }
+
+    def test_matches_per_row_scoring(self):
+        users, items, orders = _users(), _items(), _orders()
+        for (user_id, time_of_day, budget_level), (scores, ranking) in self.EXPECTED.items():
+            ctx = Context(user_id=user_id, now=pd.Timestamp('2025-02-01 19:30'), time_of_day=time_of_day,
+                          budget_level=budget_level)
+            scored = score_items(user_id, ctx, users, items, orders)
+            with self.subTest(user_id=user_id):
+                self.assertEqual(scored['item_id'].tolist(), ranking)
+                self.assertEqual(scored.sort_values('item_id')['score'].round(6).tolist(), scores)
+
+
+class SparseUserItemMatrixTests(TestCase):
+    def test_similarity_matches_dense(self):
+        orders = _orders()
+        dense, _, items = item_similarity(user_item_matrix(orders))
+        sparse_matrix = SparseUserItemMatrix.from_orders(orders)
+        self.assertEqual(list(sparse_matrix.items), list(items))
+        np.testing.assert_allclose(sparse_matrix.similarity().toarray(), dense.values, atol=1e-6)
+
+    def test_scores_match_dense_backend(self):
+        orders = _orders()
+        sparse_matrix = SparseUserItemMatrix.from_orders(orders)
+        with override_settings(RECOMMENDER={**settings.RECOMMENDER, 'CF_BACKEND': 'dense'}):
+            for user_id in (1, 2, 3, 99):
+                with self.subTest(user_id=user_id):
+                    expected = cf_scores_for_user(user_id, orders=orders)
+                    scores = sparse_matrix.scores_for_user(user_id)
+                    self.assertEqual(list(scores.index), list(expected.index))
+                    np.testing.assert_allclose(scores.to_numpy(), expected.to_numpy(), atol=1e-5)
+
+
+class TopKNeighboursTests(TestCase):
+    @staticmethod
+    def _truncated_scores(similarity: np.ndarray, weights: np.ndarray, k: int) -> np.ndarray:
+        """Each consumed item spreads its weight over itself and its k most similar other items"""
+        scores = np.zeros(len(weights))
+        for i in np.flatnonzero(weights):
+            scores[i] += weights[i] * similarity[i, i]
+            others = [(-similarity[i, j], j) for j in range(len(weights)) if j != i and similarity[i, j] > 0]
+            for _, j in sorted(others)[:k]:
+                scores[j] += weights[i] * similarity[i, j]
+        return scores
+
+    def test_scores_match_truncated_similarity(self):
+        sparse_matrix = SparseUserItemMatrix.from_orders(_orders())
+        similarity = sparse_matrix.similarity()
+        dense = similarity.toarray().astype(float)
+        for k in (1, 2, len(dense)):
+            index = TopKNeighbours.from_similarity(similarity, k)
+            for user_id in sparse_matrix.users:
+                weights = sparse_matrix.user_vector(user_id).astype(float)
+                with self.subTest(k=k, user_id=user_id):
+                    np.testing.assert_allclose(index.scores(weights), self._truncated_scores(dense, weights, k),
+                                               atol=1e-6)
+                    np.testing.assert_allclose(weights @ index.as_matrix().toarray(), index.scores(weights),
+                                               atol=1e-6)
+
+    def test_full_index_equals_similarity(self):
+        sparse_matrix = SparseUserItemMatrix.from_orders(_orders())
+        similarity = sparse_matrix.similarity().toarray()
+        index = TopKNeighbours.from_similarity(similarity, len(similarity))
+        for user_id in sparse_matrix.users:
+            weights = sparse_matrix.user_vector(user_id)
+            np.testing.assert_allclose(index.scores(weights), similarity @ weights, atol=1e-6)
+
+
+class BatchCFScoresTests(TestCase):
+    def _check_batch(self, model: ItemCFModel):
+        user_ids = [3, 99, 4, 1, 2]
+        seen = []
+        for users, items, scores in model.iter_scores(user_ids, chunk_size=2):
+            for user_id, row in zip(users, scores):
+                expected = model.scores_for_user(user_id)
+                self.assertEqual(list(items), list(expected.index))
+                np.testing.assert_allclose(row, expected.to_numpy(), atol=1e-6)
+                seen.append(user_id)
+        self.assertEqual(seen, [u for u in user_ids if u in model.user_ids])
+
+    def test_batch_matches_single_user_scores(self):
+        orders = _orders()
+        for neighbours in (None, 2):
+            with self.subTest(neighbours=neighbours), \
+                    override_settings(RECOMMENDER={**settings.RECOMMENDER, 'CF_NEIGHBOURS': neighbours}):
+                model = ItemCFModel.from_orders(orders.iloc[:6])
+                self._check_batch(model)
+                # Pending (uncompacted) updates, including a new user and item
+                added = orders.iloc[6:].copy()
+                added.loc[added.index[-1], ['user_id', 'item_id']] = [4, 7]
+                model.apply(added, orders.iloc[:0])
+                self._check_batch(model)
+
+
+class RerankTests(TestCase):
+    @staticmethod
+    def _candidates() -> pd.DataFrame:
+        categories = ['Pizza', 'Pizza', 'Pasta', 'Pizza', None, 'Pasta', 'Salad', 'Pizza', 'Dessert', None,
+                      'Pasta', 'Salad', 'Pizza', 'Dessert']
+        return pd.DataFrame({
+            'item_id': range(1, len(categories) + 1),
+            'category': categories,
+            'score': np.linspace(1.0, 0.1, len(categories)),
+        })
+
+    @staticmethod
+    def _hybrid_loop(scored: pd.DataFrame, top_k: int) -> list:
+        """recommend_hybrid's per-category cap before ``rerank``"""
+        max_per_category = max(1, top_k // 3)
+        seen, diversified = {}, []
+        for _, row in scored.iterrows():
+            cat = row.get("category", "unknown")
+            count = seen.get(cat, 0)
+            if count < max_per_category or len(diversified) < top_k:
+                diversified.append(row)
+                seen[cat] = count + 1
+            if len(diversified) >= top_k * 2:
+                break
+        return [int(row['item_id']) for row in diversified]
+
+    @staticmethod
+    def _smart_loop(recommendations: pd.DataFrame, top_k: int) -> list:
+        """SmartRecommender._apply_diversity_enhancement before ``rerank``"""
+        max_per_category = max(1, top_k // 3)
+        category_counts, diversified = {}, []
+        for _, row in recommendations.iterrows():
+            category = row.get('category', 'unknown')
+            count = category_counts.get(category, 0)
+            if count < max_per_category:
+                diversified.append(row)
+                category_counts[category] = count + 1
+            elif len(diversified) < top_k:
+                diversified.append(row)
+        return [int(row['item_id']) for row in diversified]
+
+    @staticmethod
+    def _greedy_mmr(relevance: np.ndarray, similarity: np.ndarray, k: int, diversity_lambda: float) -> list:
+        picked = []
+        for _ in range(min(k, len(relevance))):
+            best, best_gain = None, -np.inf
+            for i in range(len(relevance)):
+                if i in picked:
+                    continue
+                worst = max([similarity[i, j] for j in picked], default=0.0)
+                gain = diversity_lambda * relevance[i] - (1 - diversity_lambda) * worst
+                if gain > best_gain:
+                    best, best_gain = i, gain
+            picked.append(best)
+        return picked
+
+    def test_cap_matches_previous_loops(self):
+        candidates = self._candidates()
+        for top_k in (1, 3, 5, 6, 10):
+            with self.subTest(top_k=top_k):
+                hybrid = rerank(candidates, top_k, 'score', mode='cap', limit=top_k * 2)
+                self.assertEqual(hybrid['item_id'].tolist(), self._hybrid_loop(candidates, top_k))
+                smart = rerank(candidates, top_k, 'score', mode='cap')
+                self.assertEqual(smart['item_id'].tolist(), self._smart_loop(candidates, top_k))
+
+    def test_mmr_matches_greedy_loop(self):
+        candidates = self._candidates()
+        relevance = candidates['score'].to_numpy()
+        similarities = [category_similarity(category_codes(candidates['category']))]
+        rng = np.random.default_rng(7)
+        random = rng.random((len(candidates), len(candidates)))
+        similarities.append((random + random.T) / 2)
+        for similarity in similarities:
+            for diversity_lambda in (0.3, 0.7, 1.0):
+                with self.subTest(diversity_lambda=diversity_lambda):
+                    self.assertEqual(mmr(relevance, similarity, 6, diversity_lambda).tolist(),
+                                     self._greedy_mmr(relevance, similarity, 6, diversity_lambda))
+
+    def test_mmr_uses_the_similarity_passed_in(self):
+        candidates = self._candidates()
+        relevance = candidates['score'].to_numpy()
+        codes = category_codes(candidates['category'])
+        rng = np.random.default_rng(11)
+        random = rng.random((len(candidates), len(candidates)))
+        pairwise = (random + random.T) / 2
+        pairwise[:, 0] = pairwise[0, :] = 0.0  # an item the CF model has not seen
+
+        def similarity(item_ids):
+            return pairwise[np.ix_(np.asarray(item_ids) - 1, np.asarray(item_ids) - 1)].copy()
+
+        expected = pairwise.copy()
+        expected[0, :], expected[:, 0] = category_similarity(codes)[0, :], category_similarity(codes)[:, 0]
+        with mock.patch('src.core.cf_model.get_cf_model') as get_cf_model:
+            picked = rerank(candidates, 6, 'score', mode='mmr', similarity=similarity)
+        get_cf_model.assert_not_called()
+        normalized = (relevance - relevance.min()) / (relevance.max() - relevance.min())
+        diversity_lambda = settings.RECOMMENDER.get('RERANK_MMR_LAMBDA', 0.7)
+        self.assertEqual(picked['item_id'].tolist(),
+                         [i + 1 for i in self._greedy_mmr(normalized, expected, 6, diversity_lambda)])
+
+        def failing(item_ids):
+            raise RuntimeError('model not loaded')
+
+        with self.assertLogs('src.core.rerank', 'WARNING'):
+            picked = rerank(candidates, 6, 'score', mode='mmr', similarity=failing)
+        self.assertEqual(picked['item_id'].tolist(),
+                         rerank(candidates, 6, 'score', mode='mmr')['item_id'].tolist())
+
+
+class CompactOrderLinesTests(TestCase):
+    def test_round_trip(self):
+        orders = _orders().assign(item_name='x', size='M', price=9.5, total_amount=20.0, pickup_type='Delivery',
+                                  status='done', time_of_day='dinner')
+        orders['added_ingredients'] = orders['added_ingredients'].astype(object)
+        orders.at[0, 'added_ingredients'] = ['cheese', None]
+        orders.at[3, 'removed_ingredients'] = [None, 'onion']
+        compact = CompactOrderLines.from_frame(orders)
+        frame = compact.to_frame()
+
+        for col in ('added_ingredients', 'removed_ingredients'):
+            expected = [v if isinstance(v, list) else [] for v in orders[col]]
+            self.assertEqual(frame[col].tolist(), expected)
+        self.assertEqual(frame['added_ingredients'][0], ['cheese', None])
+        np.testing.assert_array_equal(
+            compact.modification_counts(),
+            [len(a or []) + len(r or []) for a, r in zip(orders['added_ingredients'], orders['removed_ingredients'])]
+        )
+        self.assertEqual(frame['timestamp'].tolist(), orders['timestamp'].dt.tz_localize('UTC').tolist())
+        self.assertEqual(frame['order_id'].tolist(), orders['order_id'].tolist())
+
+
+class SingleFlightTests(TestCase):
+    def _burst(self, flight: SingleFlight, fn, callers: int = 5) -> list:
+        """Run ``flight.do('key', fn)`` from ``callers`` threads; ``fn`` must wait for ``release``"""
+        outcomes = [None] * callers
+
+        def call(i):
+            try:
+                outcomes[i] = flight.do('key', fn)
+            except Exception as e:
+                outcomes[i] = e
+
+        threads = [threading.Thread(target=call, args=(i,)) for i in range(callers)]
+        for thread in threads:
+            thread.start()
+        for _ in range(500):  # until every follower waits on the leader
+            if flight.coalesced == callers - 1:
+                break
+            time.sleep(0.01)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def setUp(self):
+        self.release = threading.Event()
+
+    def test_concurrent_callers_share_one_run(self):
+        flight = SingleFlight()
+        runs = []
+
+        def compute():
+            runs.append(1)
+            self.release.wait(5)
+            return b'value'
+
+        outcomes = self._burst(flight, compute)
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(sorted(shared for _, shared in outcomes), [False, True, True, True, True])
+        self.assertTrue(all(value == b'value' for value, _ in outcomes))
+        self.assertEqual(flight.stats(), {'in_flight': 0, 'executions': 1, 'coalesced': 4, 'coalesced_rate': 0.8,
+                                          'failures': 0})
+
+        # Once finished, the next call runs again
+        self.assertEqual(flight.do('key', lambda: b'again'), (b'again', False))
+        self.assertEqual(flight.executions, 2)
+
+    def test_error_reaches_every_caller(self):
+        flight = SingleFlight()
+
+        def fail():
+            self.release.wait(5)
+            raise ValueError('boom')
+
+        outcomes = self._burst(flight, fail, callers=3)
+        self.assertTrue(all(isinstance(outcome, ValueError) for outcome in outcomes))
+        self.assertEqual((flight.executions, flight.coalesced, flight.failures), (1, 2, 1))
+        self.assertEqual(flight.stats()['in_flight'], 0)
+
+    def test_different_keys_run_separately(self):
+        flight = SingleFlight()
+        self.assertEqual([flight.do(key, lambda: key) for key in ('a', 'b')], [('a', False), ('b', False)])
+        self.assertEqual((flight.executions, flight.coalesced), (2, 0))
+
+
+class AsyncSingleFlightTests(TestCase):
+    def test_concurrent_callers_share_one_run(self):
+        flight = AsyncSingleFlight()
+        runs = []
+
+        async def compute():
+            runs.append(1)
+            await asyncio.sleep(0.01)
+            return 'value'
+
+        async def burst():
+            return await asyncio.gather(*[flight.do('key', compute) for _ in range(5)])
+
+        outcomes = asyncio.run(burst())
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(sorted(shared for _, shared in outcomes), [False, True, True, True, True])
+        self.assertTrue(all(value == 'value' for value, _ in outcomes))
+        self.assertEqual((flight.executions, flight.coalesced, flight.stats()['in_flight']), (1, 4, 0))
+
+    def test_error_reaches_every_caller(self):
+        flight = AsyncSingleFlight()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError('boom')
+
+        async def burst():
+            return await asyncio.gather(*[flight.do('key', fail) for _ in range(3)], return_exceptions=True)
+
+        outcomes = asyncio.run(burst())
+        self.assertTrue(all(isinstance(outcome, ValueError) for outcome in outcomes))
+        self.assertEqual(flight.failures, 1)
+
+
+class OrderSnapshotTests(TestCase):
+    def setUp(self):
+        self.store, self.users = _create_store_and_users()
+        self.first = _create_order(self.store, self.users[0], [
+            {'itemId': 1, 'name': 'Margherita', 'qty': 2, 'price': 9.0, 'addedIngredients': ['olives']},
+            {'itemId': 4, 'name': 'Tiramisu', 'qty': 1, 'price': 6.0},
+        ])
+        _create_order(self.store, self.users[1], [{'itemId': 2, 'name': 'Carbonara', 'qty': 1, 'price': 12.0}])
+
+    def test_refresh_follows_new_and_edited_orders(self):
+        with _read_through_test_connection():
+            snapshot = OrderSnapshot(refresh_interval=0, full_reload_interval=0)
+            listener = _RecordingListener()
+            snapshot.subscribe(listener)
+            pd.testing.assert_frame_equal(_by_order(snapshot.frame()), _by_order(load_orders(mode='python')))
+            self.assertEqual([len(lines) for lines in listener.resets], [3])
+
+            new = _create_order(self.store, self.users[1], [{'itemId': 5, 'name': 'Cola', 'qty': 3, 'price': 2.5}])
+            self.first.status = Order.Status.COMPLETED
+            self.first.items = [{'itemId': 6, 'name': 'Veggie', 'qty': 1, 'price': 10.0}]
+            self.first.save()
+
+            frame = snapshot.frame()
+            pd.testing.assert_frame_equal(_by_order(frame), _by_order(load_orders(mode='python')))
+            self.assertEqual(set(frame.loc[frame['order_id'] == self.first.id, 'status']), {'COMPLETED'})
+            self.assertEqual(len(listener.applies), 1)
+            added, removed = listener.applies[0]
+            self.assertEqual(sorted(zip(added['order_id'], added['item_id'])), sorted([(self.first.id, 6), (new.id, 5)]))
+            self.assertEqual(sorted(zip(removed['order_id'], removed['item_id'])), [(self.first.id, 1), (self.first.id, 4)])
+            self.assertEqual(len(snapshot.frame(self.users[1].uid)), 2)
+
+
+class RecommendationCacheTests(TestCase):
+    @staticmethod
+    def _response(size: int = 10) -> dict:
+        return {'recommendations': [{'item_id': i} for i in range(size)], 'metadata': {'from_cache': False}}
+
+    def test_evicts_least_recently_used_by_count(self):
+        cache = RecommendationCache(max_entries=2, ttl=60)
+        cache.put((1, 'a'), 'a')
+        cache.put((2, 'b'), 'b')
+        cache.get((1, 'a'))
+        cache.put((3, 'c'), 'c')
+        self.assertEqual([cache.get(key) for key in [(1, 'a'), (2, 'b'), (3, 'c')]], ['a', None, 'c'])
+        self.assertEqual(cache.evictions, 1)
+
+    def test_evicts_by_bytes(self):
+        entry_bytes = len(pickle.dumps(self._response(), protocol=pickle.HIGHEST_PROTOCOL))
+        cache = RecommendationCache(max_entries=100, max_bytes=int(entry_bytes * 2.5), ttl=60)
+        for user_id in (1, 2, 3):
+            cache.put((user_id,), self._response())
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get((1,)))
+        self.assertLessEqual(cache.bytes, cache.max_bytes)
+        cache.put((4,), self._response(100_000))
+        self.assertIsNone(cache.get((4,)))  # larger than the whole cache
+        self.assertEqual(len(cache), 2)
+
+    def test_entries_expire(self):
+        cache = RecommendationCache(ttl=10)
+        with mock.patch('src.recommendation_cache.time.monotonic', return_value=100.0):
+            cache.put((1,), 'value')
+        with mock.patch('src.recommendation_cache.time.monotonic', return_value=109.0):
+            self.assertEqual(cache.get((1,)), 'value')
+        with mock.patch('src.recommendation_cache.time.monotonic', return_value=111.0):
+            self.assertIsNone(cache.get((1,)))
+        self.assertEqual((cache.expirations, len(cache), cache.bytes), (1, 0, 0))
+
+    def test_invalidate_user_drops_every_key_of_the_user(self):
+        cache = RecommendationCache(ttl=60)
+        for key in [(1, 5), (1, 10), (1, 10, 'pizza'), (2, 5)]:
+            cache.put(key, key)
+        self.assertEqual(cache.invalidate_user(1), 3)
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.get((2, 5)), (2, 5))
+        self.assertEqual(cache.invalidate_user(1), 0)
+
+    def test_keys_differ_by_top_k_and_query(self):
+        ctx = Context(user_id=1, now=pd.Timestamp('2025-01-02 19:00'), budget_level='mid').ensure()
+        keys = [SmartRecommender._cache_key(1, top_k, ctx, query, False)
+                for top_k, query in [(5, None), (10, None), (10, 'vegan'), (10, 'cheap')]]
+        self.assertEqual(len(set(keys)), 4)
+        self.assertEqual(SmartRecommender._cache_key(1, 10, ctx, ' Vegan ', False), keys[2])
+
+        cache = RecommendationCache(ttl=60)
+        for i, key in enumerate(keys):
+            cache.put(key, i)
+        self.assertEqual([cache.get(key) for key in keys], [0, 1, 2, 3])
+
+    def test_returned_copy_is_independent(self):
+        cache = RecommendationCache(ttl=60)
+        cache.put((1,), self._response())
+        copy = cache.get((1,))
+        copy['metadata']['from_cache'] = True
+        copy['recommendations'].clear()
+        self.assertEqual(cache.get((1,)), self._response())
+
+    def test_put_skips_results_computed_before_an_invalidation(self):
+        cache = RecommendationCache(ttl=60)
+        generation = cache.generation(1)
+        cache.invalidate_user(1)
+        cache.put((1,), 'stale', generation)
+        self.assertIsNone(cache.get((1,)))
+        cache.put((1,), 'fresh', cache.generation(1))
+        self.assertEqual(cache.get((1,)), 'fresh')
+        self.assertEqual(cache.stale_puts, 1)
+
+
+class OrderChangeWatcherTests(TestCase):
+    def test_invalidates_users_whose_orders_changed(self):
+        store, users = _create_store_and_users(3)
+        orders = [_create_order(store, user, [{'itemId': 1, 'qty': 1, 'price': 9.0}]) for user in users[:2]]
+        cache = RecommendationCache(ttl=60)
+        for user in users:
+            cache.put((user.uid, 10), 'cached')
+
+        with _read_through_test_connection():
+            watcher = OrderChangeWatcher(cache, interval=0)
+            self.assertEqual(watcher.poll(), 0)  # first poll only sets the watermark
+            self.assertEqual(len(cache), 3)
+
+            orders[0].status = Order.Status.COMPLETED
+            orders[0].save()
+            _create_order(store, users[2], [{'itemId': 2, 'qty': 1, 'price': 12.0}])
+            self.assertEqual(watcher.poll(), 2)
+            self.assertEqual([cache.get((user.uid, 10)) for user in users], [None, 'cached', None])
+            self.assertEqual(watcher.poll(), 0)
+
+
+@override_settings(RECOMMENDER={**settings.RECOMMENDER, 'CF_NEIGHBOURS': None})
+class ItemCFModelUpdateTests(TestCase):
+    def assertSameScores(self, model: ItemCFModel, expected: ItemCFModel):
+        self.assertEqual(sorted(model.user_ids), sorted(expected.user_ids))
+        for user_id in expected.user_ids:
+            with self.subTest(user_id=user_id):
+                scores = model.scores_for_user(user_id)
+                reference = expected.scores_for_user(user_id)
+                # Items whose last line was removed keep a column, scored 0
+                items = scores.index.union(reference.index)
+                np.testing.assert_allclose(scores.reindex(items, fill_value=0).to_numpy(),
+                                           reference.reindex(items, fill_value=0).to_numpy(), atol=1e-5)
+
+    def test_apply_added_lines_matches_rebuild(self):
+        orders = _orders()
+        early = orders['timestamp'] < '2025-01-25'
+        model = ItemCFModel.from_orders(orders.loc[early])
+        model.apply(orders.loc[~early], orders.iloc[:0])  # includes a new user and new items
+        self.assertSameScores(model, ItemCFModel.from_orders(orders))
+        self.assertEqual(model.watermark, ItemCFModel.from_orders(orders).watermark)
+
+    def test_apply_removed_and_edited_lines_matches_rebuild(self):
+        orders = _orders()
+        model = ItemCFModel.from_orders(orders)
+        removed = orders.loc[orders['order_id'].isin([10, 15])]
+        edited = orders.loc[orders['order_id'] == 10].assign(quantity=[5, 1], item_id=[1, 3])
+        model.apply(edited, removed)
+        expected = pd.concat([orders.loc[~orders['order_id'].isin([10, 15])], edited], ignore_index=True)
+        self.assertSameScores(model, ItemCFModel.from_orders(expected))
+
+    def test_compact_keeps_scores(self):
+        orders = _orders()
+        early = orders['timestamp'] < '2025-01-25'
+        model = ItemCFModel.from_orders(orders.loc[early])
+        model.apply(orders.loc[~early], orders.iloc[:0])
+        before = {user_id: model.scores_for_user(user_id) for user_id in model.user_ids}
+        similarity = model.similarity().toarray()
+
+        model.compact()
+        self.assertEqual((model.stats()['pending_entries'], model.stats()['changed_users']), (0, 0))
+        for user_id, scores in before.items():
+            np.testing.assert_allclose(model.scores_for_user(user_id).to_numpy(), scores.to_numpy(), atol=1e-9)
+        np.testing.assert_allclose(model.similarity().toarray(), similarity, atol=1e-9)
+        self.assertSameScores(model, ItemCFModel.from_orders(orders))
+
+    def test_loaded_artifact_catches_up_from_its_watermark(self):
+        orders = _orders()
+        early = orders['timestamp'] < '2025-01-25'
+        built = ItemCFModel.from_orders(orders.loc[early])
+        with tempfile.TemporaryDirectory() as root:
+            path = built.save(f"{root}/item_cf.npz")
+            loaded = ItemCFModel.load(path)
+        self.assertEqual(loaded.watermark, built.watermark)
+        self.assertEqual(loaded.version, built.version)
+        self.assertSameScores(loaded, built)
+
+        with mock.patch.object(ItemCFModel, 'from_orders', wraps=ItemCFModel.from_orders) as from_orders:
+            loaded.reset(orders)
+        from_orders.assert_not_called()  # only the newer lines were applied
+        self.assertEqual(loaded.stats()['changed_users'], 3)
+        self.assertSameScores(loaded, ItemCFModel.from_orders(orders))
+
+        # Later resets (a full snapshot reload) rebuild
+        loaded.reset(orders.loc[early])
+        self.assertSameScores(loaded, built)
+
+
+class DecayedPopularityTests(TestCase):
+    NOW = pd.Timestamp('2025-02-15 08:00', tz='UTC')
+
+    @staticmethod
+    def _state(lines: pd.DataFrame) -> DecayedPopularity:
+        state = DecayedPopularity(half_life_days=30)
+        state.reset(lines)
+        return state
+
+    def assertSameState(self, state: DecayedPopularity, expected: DecayedPopularity):
+        for store_id in (None, 1, 2):
+            with self.subTest(store_id=store_id):
+                scores = state.scores(store_id, now=self.NOW).sort_index()
+                reference = expected.scores(store_id, now=self.NOW).sort_index()
+                self.assertEqual(list(scores.index), list(reference.index))
+                np.testing.assert_allclose(scores.to_numpy(), reference.to_numpy(), rtol=1e-9)
+        self.assertEqual(state.watermark, expected.watermark)
+
+    def test_apply_matches_reset_on_full_history(self):
+        orders = _orders()
+        early = orders['timestamp'] < '2025-01-25'
+        state = self._state(orders.loc[early])
+        state.apply(orders.loc[~early], orders.iloc[:0])
+        self.assertSameState(state, self._state(orders))
+
+        # An edited order: its old lines go, the new ones come in
+        removed = orders.loc[orders['order_id'] == 13]
+        edited = removed.assign(item_id=4)
+        state.apply(edited, removed)
+        self.assertSameState(state, self._state(pd.concat([orders.loc[orders['order_id'] != 13], edited])))
+
+    def test_round_trip_catches_up_from_watermark(self):
+        orders = _orders()
+        early = orders['timestamp'] < '2025-01-25'
+        saved = self._state(orders.loc[early])
+        with tempfile.TemporaryDirectory() as root:
+            loaded = DecayedPopularity.load(saved.save(f"{root}/popularity.npz"))
+        self.assertSameState(loaded, saved)
+
+        with mock.patch.object(DecayedPopularity, '_clear', wraps=loaded._clear) as clear:
+            loaded.reset(orders)
+        clear.assert_not_called()  # only the lines after the watermark were added
+        self.assertSameState(loaded, self._state(orders))
+
+    def test_ordering_matches_hybrid_popularity(self):
+        orders = _orders()
+        state = self._state(orders)
+        for now in ('2025-02-01 12:00', '2025-02-15 08:00', '2025-03-20 00:00'):
+            with self.subTest(now=now):
+                now = pd.Timestamp(now, tz='UTC')
+                normalized = state.normalized(now=now)
+                reference = _popularity(Context(user_id=1, now=now), orders)
+                self.assertEqual(normalized.sort_values(ascending=False).index.tolist(),
+                                 reference.sort_values(ascending=False).index.tolist())
+                # score_items counts whole days of age; the state uses exact ages
+                np.testing.assert_allclose(normalized.sort_index().to_numpy(), reference.sort_index().to_numpy(),
+                                           atol=0.02)
+
+
+class OrderAggregatesTests(TestCase):
+    @staticmethod
+    def _lines() -> pd.DataFrame:
+        return _orders().assign(total_amount=[1200.0, 1200.0, 900.0, 4000.0, 2500.0, 1000.0, 3800.0, 1600.0, 1600.0])
+
+    def assertSameAggregates(self, aggregates: OrderAggregates, expected: OrderAggregates):
+        for store_id in (None, 1, 2):
+            with self.subTest(store_id=store_id):
+                popularity = aggregates.popularity(store_id).sort_index()
+                reference = expected.popularity(store_id).sort_index()
+                self.assertEqual(list(popularity.index), list(reference.index))
+                np.testing.assert_allclose(popularity.to_numpy(), reference.to_numpy(), atol=1e-9)
+        self.assertEqual(aggregates.budget_categories().sort_index().to_dict(),
+                         expected.budget_categories().sort_index().to_dict())
+
+    def test_apply_matches_rebuild(self):
+        lines = self._lines()
+        early = lines['timestamp'] < '2025-01-25'
+        aggregates = OrderAggregates(lines.loc[early])
+        aggregates.apply(lines.loc[~early], lines.iloc[:0])  # includes a new user and new items
+        self.assertSameAggregates(aggregates, OrderAggregates(lines))
+
+        # An edited order and a cancelled one: their old lines go, the new ones come in
+        removed = lines.loc[lines['order_id'].isin([12, 13])]
+        edited = lines.loc[lines['order_id'] == 13].assign(item_id=4, total_amount=500.0)
+        aggregates.apply(edited, removed)
+        expected = pd.concat([lines.loc[~lines['order_id'].isin([12, 13])], edited], ignore_index=True)
+        self.assertSameAggregates(aggregates, OrderAggregates(expected))
+        self.assertEqual(aggregates.stats()['updates'], 2)
+
+    @override_settings(RECOMMENDER={**settings.RECOMMENDER, 'ORDER_AGGREGATES': True, 'ORDER_SNAPSHOT': False,
+                                    'COLUMNAR_SNAPSHOT_DIR': None})
+    def test_user_scoped_load_all_uses_every_order(self):
+        store, users = _create_store_and_users(2)
+        menu = Menu.objects.create(store=store)
+        items = [MenuItem.objects.create(menu=menu, name={'en': name}, category=MenuItem.Category.PIZZA, price=price,
+                                         display_type=MenuItem.DisplayType.NORMAL)
+                 for name, price in (('Margherita', 900), ('Diavola', 1100), ('Tiramisu', 600))]
+        line = lambda item, qty: {'itemId': item.item_id, 'qty': qty, 'price': float(item.price)}
+        _create_order(store, users[0], [line(items[0], 1)])
+        _create_order(store, users[0], [line(items[2], 2)])
+        # Most of the ordering comes from the other user, whose orders a user-scoped load leaves out
+        _create_order(store, users[1], [line(items[1], 4), line(items[0], 1)])
+
+        with _read_through_test_connection(), mock.patch('src.order_aggregates._order_aggregates', None):
+            every_order = load_orders()
+            loaded_users, loaded_items, orders = load_all(user_id=users[0].uid)
+
+        self.assertEqual(set(orders['user_id']), {users[0].uid})
+        quantities = every_order.groupby('item_id')['quantity'].sum()
+        popularity = (quantities - quantities.min()) / (quantities.max() - quantities.min() + 1e-6)
+        np.testing.assert_allclose(loaded_items.set_index('item_id')['popularity_score'].sort_index().to_numpy(),
+                                   popularity.sort_index().to_numpy(), atol=1e-9)
+        self.assertEqual(loaded_items.set_index('item_id')['popularity_score'].idxmax(), items[1].item_id)
+
+        budgets = budget_categories(every_order.groupby('user_id')['total_amount'].mean())
+        self.assertEqual(loaded_users['budget_sensitivity'].tolist(), [budgets[users[0].uid]])
+
+
+def _load_fixtures(user_id=None, store_id=None) -> tuple:
+    """``load_all`` over the fixtures: a user-scoped load holds only that user's order lines"""
+    orders = _orders()
+    return _users(), _items(), orders if user_id is None else orders.loc[orders['user_id'] == user_id]
+
+
+class BatchRecommendationsEndpointTests(TestCase):
+    REQUESTS = [{'user_id': 1, 'top': 3, 'time': 'dinner'}, {'user_id': 3, 'top': 2, 'time': 'lunch'},
+                {'user_id': 2, 'top': 4, 'time': 'dinner', 'budget': 'low'}]
+
+    def setUp(self):
+        self.client = TestClient(app)
+        get_smart_recommender().recommendation_cache.clear()
+        patcher = mock.patch('src.api.api.load_all', side_effect=_load_fixtures)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _single(self, entry: dict, use_smart: bool) -> dict:
+        params = {'user_id': entry['user_id'], 'top': entry['top'], 'time': entry['time'], 'use_smart': use_smart}
+        if 'budget' in entry:
+            params['budget'] = entry['budget']
+        response = self.client.get('/recommendations', params=params)
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    @override_settings(RECOMMENDER={**settings.RECOMMENDER, 'API_BATCH_MAX_USERS': 2})
+    def test_rejects_batches_above_the_limit(self):
+        response = self.client.post('/recommendations/batch', json={'requests': self.REQUESTS})
+        self.assertEqual(response.status_code, 413)
+        response = self.client.post('/recommendations/batch', json={'requests': self.REQUESTS[:2]})
+        self.assertEqual(response.status_code, 200)
+
+    def test_reports_invalid_requests_inline(self):
+        response = self.client.post('/recommendations/batch', json={'requests': [
+            {'user_id': -1}, self.REQUESTS[0], {'user_id': 2, 'top': 0},
+        ], 'use_smart': False})
+        self.assertEqual(response.status_code, 200)
+        body = response.json()
+        self.assertEqual(body['results'][0], {'user_id': -1, 'error': 'user_id must be positive'})
+        self.assertEqual(body['results'][2], {'user_id': 2, 'error': 'top must be at least 1'})
+        self.assertEqual(len(body['results'][1]['recommendations']), 3)
+        self.assertEqual((body['metadata']['succeeded'], body['metadata']['failed']), (1, 2))
+
+    def test_results_match_single_user_route(self):
+        for use_smart in (False, True):
+            with self.subTest(use_smart=use_smart):
+                response = self.client.post('/recommendations/batch',
+                                            json={'requests': self.REQUESTS, 'use_smart': use_smart})
+                self.assertEqual(response.status_code, 200)
+                results = response.json()['results']
+                # Score the single-user route afresh rather than from what the batch cached
+                get_smart_recommender().recommendation_cache.clear()
+                for entry, result in zip(self.REQUESTS, results):
+                    single = self._single(entry, use_smart)
+                    self.assertEqual(result['user_id'], entry['user_id'])
+                    self.assertEqual([r['item_id'] for r in result['recommendations']],
+                                     [r['item_id'] for r in single['recommendations']])
+                    np.testing.assert_allclose([r['hybrid_score'] for r in result['recommendations']],
+                                               [r['hybrid_score'] for r in single['recommendations']], rtol=1e-6)
+
+
+def _load_fixture_chunk(after, limit, items) -> tuple:
+    """``load_user_chunk`` over the fixtures"""
+    users = _users()
+    users = users.loc[users['user_id'] > (after or 0)].head(limit)
+    orders = _orders()
+    return users, orders.loc[orders['user_id'].isin(users['user_id'])]
+
+
+class ExportResumeTests(TestCase):
+    def setUp(self):
+        for target, fake in (('load_items', _items), ('load_user_chunk', _load_fixture_chunk)):
+            patcher = mock.patch(f'src.export.{target}', side_effect=fake)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        root = tempfile.TemporaryDirectory()
+        self.addCleanup(root.cleanup)
+        self.root = root.name
+
+    @staticmethod
+    def _recommended(path) -> list:
+        with open(path) as f:
+            return [(line['user_id'], [r['item_id'] for r in line['recommendations']]) for line in map(json.loads, f)]
+
+    def test_resume_drops_the_partial_chunk_and_continues(self):
+        complete = export.export(f"{self.root}/complete.ndjson", top_k=2, chunk_size=1)
+        self.assertEqual((complete['users'], complete['after']), (3, 3))
+
+        output = f"{self.root}/resumed.ndjson"
+        score_chunk = export.score_chunk
+
+        def crash_on_last_user(users, *args, **kwargs):
+            if 3 in set(users['user_id']):
+                raise KeyboardInterrupt
+            return score_chunk(users, *args, **kwargs)
+
+        with mock.patch('src.export.score_chunk', side_effect=crash_on_last_user):
+            with self.assertRaises(KeyboardInterrupt):
+                export.export(output, top_k=2, chunk_size=1)
+        self.assertEqual(json.loads(export.cursor_path(output).read_text())['after'], 2)
+        with open(output, 'a') as f:
+            f.write('{"user_id": 3, "recommen')  # a chunk written past the cursor
+
+        resumed = export.export(output, top_k=2, chunk_size=1, resume=True)
+        self.assertEqual((resumed['users'], resumed['after']), (3, 3))
+        self.assertEqual(self._recommended(output), self._recommended(f"{self.root}/complete.ndjson"))
+
+    def test_resume_rejects_other_export_parameters(self):
+        output = f"{self.root}/recs.ndjson"
+        export.export(output, top_k=2, chunk_size=2)
+        written = open(output).read()
+        for kwargs in ({'top_k': 5}, {'top_k': 2, 'time_of_day': 'lunch'}, {'top_k': 2, 'fmt': 'parquet'}):
+            with self.subTest(**kwargs), self.assertRaises(ValueError):
+                export.export(output, chunk_size=2, resume=True, **kwargs)
+        self.assertEqual(open(output).read(), written)
+
+
+class OrderLineTableTests(TestCase):
+    def test_table_mode_matches_python_mode(self):
+        store, users = _create_store_and_users()
+        orders = [
+            Order.objects.create(store=store, user=users[0], pickup_type=Order.PickupType.DELIVERY, total=40.0, items=[
+                {'itemId': 0, 'name': 'Free bread', 'qty': 1, 'price': 0},
+                {'itemId': None, 'item_id': '7', 'qty': None, 'price': None, 'size': None},
+                {'id': 3, 'quantity': '2', 'price': '9.5', 'name': None, 'addedIngredients': '["basil"]'},
+                {'itemId': 4, 'qty': 0, 'price': -2.0, 'removedIngredients': None, 'removed_ingredients': ['ice']},
+                {'itemId': 5, 'qty': 2.7, 'price': 3.0},
+            ]),
+            Order.objects.create(store=store, user=users[1], pickup_type=Order.PickupType.DELIVERY, total=12.0, items=[
+                {'itemId': 'pizza', 'qty': 1, 'price': 9.0},
+                {'itemId': 2, 'qty': 'two', 'price': 9.0},
+                {'itemId': 6, 'qty': 1, 'price': 'free'},
+                'not a line',
+                {'qty': 1, 'price': 12.0},
+                {'itemId': 2, 'qty': 1, 'price': 12.0, 'name': 'Carbonara', 'size': 'large'},
+            ]),
+        ]
+        for order in orders:
+            OrderLine.sync_order(order)
+
+        with _read_through_test_connection():
+            python_lines = load_orders(mode='python')
+            table_lines = load_orders(mode='table')
+        self.assertEqual(len(table_lines), 6)
+        columns = ['order_id', 'item_id', 'item_name', 'quantity', 'size', 'price', 'added_ingredients',
+                   'removed_ingredients']
+        pd.testing.assert_frame_equal(_by_order(table_lines)[columns], _by_order(python_lines)[columns])
+
+
+class FavoritesEngineTests(TestCase):
+    def assertSameFavorites(self, engine: FavoritesEngine, lines: pd.DataFrame):
+        expected = user_favorites(lines)
+        favorites = engine.favorites()
+        self.assertEqual(list(favorites.index), list(expected.index))
+        np.testing.assert_allclose(favorites.to_numpy(), expected.to_numpy(), atol=1e-9)
+
+    def test_apply_matches_rebuild(self):
+        orders = _orders()
+        early = orders['timestamp'] < '2025-01-25'
+        engine = FavoritesEngine(orders.loc[early])
+        engine.apply(orders.loc[~early], orders.iloc[:0])  # includes a new user and new items
+        self.assertSameFavorites(engine, orders)
+
+        # An edited order and a cancelled one: their old lines go, the new ones come in
+        removed = orders.loc[orders['order_id'].isin([10, 13])]
+        edited = orders.loc[orders['order_id'] == 10].assign(item_id=[2, 2])
+        engine.apply(edited, removed)
+        self.assertSameFavorites(engine, pd.concat([orders.loc[~orders['order_id'].isin([10, 13])], edited]))
+        self.assertEqual(engine.stats()['updates'], 2)
+
+    def test_for_user_matches_per_request_favorites(self):
+        orders = _orders()
+        engine = FavoritesEngine(orders)
+        for user_id in (1, 2, 3):
+            with self.subTest(user_id=user_id):
+                favorites = engine.for_user(user_id).sort_index()
+                reference = favorites_for_user(orders.loc[orders['user_id'] == user_id]).sort_index()
+                self.assertEqual(list(favorites.index), list(reference.index))
+                np.testing.assert_allclose(favorites.to_numpy(), reference.to_numpy(), atol=1e-9)
+        self.assertTrue(engine.for_user(99).empty)
+
+
+class RecentPurchasesTests(TestCase):
+    @staticmethod
+    def _recent(size: int, lines: pd.DataFrame) -> RecentPurchases:
+        recent = RecentPurchases(size=size)
+        recent.reset(lines)
+        return recent
+
+    def assertMatchesPerRequest(self, recent: RecentPurchases, lines: pd.DataFrame, n: int = 3):
+        for user_id in (1, 2, 3):
+            with self.subTest(user_id=user_id):
+                mine = lines.loc[lines['user_id'] == user_id]
+                # score_items' recent-purchase lookup
+                expected = mine.sort_values('timestamp', kind='stable')['item_id'].tail(n).tolist()
+                self.assertEqual(recent.recent_items(user_id, n), expected)
+
+    def test_matches_per_request_lookup(self):
+        orders = _orders()
+        self.assertMatchesPerRequest(self._recent(10, orders), orders)
+        # Lines of the newest orders first, as load_orders returns them
+        newest_first = orders.sort_values('timestamp', ascending=False, kind='stable')
+        self.assertMatchesPerRequest(self._recent(10, newest_first), newest_first)
+        self.assertEqual(self._recent(10, orders).recent_items(99), [])
+
+    def test_apply_matches_rebuild(self):
+        orders = _orders()
+        early = orders['timestamp'] < '2025-01-25'
+        recent = self._recent(10, orders.loc[early])
+        recent.apply(orders.loc[~early], orders.iloc[:0])  # includes a new user
+        self.assertMatchesPerRequest(recent, orders)
+
+        # An edited order keeps its place; a cancelled one's lines go
+        removed = orders.loc[orders['order_id'].isin([10, 17])]
+        edited = orders.loc[orders['order_id'] == 10].assign(item_id=[3, 6])
+        recent.apply(edited, removed)
+        self.assertMatchesPerRequest(recent, pd.concat([orders.loc[~orders['order_id'].isin([10, 17])], edited]))
+
+    def test_buffers_are_trimmed_to_the_newest_lines(self):
+        orders = _orders()
+        recent = self._recent(2, orders)
+        self.assertEqual([recent.recent_items(user_id, 5) for user_id in (1, 2, 3)], [[1, 6], [3, 2], [1, 5]])
+
+        newer = pd.DataFrame({'order_id': [20, 20], 'user_id': [1, 1], 'item_id': [5, 2],
+                              'timestamp': pd.to_datetime(['2025-02-03 20:00'] * 2)})
+        older = pd.DataFrame({'order_id': [9], 'user_id': [2], 'item_id': [4],
+                              'timestamp': pd.to_datetime(['2024-12-30 12:00'])})
+        recent.apply(pd.concat([newer, older], ignore_index=True), orders.iloc[:0])
+        self.assertEqual(recent.recent_items(1, 5), [5, 2])  # lines of one order keep their order
+        self.assertEqual(recent.recent_items(2, 5), [3, 2])  # older than everything kept
+        self.assertEqual(recent.recent_items(1, 1), [2])
@@ -1,4 +1,5 @@
 from random import randint
+from django.db import transaction
 from django.utils import timezone
 from django.shortcuts import render
 from rest_framework import generics
@@ -139,7 +140,9 @@ class OrderListCreateView(generics.CreateAPIView):
         serializer.validated_data['created_at'] = timezone.now()
         serializer.validated_data['status'] = Order.Status.PENDING
         serializer.validated_data['total'] = sum([item['price'] * item['qty'] for item in serializer.validated_data['items']])
-        serializer.save()
+        with transaction.atomic():
+            order = serializer.save()
+            OrderLine.sync_order(order)
 
 class OrderListView(generics.ListAPIView):
     queryset = Order.objects.all()
@@ -173,19 +176,22 @@ class OrderDetailView(generics.RetrieveUpdateDestroyAPIView):
             case Order.Status.PREPARING if serializer.validated_data.get('status') != Order.Status.CANCELLED:
                 raise serializers.ValidationError("Cannot modify an order in preparation.")
         
-        # Only update user's XP and nexo coins if order status is being set to CONFIRMED
-        new_status = serializer.validated_data.get('status', old_instance.status)
-        if new_status == Order.Status.COMPLETED:
-            new_items = serializer.validated_data.get('items', old_instance.items)
-            itemcount = sum([item['qty'] for item in new_items])
-            user.xp += itemcount * 10  # 10 XP per item
-            user.nexo_coins += total * 0.3  # 30% of the total in nexo coins
-            while user.xp >= 100:  # level up for every 100 XP
-                user.level += 1
-                user.xp -= 100
-            user.save()
-
-        serializer.save()
+        # The reward, the order and its lines are saved together or not at all
+        with transaction.atomic():
+            # Only update user's XP and nexo coins if order status is being set to CONFIRMED
+            new_status = serializer.validated_data.get('status', old_instance.status)
+            if new_status == Order.Status.COMPLETED:
+                new_items = serializer.validated_data.get('items', old_instance.items)
+                itemcount = sum([item['qty'] for item in new_items])
+                user.xp += itemcount * 10  # 10 XP per item
+                user.nexo_coins += total * 0.3  # 30% of the total in nexo coins
+                while user.xp >= 100:  # level up for every 100 XP
+                    user.level += 1
+                    user.xp -= 100
+                user.save()
+
+            order = serializer.save()
+            OrderLine.sync_order(order)
  
     def perform_destroy(self, instance):
         if instance.status in [Order.Status.COMPLETED, Order.Status.CANCELLED, Order.Status.PREPARING]:
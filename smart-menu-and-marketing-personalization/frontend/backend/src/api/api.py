@@ -1,14 +1,24 @@
 import pandas as pd
-from fastapi import FastAPI, Query, HTTPException
+from fastapi import FastAPI, Query, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
 from datetime import datetime, timezone
 from typing import Optional
+from pydantic import BaseModel
 from src.core.contextual import Context
-from src.core.hybrid import recommend_hybrid as base_recommend
+from src.core.hybrid import recommend_hybrid as base_recommend, recommend_hybrid_batch
+from src.core.ann import similar_items
 from src.smart_recommender import get_smart_recommender
 from src.smart_query_processor import get_query_processor
 from src.notifications import generate_notifications
-from src.data_loader import get_sample_data
+from src.data_loader import get_sample_data, get_pool_stats, recommender_setting, load_all, load_items, load_orders, load_user_chunk
+from src.compact_orders import memory_report
+from src.order_snapshot import get_order_snapshot
+from src.recommendation_cache import AsyncSingleFlight
+from src.api.executors import Overloaded, get_lane, lane_stats, offload, run_patiently
+from src.export import ndjson_chunk, score_chunk
 import logging
+import threading
+import weakref
 from src.utils import convert_numpy, clean
 import numpy as np
 
@@ -18,6 +28,16 @@ logger = logging.getLogger(__name__)
 app = FastAPI(title="Smart Menu API - Hackathon Edition", version="2.0.0")
 
 
+@app.exception_handler(Overloaded)
+async def overloaded_handler(request: Request, exc: Overloaded):
+    """Shed load instead of queueing without bound"""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": str(exc), "lane": exc.lane},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+
 def convert_numpy(obj):
     if isinstance(obj, np.generic):
         return obj.item()
@@ -36,33 +56,47 @@ def clean(obj):
     return obj
 
 
-@app.get("/recommendations")
-def get_recommendations(
-    user_id: int, 
-    time: str | None = Query(None), 
-    budget: str | None = Query(None), 
-    top: int = 10,
-    query: str | None = Query(None, description="Natural language query for recommendations"),
-    include_explanation: bool = Query(False, description="Include AI-generated explanation"),
-    use_smart: bool = Query(True, description="Use smart recommendation system")
-):
-    """Get personalized menu recommendations"""
+# Concurrent identical /recommendations requests, coalesced before they take a lane slot
+_recommendation_flights = AsyncSingleFlight()
+
+
+def _cached_or_load(user_id: int, top: int, ctx: Context, query: str, include_explanation: bool,
+                    use_smart: bool) -> tuple:
+    """``(cached smart response, None, None)`` or ``(None, load_all data, cache generation token)``;
+    runs on the "db" lane"""
+    try:
+        generation = None
+        if use_smart:
+            recommender = get_smart_recommender()
+            cached = recommender.cached_recommendations(user_id, top, ctx, query, include_explanation)
+            if cached is not None:
+                return cached, None, None
+            generation = recommender.recommendation_cache.generation(user_id)
+        return None, load_all(user_id=user_id), generation
+    except Exception as e:
+        logger.error(f"Error loading data for recommendations: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def _recommend(user_id: int, top: int, ctx: Context, query: str, include_explanation: bool, use_smart: bool,
+               data: tuple, generation: tuple, now: pd.Timestamp) -> dict:
+    """Score already loaded data; runs on the "cpu" lane"""
     try:
-        now = pd.Timestamp.now()
-        ctx = Context(user_id=user_id, now=now, time_of_day=time, budget_level=budget)
-        
         if use_smart:
             recommender = get_smart_recommender()
             result = recommender.get_recommendations(
                 user_id=user_id,
                 top_k=top,
                 context=ctx,
-                user_query=query if query is not None else "",
-                include_explanation=include_explanation
+                user_query=query,
+                include_explanation=include_explanation,
+                data=data,
+                lookup_cache=False,
+                generation=generation
             )
             return clean(result)
         else:
-            df = base_recommend(user_id, top_k=top, ctx=ctx)
+            df = base_recommend(user_id, top_k=top, ctx=ctx, data=data)
             records = df.apply(convert_numpy).to_dict(orient="records")
             return clean({
                 "recommendations": records,
@@ -81,7 +115,233 @@ def get_recommendations(
         raise HTTPException(status_code=500, detail=str(e))
 
 
+@app.get("/recommendations")
+async def get_recommendations(
+    user_id: int, 
+    time: str | None = Query(None), 
+    budget: str | None = Query(None), 
+    top: int = 10,
+    query: str | None = Query(None, description="Natural language query for recommendations"),
+    include_explanation: bool = Query(False, description="Include AI-generated explanation"),
+    use_smart: bool = Query(True, description="Use smart recommendation system")
+):
+    """Get personalized menu recommendations
+
+    The cache lookup and data loading run on the "db" lane; only a cache
+    miss goes on to be scored on the "cpu" lane. Concurrent identical
+    requests share one pass through both lanes.
+    """
+    now = pd.Timestamp.now()
+    ctx = Context(user_id=user_id, now=now, time_of_day=time, budget_level=budget).ensure()
+    query = query if query is not None else ""
+    key = (user_id, top, ctx.time_of_day, ctx.budget_level, query.strip().lower(), include_explanation, use_smart)
+
+    async def compute():
+        cached, data, generation = await get_lane("db").run(_cached_or_load, user_id, top, ctx, query,
+                                                            include_explanation, use_smart)
+        if cached is not None:
+            return clean(cached)
+        return await get_lane("cpu").run(_recommend, user_id, top, ctx, query, include_explanation, use_smart,
+                                         data, generation, now)
+
+    result, shared = await _recommendation_flights.do(key, compute)
+    if shared:
+        result = dict(result, metadata=dict(result["metadata"], coalesced=True))
+    return result
+
+
+class BatchRecommendationRequest(BaseModel):
+    user_id: int
+    time: str | None = None
+    budget: str | None = None
+    top: int = 10
+
+
+class BatchRecommendationsBody(BaseModel):
+    requests: list[BatchRecommendationRequest]
+    query: str | None = None
+    include_explanation: bool = False
+    use_smart: bool = True
+
+
+def _batch_cached_or_load(body: BatchRecommendationsBody, now: pd.Timestamp) -> tuple:
+    """Validate the requests, answer those with a cached smart response and load the data the
+    rest need; runs on the "db" lane. Returns ``(results, pending requests, data)``, each pending
+    request as ``(index, entry, context, cache generation token)``.
+    """
+    results = [None] * len(body.requests)
+    valid = []
+    for i, entry in enumerate(body.requests):
+        if entry.user_id <= 0:
+            results[i] = {"user_id": entry.user_id, "error": "user_id must be positive"}
+        elif entry.top < 1:
+            results[i] = {"user_id": entry.user_id, "error": "top must be at least 1"}
+        else:
+            ctx = Context(user_id=entry.user_id, now=now, time_of_day=entry.time, budget_level=entry.budget)
+            valid.append((i, entry, ctx.ensure(), None))
+    try:
+        if body.use_smart:
+            recommender = get_smart_recommender()
+            pending = []
+            for i, entry, ctx, _ in valid:
+                cached = recommender.cached_recommendations(entry.user_id, entry.top, ctx, body.query or "",
+                                                            body.include_explanation)
+                if cached is not None:
+                    results[i] = dict(cached, user_id=entry.user_id)
+                else:
+                    pending.append((i, entry, ctx, recommender.recommendation_cache.generation(entry.user_id)))
+            valid = pending
+        return results, valid, load_all() if valid else None
+    except Exception as e:
+        logger.error(f"Error loading data for batch recommendations: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+def _batch_recommend(body: BatchRecommendationsBody, results: list, valid: list, data: tuple,
+                     start: datetime, now: pd.Timestamp) -> dict:
+    """Score the pending requests from already loaded data; runs on the "cpu" lane"""
+    try:
+        if not valid:
+            responses = []
+        elif body.use_smart:
+            responses = get_smart_recommender().get_recommendations_batch(
+                [{"user_id": entry.user_id, "top_k": entry.top, "context": ctx, "generation": generation}
+                 for _, entry, ctx, generation in valid],
+                user_query=body.query or "",
+                include_explanation=body.include_explanation,
+                data=data,
+                lookup_cache=False,
+            )
+        else:
+            responses = []
+            frames = recommend_hybrid_batch([(entry.user_id, entry.top, ctx) for _, entry, ctx, _ in valid], data=data)
+            for (_, entry, ctx, _), df in zip(valid, frames):
+                if isinstance(df, Exception):
+                    responses.append({"error": str(df)})
+                    continue
+                responses.append({
+                    "recommendations": df.apply(convert_numpy).to_dict(orient="records"),
+                    "metadata": {
+                        "user_id": entry.user_id,
+                        "time_of_day": ctx.time_of_day,
+                        "budget_level": ctx.budget_level,
+                        "total_recommendations": len(df),
+                        "from_cache": False,
+                        "timestamp": now.isoformat()
+                    }
+                })
+        for (i, entry, _, _), response in zip(valid, responses):
+            results[i] = dict(response, user_id=entry.user_id)
+
+        failed = sum("error" in result for result in results)
+        return clean({
+            "results": results,
+            "metadata": {
+                "total_requests": len(results),
+                "succeeded": len(results) - failed,
+                "failed": failed,
+                "processing_time_seconds": (datetime.now() - start).total_seconds(),
+                "timestamp": now.isoformat()
+            }
+        })
+    except Exception as e:
+        logger.error(f"Error generating batch recommendations: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
+@app.post("/recommendations/batch")
+async def get_recommendations_batch(body: BatchRecommendationsBody):
+    """Recommendations for many users in one call; per-user failures are reported inline
+
+    Cached responses and data loading come from the "db" lane, scoring of
+    the rest from the "cpu" lane.
+    """
+    max_users = recommender_setting('API_BATCH_MAX_USERS', 5000)
+    if len(body.requests) > max_users:
+        raise HTTPException(status_code=413, detail=f"At most {max_users} requests per batch")
+    start = datetime.now()
+    now = pd.Timestamp.now()
+    results, valid, data = await get_lane("db").run(_batch_cached_or_load, body, now)
+    return await get_lane("cpu").run(_batch_recommend, body, results, valid, data, start, now)
+
+
+_export_slots = threading.BoundedSemaphore(recommender_setting('API_EXPORT_MAX_CONCURRENT', 1))
+
+
+@app.get("/export/recommendations")
+async def export_recommendations(
+    top: int = Query(10, ge=1, le=100),
+    after: int | None = Query(None, description="Resume after this user_id (the last one received)"),
+    chunk: int | None = Query(None, ge=1, le=10000, description="Users scored per chunk"),
+    time: str | None = Query(None),
+    budget: str | None = Query(None),
+):
+    """Top-K recommendations of every user as NDJSON, streamed chunk by chunk in user_id order
+
+    Each chunk is loaded on the "db" lane and scored on the "cpu" lane, as
+    ``src.export.iter_chunks`` would; once streaming, a saturated lane is
+    waited out rather than cutting the response short.
+    """
+    if not _export_slots.acquire(blocking=False):
+        raise Overloaded("export", recommender_setting('API_RETRY_AFTER_SECONDS', 1))
+    released = threading.Event()
+    chunk_size = chunk or recommender_setting('EXPORT_CHUNK_SIZE', 1000)
+    now = pd.Timestamp.now()
+
+    def release():
+        if not released.is_set():
+            released.set()
+            _export_slots.release()
+
+    def score(users, items, orders):
+        user_ids, results = score_chunk(users, items, orders, top, now, time, budget)
+        return user_ids, ndjson_chunk(user_ids, results)
+
+    async def stream():
+        try:
+            cursor = after
+            items = await run_patiently("db", load_items)
+            while True:
+                users, orders = await run_patiently("db", load_user_chunk, cursor, chunk_size, items)
+                if users.empty:
+                    return
+                user_ids, text = await run_patiently("cpu", score, users, items, orders)
+                yield text
+                cursor = user_ids[-1]
+                if len(user_ids) < chunk_size:
+                    return
+        except Exception as e:
+            logger.error(f"Error exporting recommendations: {e}")
+            raise
+        finally:
+            release()
+
+    body = stream()
+    # A stream dropped before its first chunk never runs the finally above
+    weakref.finalize(body, release)
+    return StreamingResponse(body, media_type="application/x-ndjson")
+
+
+@app.get("/items/{item_id}/similar")
+@offload("cpu")
+def get_similar_items(item_id: int, k: int = Query(10, ge=1, le=100)):
+    """Items most similar to ``item_id`` under the configured CF source"""
+    try:
+        similar = similar_items(item_id, k)
+    except Exception as e:
+        logger.error(f"Error finding items similar to {item_id}: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    if similar is None:
+        raise HTTPException(status_code=404, detail=f"Item {item_id} not found")
+    return clean({
+        "item_id": item_id,
+        "source": recommender_setting('CF_SOURCE', 'item_cf'),
+        "similar": [{"item_id": int(i), "similarity": float(s)} for i, s in similar.items()],
+    })
+
+
 @app.get("/notifications")
+@offload("db")
 def get_notifications(user_id: int):
     """Get personalized notifications for user"""
     try:
@@ -92,6 +352,7 @@ def get_notifications(user_id: int):
 
 
 @app.post("/feedback")
+@offload("db")
 def record_feedback(
     user_id: int,
     item_id: int,
@@ -110,17 +371,25 @@ def record_feedback(
 
 
 @app.get("/metrics")
+@offload("db")
 def get_system_metrics():
     """Get system performance metrics"""
     try:
         recommender = get_smart_recommender()
-        return clean(recommender.get_system_stats())
+        stats = recommender.get_system_stats()
+        stats['db_pool'] = get_pool_stats()
+        stats['executors'] = lane_stats()
+        stats['api_coalescing'] = _recommendation_flights.stats()
+        if recommender_setting('ORDER_SNAPSHOT', False):
+            stats['order_snapshot'] = get_order_snapshot().stats()
+        return clean(stats)
     except Exception as e:
         logger.error(f"Error getting metrics: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.get("/query-analysis")
+@offload("cpu")
 def analyze_query(query: str):
     """Analyze natural language query"""
     try:
@@ -133,7 +402,7 @@ def analyze_query(query: str):
 
 
 @app.get("/health")
-def health_check():
+async def health_check():
     """Health check endpoint"""
     return clean({
         "status": "healthy",
@@ -143,6 +412,7 @@ def health_check():
 
 
 @app.get("/sampledata")
+@offload("db")
 def sample_data():
     """Get sample data for testing"""
     try:
@@ -165,6 +435,7 @@ def sample_data():
 # Add this debug endpoint to your API to trace the issue
 
 @app.get("/debug/recommendations/{user_id}")
+@offload("db")
 def debug_recommendations(user_id: int):
     """Debug endpoint to trace recommendation generation"""
     debug_info = {
@@ -304,6 +575,7 @@ def debug_recommendations(user_id: int):
 
 
 @app.get("/debug/database")
+@offload("db")
 def debug_database():
     """Debug database tables and data"""
     debug_info = {
@@ -390,7 +662,22 @@ def debug_database():
     return debug_info
 
 
+@app.get("/debug/memory")
+@offload("cpu")
+def debug_memory():
+    """Memory held by the order-line frame against its compact representation"""
+    try:
+        orders = load_orders()
+        report = memory_report(orders)
+        report['source'] = 'order_snapshot' if recommender_setting('ORDER_SNAPSHOT', False) else 'database'
+        return clean(report)
+    except Exception as e:
+        logger.error(f"Error building memory report: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @app.get("/debug/context/{user_id}")
+@offload("db")
 def debug_context(user_id: int, time: str = None, budget: str = None):
     """Debug context creation"""
     debug_info = {
@@ -0,0 +1,163 @@
+"""
+Bounded thread-pool offload for the async API routes
+
+Blocking work runs on one of two lanes, each a sized ``ThreadPoolExecutor``
+with its own admission limit:
+
+* ``"cpu"``: scoring (recommendations, similar items, query analysis).
+* ``"db"``: database loading, including the loading step of the
+  recommendation and export routes, and routes dominated by it (sample
+  data, notifications, feedback, metrics, debugging).
+
+A lane admits at most ``workers + queue`` requests. Beyond that it sheds the
+request with :class:`Overloaded`, which the API turns into a 503 carrying a
+``Retry-After`` estimated from the lane's backlog and recent service time.
+Long streams use :func:`run_patiently` instead, which waits for room.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from src.data_loader import recommender_setting
+
+
+class Overloaded(Exception):
+    """A lane is at its admission limit"""
+
+    def __init__(self, lane: str, retry_after: int):
+        super().__init__(f"{lane} lane saturated, retry after {retry_after}s")
+        self.lane = lane
+        self.retry_after = retry_after
+
+
+class Lane:
+    """A sized executor that sheds requests past ``workers + queue`` in flight"""
+
+    def __init__(self, name: str, workers: int, queue: int):
+        self.name = name
+        self.workers = max(1, int(workers))
+        self.queue = max(0, int(queue))
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=f'api-{name}')
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.completed = 0
+        self.shed = 0
+        self.avg_service_seconds = 0.0  # exponentially weighted
+
+    def retry_after(self) -> int:
+        """Seconds until the current backlog should have drained"""
+        waves = math.ceil(self.in_flight / self.workers)
+        minimum = recommender_setting('API_RETRY_AFTER_SECONDS', 1)
+        return max(minimum, math.ceil(waves * self.avg_service_seconds))
+
+    def _admit(self):
+        with self._lock:
+            if self.in_flight >= self.workers + self.queue:
+                self.shed += 1
+                raise Overloaded(self.name, self.retry_after())
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def _release(self, future):
+        with self._lock:
+            self.in_flight -= 1
+
+    def _timed(self, fn, args, kwargs):
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.completed += 1
+                self.avg_service_seconds += 0.1 * (elapsed - self.avg_service_seconds)
+
+    async def run(self, fn, *args, **kwargs):
+        """Run ``fn(*args, **kwargs)`` on the lane, or raise Overloaded"""
+        self._admit()
+        try:
+            future = self.executor.submit(self._timed, fn, args, kwargs)
+        except BaseException:
+            self._release(None)
+            raise
+        # Released when the work finishes, not when the caller stops waiting,
+        # so abandoned requests still count against the lane
+        future.add_done_callback(self._release)
+        return await asyncio.wrap_future(future)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queue_limit': self.queue,
+                'in_flight': self.in_flight,
+                'queued': max(0, self.in_flight - self.workers),
+                'max_in_flight': self.max_in_flight,
+                'completed': self.completed,
+                'shed': self.shed,
+                'avg_service_ms': 1000 * self.avg_service_seconds,
+            }
+
+
+_lanes = {}
+_lanes_lock = threading.Lock()
+
+
+def _lane_config(name: str) -> tuple:
+    if name == 'cpu':
+        workers = recommender_setting('API_CPU_WORKERS') or os.cpu_count() or 1
+        return workers, recommender_setting('API_CPU_QUEUE', 64)
+    if name == 'db':
+        workers = recommender_setting('API_DB_WORKERS') or recommender_setting('DB_POOL_SIZE', 5)
+        return workers, recommender_setting('API_DB_QUEUE', 32)
+    raise ValueError(f"Unknown lane: {name}")
+
+
+def get_lane(name: str) -> Lane:
+    """Process-wide lane, created on first use (after any worker fork)"""
+    lane = _lanes.get(name)
+    if lane is None:
+        with _lanes_lock:
+            lane = _lanes.get(name)
+            if lane is None:
+                lane = _lanes[name] = Lane(name, *_lane_config(name))
+    return lane
+
+
+def lane_stats() -> dict:
+    return {name: lane.stats() for name, lane in list(_lanes.items())}
+
+
+async def run_patiently(lane_name: str, fn, *args, **kwargs):
+    """Run on ``lane_name`` like :meth:`Lane.run`, but wait out saturation instead of raising.
+
+    For work that has already started answering (a streamed export), where a
+    503 is no longer possible.
+    """
+    while True:
+        try:
+            return await get_lane(lane_name).run(fn, *args, **kwargs)
+        except Overloaded as e:
+            await asyncio.sleep(e.retry_after)
+
+
+def offload(lane_name: str):
+    """Turn a blocking route function into an async one that runs on ``lane_name``.
+
+    The wrapper keeps the function's signature, so FastAPI reads the same
+    parameters from it.
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def endpoint(*args, **kwargs):
+            return await get_lane(lane_name).run(fn, *args, **kwargs)
+        return endpoint
+    return decorator
@@ -0,0 +1,221 @@
+"""
+Micro-benchmarks for the recommendation data path
+
+Usage:
+    python -m src.benchmark orders --sizes 10000 100000 1000000
+    python -m src.benchmark memory --sizes 100000 1000000
+    python -m src.benchmark score --items 50 500 5000
+    python -m src.benchmark cf --users 1000 20000 --items 2000
+    python -m src.benchmark ann --items 10000 100000 --probes 1 4 16
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.compact_orders import memory_report
+from src.data_loader import explode_order_items
+
+
+def synthetic_orders(n_orders: int, n_users: int = 5000, n_items: int = 200, seed: int = 42) -> pd.DataFrame:
+    """Build raw ``slice_order`` rows shaped like the ``load_orders`` query result"""
+    rng = np.random.default_rng(seed)
+    lines_per_order = rng.integers(1, 5, n_orders)
+    item_ids = rng.integers(1, n_items + 1, lines_per_order.sum())
+    qtys = rng.integers(1, 4, lines_per_order.sum())
+
+    items_json = []
+    pos = 0
+    for n in lines_per_order:
+        items_json.append(json.dumps([
+            {
+                'itemId': int(item_ids[pos + j]), 'name': 'Item', 'qty': int(qtys[pos + j]),
+                'size': 'M', 'price': 700.0, 'addedIngredients': [], 'removedIngredients': []
+            }
+            for j in range(n)
+        ]))
+        pos += n
+
+    return pd.DataFrame({
+        'order_id': np.arange(1, n_orders + 1),
+        'store_id': rng.integers(1, 4, n_orders),
+        'user_id': rng.integers(1, n_users + 1, n_orders),
+        'timestamp': pd.Timestamp.now(tz='UTC') - pd.to_timedelta(rng.integers(0, 90 * 24 * 60, n_orders), unit='m'),
+        'pickup_type': 'Delivery',
+        'status': 'COMPLETED',
+        'total_amount': 700.0 * lines_per_order,
+        'items_json': items_json,
+    })
+
+
+def synthetic_items(n_items: int, seed: int = 42) -> pd.DataFrame:
+    """Build a ``load_items``-shaped menu"""
+    rng = np.random.default_rng(seed)
+    tags = [[], ['vegetarian'], ['meat'], ['vegetarian', 'dairy']]
+    price = rng.choice([500.0, 900.0, 1500.0, 2500.0, 3500.0], n_items)
+    return pd.DataFrame({
+        'item_id': np.arange(1, n_items + 1),
+        'name': [f"Item {i}" for i in range(1, n_items + 1)],
+        'category': rng.choice(['pizza', 'pasta', 'salad', 'dessert', 'cold drink', 'hot drink'], n_items),
+        'price': price,
+        'dietary_tags': [tags[i] for i in rng.integers(0, len(tags), n_items)],
+        'time_preference': rng.choice(['morning', 'lunch', 'dinner', 'any'], n_items),
+        'budget_category': np.where(price < 1000, 'low', np.where(price > 3000, 'high', 'mid')),
+    })
+
+
+def _timed(fn, *args, repeat: int = 1, **kwargs) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def bench_orders(sizes, repeat: int = 1):
+    print(f"{'orders':>10} {'lines':>10} {'explode (s)':>12} {'lines/s':>12}")
+    for n in sizes:
+        raw = synthetic_orders(n)
+        lines = explode_order_items(raw)
+        elapsed = _timed(explode_order_items, raw, repeat=repeat)
+        print(f"{n:>10} {len(lines):>10} {elapsed:>12.3f} {len(lines) / elapsed:>12.0f}")
+
+
+def bench_memory(sizes):
+    print(f"{'orders':>10} {'lines':>10} {'frame MB':>10} {'compact MB':>11} {'ratio':>7} {'build (s)':>10}")
+    for n in sizes:
+        report = memory_report(explode_order_items(synthetic_orders(n)))
+        print(f"{n:>10} {report['lines']:>10} {report['frame_bytes'] / 2**20:>10.1f} "
+              f"{report['compact_bytes'] / 2**20:>11.1f} {report['ratio']:>7} {report['build_seconds']:>10.3f}")
+
+
+def bench_score(item_counts, n_orders: int = 20_000, repeat: int = 20):
+    from src.core.contextual import Context
+    from src.core.features import ItemFeatures
+    from src.core.hybrid import score_items
+
+    users = pd.DataFrame({
+        'user_id': [1], 'diet': ['vegetarian'], 'budget_sensitivity': ['medium'],
+        'favorite_categories': [['italian']], 'allergies': [['dairy']], 'time_preferences': [[]],
+    })
+    ctx = Context(user_id=1, now=pd.Timestamp.now(tz='UTC'))
+    print(f"{'items':>8} {'score_items (ms)':>17} {'with features (ms)':>19}")
+    for n in item_counts:
+        items = synthetic_items(n)
+        orders = explode_order_items(synthetic_orders(n_orders, n_users=500, n_items=n))
+        features = ItemFeatures(items)
+        cold = _timed(score_items, 1, ctx, users, items, orders, repeat=repeat)
+        warm = _timed(score_items, 1, ctx, users, items, orders, features=features, repeat=repeat)
+        print(f"{n:>8} {cold * 1000:>17.2f} {warm * 1000:>19.2f}")
+
+
+def bench_cf(user_counts, n_items: int, orders_per_user: int = 5, repeat: int = 3):
+    from src.core.collaborative import SparseUserItemMatrix, item_similarity, user_item_matrix
+
+    print(f"{'users':>8} {'items':>6} {'backend':>7} {'matrix (s)':>11} {'similarity (s)':>15} "
+          f"{'score (ms)':>11} {'MB':>8}")
+    for n_users in user_counts:
+        orders = explode_order_items(synthetic_orders(n_users * orders_per_user, n_users=n_users, n_items=n_items))
+        user_id = int(orders['user_id'].iloc[0])
+
+        start = time.perf_counter()
+        sparse_mat = SparseUserItemMatrix.from_orders(orders)
+        build = time.perf_counter() - start
+        sim = _timed(sparse_mat.similarity, repeat=1)
+        score = _timed(sparse_mat.scores_for_user, user_id, repeat=repeat)
+        nbytes = sum(m.data.nbytes + m.indices.nbytes + m.indptr.nbytes for m in (sparse_mat.matrix, sparse_mat.similarity()))
+        print(f"{n_users:>8} {n_items:>6} {'sparse':>7} {build:>11.3f} {sim:>15.3f} {score * 1000:>11.2f} {nbytes / 2**20:>8.1f}")
+
+        start = time.perf_counter()
+        dense = user_item_matrix(orders)
+        build = time.perf_counter() - start
+        start = time.perf_counter()
+        similarity, _, _ = item_similarity(dense)
+        sim = time.perf_counter() - start
+
+        def dense_score():
+            weights = dense.loc[user_id].values
+            return (similarity.values @ weights) - weights * 0.5
+
+        score = _timed(dense_score, repeat=repeat)
+        nbytes = dense.values.nbytes + similarity.values.nbytes
+        print(f"{n_users:>8} {n_items:>6} {'dense':>7} {build:>11.3f} {sim:>15.3f} {score * 1000:>11.2f} {nbytes / 2**20:>8.1f}")
+
+
+def synthetic_vectors(n_items: int, factors: int = 32, clusters: int = 100, seed: int = 42) -> np.ndarray:
+    """Clustered item vectors, shaped like trained item factors"""
+    rng = np.random.default_rng(seed)
+    centres = rng.standard_normal((clusters, factors))
+    vectors = centres[rng.integers(0, clusters, n_items)] + 0.5 * rng.standard_normal((n_items, factors))
+    return vectors.astype(np.float32)
+
+
+def bench_ann(item_counts, probes, k: int = 10, queries: int = 200):
+    from src.core.ann import IVFIndex, _top, _unit
+
+    print(f"{'items':>8} {'lists':>6} {'probes':>6} {'build (s)':>10} {'query (ms)':>11} {f'recall@{k}':>10}")
+    for n in item_counts:
+        vectors = synthetic_vectors(n)
+        ids = np.arange(n)
+        start = time.perf_counter()
+        index = IVFIndex('cosine').build(ids, vectors)
+        build = time.perf_counter() - start
+        unit = _unit(vectors)
+        sample = np.random.default_rng(0).choice(n, min(queries, n), replace=False)
+        exact = [set(_top(unit @ unit[q], k).tolist()) for q in sample]
+
+        brute = _timed(lambda: [_top(unit @ unit[q], k) for q in sample]) / len(sample)
+        print(f"{n:>8} {'-':>6} {'all':>6} {'-':>10} {brute * 1000:>11.3f} {1.0:>10.3f}")
+        for n_probe in probes:
+            start = time.perf_counter()
+            found = [index.query(vectors[q], k, n_probe=n_probe)[0] for q in sample]
+            latency = (time.perf_counter() - start) / len(sample)
+            recall = np.mean([len(exact[i] & set(f.tolist())) / k for i, f in enumerate(found)])
+            print(f"{n:>8} {len(index.centroids):>6} {n_probe:>6} {build:>10.3f} {latency * 1000:>11.3f} {recall:>10.3f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Smart Menu - recommender benchmarks")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    orders = sub.add_parser("orders", help="Order-line explosion time against order count")
+    orders.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    orders.add_argument("--repeat", type=int, default=1)
+
+    memory = sub.add_parser("memory", help="Order-line frame memory against the compact representation")
+    memory.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000])
+
+    score = sub.add_parser("score", help="score_items latency against menu size")
+    score.add_argument("--items", type=int, nargs="+", default=[50, 500, 5000])
+    score.add_argument("--orders", type=int, default=20_000)
+    score.add_argument("--repeat", type=int, default=20)
+
+    cf = sub.add_parser("cf", help="Sparse against dense collaborative-filtering matrices")
+    cf.add_argument("--users", type=int, nargs="+", default=[1_000, 20_000])
+    cf.add_argument("--items", type=int, default=2_000)
+    cf.add_argument("--orders-per-user", type=int, default=5)
+
+    ann = sub.add_parser("ann", help="Item ANN index recall against query latency")
+    ann.add_argument("--items", type=int, nargs="+", default=[10_000, 100_000])
+    ann.add_argument("--probes", type=int, nargs="+", default=[1, 4, 16])
+    ann.add_argument("-k", type=int, default=10)
+
+    args = parser.parse_args()
+    if args.bench == "orders":
+        bench_orders(args.sizes, args.repeat)
+    elif args.bench == "memory":
+        bench_memory(args.sizes)
+    elif args.bench == "score":
+        bench_score(args.items, args.orders, args.repeat)
+    elif args.bench == "cf":
+        bench_cf(args.users, args.items, args.orders_per_user)
+    elif args.bench == "ann":
+        bench_ann(args.items, args.probes, args.k)
+
+
+if __name__ == "__main__":
+    main()
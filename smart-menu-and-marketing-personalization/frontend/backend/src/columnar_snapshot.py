@@ -0,0 +1,334 @@
+"""
+Columnar on-disk snapshot of the parsed users, items and order-line frames
+
+A snapshot is a directory of Arrow IPC files (one per frame) plus a
+``meta.json``. Publishing writes a new version directory and then atomically
+repoints the ``CURRENT`` file, so readers never see a half-written snapshot.
+Workers memory-map the files, so several processes on one host share a
+single read-only page-cache copy and a cold start skips the database.
+
+A snapshot only seeds readers; it is never the source of truth for long.
+The order-line frame seeds the order snapshot, which then catches up from
+its watermark. Users and items have no change watermark, so
+:func:`fresh_columnar_snapshot` hands the snapshot out only while it is
+younger than ``COLUMNAR_SNAPSHOT_MAX_AGE_SECONDS``, and readers fall back to
+the database after that.
+
+Usage:
+    python -m src.columnar_snapshot publish [--dir PATH] [--keep 3]
+    python -m src.columnar_snapshot info [--dir PATH]
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import shutil
+import threading
+import time
+import logging
+from pathlib import Path
+from typing import Optional
+
+import pandas as pd
+
+from src.data_loader import recommender_setting
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_FORMAT_VERSION = 1
+FRAMES = ('users', 'items', 'orders')
+CURRENT_FILE = 'CURRENT'
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc  # noqa: F401
+    except ImportError as e:
+        raise ImportError("Columnar snapshots need pyarrow (pip install pyarrow)") from e
+    return pa
+
+
+def default_snapshot_dir() -> Optional[Path]:
+    path = recommender_setting('COLUMNAR_SNAPSHOT_DIR')
+    return Path(path) if path else None
+
+
+# ----------------------------------------------------------------------
+# Encoding
+# ----------------------------------------------------------------------
+def _to_table(frame: pd.DataFrame):
+    """Convert a frame to an Arrow table, recording how object columns were stored.
+
+    List columns (ingredients, dietary tags, ...) become Arrow lists; anything
+    Arrow cannot type (dicts, mixed values) is stored as JSON text.
+    """
+    pa = _require_pyarrow()
+    list_columns, json_columns = [], []
+    arrays, names = [], []
+    for col in frame.columns:
+        values = frame[col]
+        if values.dtype == object:
+            if values.map(lambda v: isinstance(v, list)).all():
+                try:
+                    arrays.append(pa.array(values.tolist()))
+                    names.append(col)
+                    list_columns.append(col)
+                    continue
+                except (pa.ArrowInvalid, pa.ArrowTypeError):
+                    pass
+            try:
+                arrays.append(pa.array(values.tolist()))
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                arrays.append(pa.array([json.dumps(v, default=str) for v in values], type=pa.string()))
+                json_columns.append(col)
+            names.append(col)
+        else:
+            arrays.append(pa.Array.from_pandas(values))
+            names.append(col)
+    return pa.Table.from_arrays(arrays, names=names), list_columns, json_columns
+
+
+def _list_values(column) -> list:
+    """Python lists for a list column, sliced from its offsets (much faster than to_pylist)"""
+    column = column.combine_chunks()
+    if column.null_count:
+        return [v if v is not None else [] for v in column.to_pylist()]
+    offsets = column.offsets.to_numpy()
+    values = column.values.to_numpy(zero_copy_only=False).tolist()
+    return [values[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def _from_table(table, list_columns, json_columns) -> pd.DataFrame:
+    """Rebuild a frame; fixed-width columns stay backed by the memory map"""
+    plain = [c for c in table.column_names if c not in list_columns and c not in json_columns]
+    frame = table.select(plain).to_pandas(split_blocks=True, self_destruct=False)
+    for col in list_columns:
+        frame[col] = pd.Series(_list_values(table.column(col)), dtype=object)
+    for col in json_columns:
+        frame[col] = pd.Series([json.loads(v) if v is not None else None for v in table.column(col).to_pylist()],
+                               dtype=object)
+    return frame[table.column_names]
+
+
+def _encode_watermark(value):
+    if value is None:
+        return None
+    if isinstance(value, pd.Timestamp) or hasattr(value, 'isoformat'):
+        return {'type': 'timestamp', 'value': pd.Timestamp(value).isoformat()}
+    return {'type': 'str', 'value': str(value)}
+
+
+def _decode_watermark(value):
+    if value is None:
+        return None
+    if value['type'] == 'timestamp':
+        return pd.Timestamp(value['value'])
+    return value['value']
+
+
+# ----------------------------------------------------------------------
+# Publish / load
+# ----------------------------------------------------------------------
+def publish_snapshot(users: pd.DataFrame, items: pd.DataFrame, orders: pd.DataFrame,
+                     root: Optional[Path] = None, watermark: Optional[dict] = None, keep: int = 3) -> Path:
+    """Write a new snapshot version and atomically make it current"""
+    pa = _require_pyarrow()
+    root = Path(root or default_snapshot_dir() or 'snapshots')
+    root.mkdir(parents=True, exist_ok=True)
+
+    # Sortable by name, which _prune relies on: UTC second, nanoseconds within it, then the pid
+    now = time.time_ns()
+    version = time.strftime('%Y%m%dT%H%M%S', time.gmtime(now // 10**9)) + f"-{now % 10**9:09d}-{os.getpid()}"
+    staging = root / f".{version}.tmp"
+    staging.mkdir()
+
+    meta = {
+        'format_version': SNAPSHOT_FORMAT_VERSION,
+        'version': version,
+        'created_at': pd.Timestamp.now(tz='UTC').isoformat(),
+        'frames': {},
+        'watermark': None,
+    }
+    if watermark:
+        meta['watermark'] = {
+            'created_at': _encode_watermark(watermark.get('created_at')),
+            'order_id': watermark.get('order_id'),
+            'updated_at': _encode_watermark(watermark.get('updated_at')),
+        }
+
+    for name, frame in zip(FRAMES, (users, items, orders)):
+        table, list_columns, json_columns = _to_table(frame.reset_index(drop=True))
+        # Uncompressed IPC so readers can memory-map without copying
+        with pa.OSFile(str(staging / f"{name}.arrow"), 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        meta['frames'][name] = {
+            'rows': len(frame),
+            'list_columns': list_columns,
+            'json_columns': json_columns,
+        }
+
+    with open(staging / 'meta.json', 'w') as f:
+        json.dump(meta, f, indent=2)
+
+    os.replace(staging, root / version)
+    pointer = root / f".{CURRENT_FILE}.{version}.tmp"
+    pointer.write_text(version)
+    os.replace(pointer, root / CURRENT_FILE)
+    logger.info(f"Published columnar snapshot {version} to {root}")
+
+    _prune(root, keep)
+    return root / version
+
+
+def _prune(root: Path, keep: int):
+    current = current_version(root)
+    versions = sorted(p for p in root.iterdir() if p.is_dir() and not p.name.startswith('.'))
+    for old in versions[:-keep] if keep > 0 else []:
+        if old.name != current:
+            shutil.rmtree(old, ignore_errors=True)
+
+
+def current_version(root: Optional[Path] = None) -> Optional[str]:
+    root = Path(root or default_snapshot_dir() or 'snapshots')
+    try:
+        return (root / CURRENT_FILE).read_text().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+class ColumnarSnapshot:
+    """One loaded snapshot version: memory-mapped frames plus metadata"""
+
+    def __init__(self, path: Path):
+        pa = _require_pyarrow()
+        self.path = Path(path)
+        with open(self.path / 'meta.json') as f:
+            self.meta = json.load(f)
+        if self.meta.get('format_version') != SNAPSHOT_FORMAT_VERSION:
+            raise ValueError(f"Unsupported snapshot format {self.meta.get('format_version')}")
+        self.version = self.meta['version']
+
+        self.frames = {}
+        for name in FRAMES:
+            info = self.meta['frames'][name]
+            source = pa.memory_map(str(self.path / f"{name}.arrow"), 'r')
+            table = pa.ipc.open_file(source).read_all()
+            self.frames[name] = _from_table(table, info['list_columns'], info['json_columns'])
+
+    @property
+    def age_seconds(self) -> float:
+        """Seconds since the snapshot was published"""
+        return (pd.Timestamp.now(tz='UTC') - pd.Timestamp(self.meta['created_at'])).total_seconds()
+
+    @property
+    def watermark(self) -> Optional[dict]:
+        raw = self.meta.get('watermark')
+        if not raw:
+            return None
+        return {
+            'created_at': _decode_watermark(raw['created_at']),
+            'order_id': raw['order_id'],
+            'updated_at': _decode_watermark(raw['updated_at']),
+        }
+
+    def users(self, user_id: Optional[int] = None) -> pd.DataFrame:
+        users = self.frames['users']
+        if user_id:
+            users = users.loc[users['user_id'] == user_id].reset_index(drop=True)
+        return users.copy()
+
+    def items(self, store_id: Optional[int] = None) -> pd.DataFrame:
+        items = self.frames['items']
+        if store_id:
+            items = items.loc[items['store_id'] == store_id].reset_index(drop=True)
+        return items.copy()
+
+    def orders(self, user_id: Optional[int] = None, store_id: Optional[int] = None) -> pd.DataFrame:
+        orders = self.frames['orders']
+        if user_id:
+            orders = orders.loc[orders['user_id'] == user_id]
+        if store_id:
+            orders = orders.loc[orders['store_id'] == store_id]
+        return orders.reset_index(drop=True)
+
+
+_loaded: Optional[ColumnarSnapshot] = None
+_loaded_lock = threading.Lock()
+_stale_logged: Optional[str] = None
+
+
+def get_columnar_snapshot(root: Optional[Path] = None) -> Optional[ColumnarSnapshot]:
+    """Current snapshot for this worker, swapping to a newly published version if any"""
+    global _loaded
+    root = root or default_snapshot_dir()
+    if root is None:
+        return None
+    version = current_version(root)
+    if version is None:
+        return None
+    if _loaded is not None and _loaded.version == version:
+        return _loaded
+    with _loaded_lock:
+        if _loaded is None or _loaded.version != version:
+            try:
+                start = time.perf_counter()
+                _loaded = ColumnarSnapshot(Path(root) / version)
+                logger.info(f"Loaded columnar snapshot {version} in {time.perf_counter() - start:.3f}s")
+            except Exception as e:
+                logger.error(f"Could not load columnar snapshot {version}: {e}")
+                return _loaded
+    return _loaded
+
+
+def build_and_publish(root: Optional[Path] = None, keep: int = 3) -> Path:
+    """Load everything from the database and publish it as a new snapshot"""
+    from src.data_loader import load_users, load_items
+    from src.order_snapshot import OrderSnapshot
+
+    orders = OrderSnapshot(refresh_interval=0, full_reload_interval=0)
+    lines = orders.refresh()
+    return publish_snapshot(load_users(), load_items(), lines, root=root,
+                            watermark=orders.watermark(), keep=keep)
+
+
+def fresh_columnar_snapshot(root: Optional[Path] = None) -> Optional[ColumnarSnapshot]:
+    """The current snapshot while it is younger than ``COLUMNAR_SNAPSHOT_MAX_AGE_SECONDS``, else None"""
+    global _stale_logged
+    snapshot = get_columnar_snapshot(root)
+    if snapshot is None:
+        return None
+    max_age = recommender_setting('COLUMNAR_SNAPSHOT_MAX_AGE_SECONDS', 300)
+    if max_age is not None and snapshot.age_seconds > max_age:
+        if _stale_logged != snapshot.version:
+            _stale_logged = snapshot.version
+            logger.warning(f"Columnar snapshot {snapshot.version} is older than {max_age}s; "
+                           f"reading users and items from the database")
+        return None
+    return snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Smart Menu - columnar data snapshots")
+    parser.add_argument("command", choices=["publish", "info"])
+    parser.add_argument("--dir", type=str, default=None, help="Snapshot root (default: RECOMMENDER['COLUMNAR_SNAPSHOT_DIR'])")
+    parser.add_argument("--keep", type=int, default=3, help="Versions to keep when publishing")
+    args = parser.parse_args()
+
+    root = Path(args.dir) if args.dir else default_snapshot_dir()
+    if args.command == "publish":
+        path = build_and_publish(root, keep=args.keep)
+        print(f"Published {path}")
+    else:
+        snapshot = get_columnar_snapshot(root or Path('snapshots'))
+        if snapshot is None:
+            print("No snapshot published")
+            return
+        print(json.dumps(snapshot.meta, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+"""
+Compact in-memory representation of the order-line frame
+
+``load_orders`` returns one wide row per order line, with Python strings for
+the low-cardinality columns, int64 ids, a list object per ingredient cell and
+the order-level fields (user, store, time, total, status) repeated on every
+line. :class:`CompactOrderLines` keeps the same data as:
+
+* an orders table (one row per order) with int32 ids, int64 epoch-ns
+  timestamps, float32 totals and categorical status/pickup/time-of-day
+* a lines table pointing at its order by position, with int32 item ids,
+  float32 prices and categorical names/sizes
+* ingredient lists as int32 codes into one shared vocabulary plus
+  per-line offsets, for both added and removed ingredients (null entries
+  have their own vocabulary entry and come back as None)
+
+:meth:`CompactOrderLines.to_frame` restores the wide layout, except that
+timestamps always come back as UTC ``datetime64`` values, whatever
+``load_orders`` returned (SQLite hands back ISO strings). Consumers go
+through ``parse_timestamps``, which accepts both.
+
+Nothing is served from this layout yet: the order snapshot still keeps the
+wide frame. It is used by :func:`memory_report` (``GET /debug/memory``,
+``python -m src.benchmark memory``) to measure what switching would save.
+"""
+
+from __future__ import annotations
+
+import json
+import sys
+import time
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+
+from src.data_loader import ORDER_LINE_COLUMNS, parse_timestamps
+
+_INT32_MAX = np.iinfo(np.int32).max
+
+
+def _compact_ints(values) -> np.ndarray:
+    """int32 when every value fits, int64 otherwise"""
+    values = np.asarray(values, dtype=np.int64)
+    if len(values) == 0 or (values.min() >= -_INT32_MAX and values.max() <= _INT32_MAX):
+        return values.astype(np.int32)
+    return values
+
+
+def _epoch_ns(timestamps: pd.Series) -> np.ndarray:
+    """UTC epoch nanoseconds; naive timestamps are taken to be UTC (USE_TZ)"""
+    parsed = parse_timestamps(timestamps)
+    if parsed.dt.tz is None:
+        parsed = parsed.dt.tz_localize('UTC')
+    else:
+        parsed = parsed.dt.tz_convert('UTC')
+    return parsed.to_numpy(dtype='datetime64[ns]').view(np.int64)
+
+
+def _hashable(value):
+    return json.dumps(value, default=str) if isinstance(value, (dict, list)) else value
+
+
+def _pack_lists(values: pd.Series):
+    """Offsets and the flattened values of a column of lists"""
+    lists = [v if isinstance(v, list) else [] for v in values]
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    np.cumsum([len(v) for v in lists], out=offsets[1:])
+    return offsets, [_hashable(v) for v in chain.from_iterable(lists)]
+
+
+class CompactOrderLines:
+    """Order lines stored as typed, normalized columns (see the module docstring)"""
+
+    def __init__(self, orders: pd.DataFrame, lines: pd.DataFrame, ingredients: pd.Index,
+                 added_codes: np.ndarray, added_offsets: np.ndarray,
+                 removed_codes: np.ndarray, removed_offsets: np.ndarray):
+        self.orders = orders
+        self.lines = lines
+        self.ingredients = ingredients
+        self.added_codes = added_codes
+        self.added_offsets = added_offsets
+        self.removed_codes = removed_codes
+        self.removed_offsets = removed_offsets
+
+    @classmethod
+    def from_frame(cls, frame: pd.DataFrame) -> 'CompactOrderLines':
+        """Build from a ``load_orders`` frame"""
+        frame = frame.reindex(columns=ORDER_LINE_COLUMNS).reset_index(drop=True)
+
+        order_pos, _ = pd.factorize(frame['order_id'], sort=False)
+        _, first = np.unique(order_pos, return_index=True)
+        heads = frame.take(first)
+
+        orders = pd.DataFrame({
+            'order_id': _compact_ints(heads['order_id']),
+            'user_id': _compact_ints(heads['user_id']),
+            'store_id': _compact_ints(heads['store_id']),
+            'timestamp': _epoch_ns(heads['timestamp']) if len(heads) else np.empty(0, dtype=np.int64),
+            'total_amount': pd.to_numeric(heads['total_amount'], errors='coerce').to_numpy(dtype=np.float32),
+        })
+        for col in ('pickup_type', 'status', 'time_of_day'):
+            orders[col] = pd.Categorical(heads[col].to_numpy())
+
+        lines = pd.DataFrame({
+            'order': order_pos.astype(np.int32),
+            'item_id': _compact_ints(frame['item_id']),
+            'item_name': pd.Categorical(frame['item_name'].map(_hashable)),
+            'quantity': _compact_ints(frame['quantity']),
+            'size': pd.Categorical(frame['size'].to_numpy()),
+            'price': pd.to_numeric(frame['price'], errors='coerce').to_numpy(dtype=np.float32),
+        })
+
+        added_offsets, added = _pack_lists(frame['added_ingredients'])
+        removed_offsets, removed = _pack_lists(frame['removed_ingredients'])
+        # Null ingredients get a code of their own instead of the -1 sentinel
+        codes, ingredients = pd.factorize(pd.Series(added + removed, dtype=object), sort=True,
+                                          use_na_sentinel=False)
+        codes = codes.astype(np.int32)
+        return cls(orders, lines, pd.Index(ingredients, dtype=object),
+                   codes[:len(added)], added_offsets, codes[len(added):], removed_offsets)
+
+    def __len__(self) -> int:
+        return len(self.lines)
+
+    # ------------------------------------------------------------------
+    # Reads
+    # ------------------------------------------------------------------
+    def modification_counts(self) -> np.ndarray:
+        """Added plus removed ingredients per line, without building any lists"""
+        return np.diff(self.added_offsets) + np.diff(self.removed_offsets)
+
+    def ingredient_lists(self, which: str = 'added') -> list:
+        """Ingredient lists per line; ``which`` is ``'added'`` or ``'removed'``"""
+        codes, offsets = (
+            (self.added_codes, self.added_offsets) if which == 'added'
+            else (self.removed_codes, self.removed_offsets)
+        )
+        vocabulary = self.ingredients.to_numpy(dtype=object).copy()
+        vocabulary[pd.isna(vocabulary)] = None
+        values = vocabulary[codes].tolist()
+        return [values[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+    def to_frame(self) -> pd.DataFrame:
+        """Expand back to the ``load_orders`` layout (timestamps as tz-aware UTC datetimes, not strings)"""
+        if not len(self.lines):
+            return pd.DataFrame(columns=ORDER_LINE_COLUMNS)
+        heads = self.orders.take(self.lines['order'].to_numpy())
+        frame = pd.DataFrame({
+            'order_id': heads['order_id'].to_numpy(np.int64),
+            'user_id': heads['user_id'].to_numpy(np.int64),
+            'store_id': heads['store_id'].to_numpy(np.int64),
+            'timestamp': pd.to_datetime(heads['timestamp'].to_numpy(), utc=True),
+            'item_id': self.lines['item_id'].to_numpy(np.int64),
+            'item_name': self.lines['item_name'].to_numpy(dtype=object),
+            'quantity': self.lines['quantity'].to_numpy(np.int64),
+            'size': self.lines['size'].to_numpy(dtype=object),
+            'price': self.lines['price'].to_numpy(np.float64),
+            'added_ingredients': self.ingredient_lists('added'),
+            'removed_ingredients': self.ingredient_lists('removed'),
+            'total_amount': heads['total_amount'].to_numpy(np.float64),
+            'pickup_type': heads['pickup_type'].to_numpy(dtype=object),
+            'status': heads['status'].to_numpy(dtype=object),
+            'time_of_day': heads['time_of_day'].to_numpy(dtype=object),
+        })
+        return frame[ORDER_LINE_COLUMNS]
+
+    def memory_usage(self) -> dict:
+        """Bytes held by each part, including categorical dictionaries"""
+        usage = {f"orders.{col}": int(size) for col, size in
+                 self.orders.memory_usage(index=False, deep=True).items()}
+        usage.update({f"lines.{col}": int(size) for col, size in
+                      self.lines.memory_usage(index=False, deep=True).items()})
+        usage['ingredients.vocabulary'] = int(self.ingredients.memory_usage(deep=True))
+        for name in ('added_codes', 'added_offsets', 'removed_codes', 'removed_offsets'):
+            usage[f"ingredients.{name}"] = int(getattr(self, name).nbytes)
+        return usage
+
+
+def _deep_size(values: pd.Series) -> int:
+    """Deep size of a column, counting the list objects and their strings"""
+    size = int(values.memory_usage(index=False, deep=True))
+    if values.dtype == object and len(values) and isinstance(values.iloc[0], list):
+        size += sum(sys.getsizeof(s) for v in values if isinstance(v, list) for s in v)
+    return size
+
+
+def memory_report(frame: pd.DataFrame) -> dict:
+    """Compare the wide order-line frame with its compact representation"""
+    start = time.perf_counter()
+    compact = CompactOrderLines.from_frame(frame)
+    build_seconds = time.perf_counter() - start
+
+    frame_columns = {col: _deep_size(frame[col]) for col in frame.columns}
+    compact_parts = compact.memory_usage()
+    frame_bytes = sum(frame_columns.values())
+    compact_bytes = sum(compact_parts.values())
+    return {
+        'lines': len(frame),
+        'orders': len(compact.orders),
+        'distinct_ingredients': len(compact.ingredients),
+        'frame_bytes': frame_bytes,
+        'compact_bytes': compact_bytes,
+        'ratio': round(frame_bytes / compact_bytes, 2) if compact_bytes else None,
+        'build_seconds': round(build_seconds, 4),
+        'frame_columns': frame_columns,
+        'compact_parts': compact_parts,
+    }
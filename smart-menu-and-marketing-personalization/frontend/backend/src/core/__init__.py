@@ -2,13 +2,14 @@
 Core recommendation algorithms and models
 """
 
-from .collaborative import cf_scores_for_user
+from .collaborative import cf_scores_for_user, cf_scores_for_users
 from .contextual import ContextualRecommender
 from .hybrid import recommend_hybrid
 from .popularity import PopularityRecommender
 
 __all__ = [
     'cf_scores_for_user',
+    'cf_scores_for_users',
     'ContextualRecommender',
     'recommend_hybrid',
     'PopularityRecommender',
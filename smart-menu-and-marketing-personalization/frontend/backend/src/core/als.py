@@ -0,0 +1,253 @@
+"""
+Implicit-feedback matrix factorisation (ALS with confidence weighting)
+
+Each (user, item) interaction strength ``r`` from :func:`interaction_strengths`
+(quantities plus weighted customizations) becomes a confidence
+``c = 1 + alpha * r`` on the binary preference "user ordered the item".
+Alternating least squares then fits float32 user and item factors, and a
+user's scores are one dot product against the item factors, whatever the
+size of the order history.
+
+Usage:
+    python -m src.core.als train [--path PATH]
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import threading
+import time
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from src.data_loader import load_orders, recommender_setting
+from .collaborative import SparseUserItemMatrix, interaction_strengths
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+
+def _solve_rows(confidence: sparse.csr_matrix, fixed: np.ndarray, regularization: float,
+                max_entries: int = 65536) -> np.ndarray:
+    """One ALS half-step: solve every row of ``confidence`` against the ``fixed`` factors.
+
+    For row u: ``(F^T F + F^T (C_u - I) F + reg I) x_u = F^T C_u p_u``. Rows
+    are taken in order of their number of non-zeros and padded to a common
+    length, so each batch is one stacked matmul of at most ``max_entries``
+    padded entries.
+    """
+    n_rows, n_factors = confidence.shape[0], fixed.shape[1]
+    gram = fixed.T @ fixed + regularization * np.eye(n_factors, dtype=fixed.dtype)
+    solved = np.zeros((n_rows, n_factors), dtype=fixed.dtype)
+    indptr, indices, data = confidence.indptr, confidence.indices, confidence.data
+    counts = np.diff(indptr)
+    by_length = np.flatnonzero(counts)
+    by_length = by_length[np.argsort(counts[by_length], kind='stable')]
+
+    start = 0
+    while start < len(by_length):
+        # Grow the batch while rows x (longest row) stays within max_entries
+        end = min(start + max(max_entries // counts[by_length[start]], 1), len(by_length))
+        while end - start > 1 and (end - start) * counts[by_length[end - 1]] > max_entries:
+            end = start + max(max_entries // counts[by_length[end - 1]], 1)
+        rows = by_length[start:end]
+        lengths = counts[rows]
+        width = lengths[-1]
+
+        # Entry positions of every selected row, and where they land in the padded batch
+        owner = np.repeat(np.arange(len(rows)), lengths)
+        slot = np.arange(len(owner)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        entries = np.repeat(indptr[rows], lengths) + slot
+
+        vectors = np.zeros((len(rows), width, n_factors), dtype=fixed.dtype)
+        weights = np.zeros((len(rows), width), dtype=fixed.dtype)
+        vectors[owner, slot] = fixed[indices[entries]]
+        weights[owner, slot] = data[entries]
+
+        a = gram + np.matmul((vectors * (weights - 1.0)[..., None]).transpose(0, 2, 1), vectors)
+        b = np.matmul(weights[:, None, :], vectors)[:, 0]
+        solved[rows] = np.linalg.solve(a, b[..., None])[..., 0]
+        start = end
+    return solved
+
+
+class ImplicitALS:
+    """Implicit ALS recommender with float32 user and item factors"""
+
+    def __init__(self, factors: int | None = None, regularization: float | None = None,
+                 alpha: float | None = None, iterations: int | None = None, seed: int = 42):
+        self.factors = factors or recommender_setting('ALS_FACTORS', 32)
+        self.regularization = regularization if regularization is not None else recommender_setting('ALS_REGULARIZATION', 0.1)
+        self.alpha = alpha if alpha is not None else recommender_setting('ALS_ALPHA', 10.0)
+        self.iterations = iterations or recommender_setting('ALS_ITERATIONS', 15)
+        self.seed = seed
+        self.user_ids = pd.Index([], name="user_id")
+        self.item_ids = pd.Index([], name="item_id")
+        self.user_factors = np.zeros((0, self.factors), dtype=np.float32)
+        self.item_factors = np.zeros((0, self.factors), dtype=np.float32)
+        self.version = None
+
+    def fit(self, orders: pd.DataFrame | None = None) -> 'ImplicitALS':
+        """Train from exploded order lines (``load_orders`` when not given)"""
+        interactions = SparseUserItemMatrix.from_orders(orders)
+        confidence = interactions.matrix.astype(np.float32)
+        confidence.data = 1.0 + self.alpha * confidence.data
+        confidence_t = confidence.T.tocsr()
+
+        rng = np.random.default_rng(self.seed)
+        n_users, n_items = confidence.shape
+        users = (rng.standard_normal((n_users, self.factors)) * 0.01).astype(np.float32)
+        items = (rng.standard_normal((n_items, self.factors)) * 0.01).astype(np.float32)
+
+        start = time.perf_counter()
+        for _ in range(self.iterations):
+            users = _solve_rows(confidence, items, self.regularization)
+            items = _solve_rows(confidence_t, users, self.regularization)
+        logger.info(f"Trained ALS on {n_users} users x {n_items} items "
+                    f"({self.iterations} iterations) in {time.perf_counter() - start:.2f}s")
+
+        self.user_ids, self.item_ids = interactions.users, interactions.items
+        self.user_factors, self.item_factors = users, items
+        self.version = time.strftime('%Y%m%dT%H%M%S')
+        self._user_rows = None
+        return self
+
+    def _row(self, user_id: int):
+        if getattr(self, '_user_rows', None) is None:
+            self._user_rows = pd.Series(np.arange(len(self.user_ids)), index=self.user_ids)
+        return self._user_rows.get(user_id)
+
+    def fold_in(self, user_orders: pd.DataFrame) -> np.ndarray:
+        """Factor for a user from their own order lines, against the trained item factors"""
+        strengths = interaction_strengths(user_orders).groupby(level=1).sum()
+        cols = self.item_ids.get_indexer(strengths.index)
+        known = cols >= 0
+        vectors = self.item_factors[cols[known]]
+        conf = (1.0 + self.alpha * strengths.to_numpy()[known]).astype(np.float32)
+        a = self.item_factors.T @ self.item_factors + self.regularization * np.eye(self.factors, dtype=np.float32)
+        a += (vectors.T * (conf - 1.0)) @ vectors
+        return np.linalg.solve(a, vectors.T @ conf).astype(np.float32)
+
+    def scores_for_user(self, user_id: int, user_orders: pd.DataFrame | None = None) -> pd.Series:
+        """Predicted preference per item, clipped at 0.
+
+        With ``user_orders`` the user's factor is folded in from them, so
+        orders placed since training (and new users) are reflected. From
+        ``ANN_MIN_ITEMS`` items on, only the ``ANN_CANDIDATES`` items
+        retrieved from the item index are scored.
+        """
+        if not len(self.item_ids):
+            return pd.Series(dtype=float)
+        if user_orders is not None and not user_orders.empty:
+            factor = self.fold_in(user_orders)
+        else:
+            row = self._row(user_id)
+            if row is None:
+                return pd.Series(dtype=float)
+            factor = self.user_factors[row]
+        if len(self.item_ids) >= recommender_setting('ANN_MIN_ITEMS', 20_000):
+            # Large catalogues: score only the candidates retrieved from the item index
+            from .ann import get_item_index
+            ids, _ = get_item_index().query(factor, recommender_setting('ANN_CANDIDATES', 500), metric='dot')
+            cols = self.item_ids.get_indexer(ids)
+            # The index may come from another model (a published artifact): skip items this one lacks
+            cols = cols[cols >= 0]
+            if len(cols):
+                scores = self.item_factors[cols] @ factor
+                return pd.Series(np.clip(scores, 0, None).astype(float), index=self.item_ids[cols])
+        scores = self.item_factors @ factor
+        return pd.Series(np.clip(scores, 0, None).astype(float), index=self.item_ids)
+
+    def item_vectors(self) -> tuple[pd.Index, np.ndarray]:
+        return self.item_ids, self.item_factors
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+    def save(self, path) -> Path:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(tmp, 'wb') as f:
+            np.savez(
+                f,
+                format_version=np.array(FORMAT_VERSION),
+                version=np.array(self.version or ''),
+                hyperparameters=np.array([self.factors, self.regularization, self.alpha, self.iterations]),
+                user_ids=self.user_ids.to_numpy(dtype=np.int64),
+                item_ids=self.item_ids.to_numpy(dtype=np.int64),
+                user_factors=self.user_factors,
+                item_factors=self.item_factors,
+            )
+        os.replace(tmp, path)
+        logger.info(f"Saved ALS model {self.version} to {path}")
+        return path
+
+    @classmethod
+    def load(cls, path) -> 'ImplicitALS':
+        with np.load(path) as arrays:
+            format_version = int(arrays['format_version'])
+            if format_version != FORMAT_VERSION:
+                raise ValueError(f"Unsupported ALS model format {format_version}")
+            factors, regularization, alpha, iterations = arrays['hyperparameters']
+            model = cls(int(factors), float(regularization), float(alpha), int(iterations))
+            model.user_ids = pd.Index(arrays['user_ids'], name="user_id")
+            model.item_ids = pd.Index(arrays['item_ids'], name="item_id")
+            model.user_factors = arrays['user_factors']
+            model.item_factors = arrays['item_factors']
+            model.version = str(arrays['version'])
+        return model
+
+
+_als_model = None
+_als_model_source = None  # artifact mtime, or training time for in-process models
+_als_model_lock = threading.Lock()
+
+
+def _is_stale(source) -> bool:
+    path = recommender_setting('ALS_MODEL_PATH')
+    if path and os.path.exists(path):
+        return os.path.getmtime(path) != source
+    return time.monotonic() - source > recommender_setting('ALS_MAX_AGE_SECONDS', 3600)
+
+
+def get_als_model() -> ImplicitALS:
+    """Process-wide ALS model: loaded from ``ALS_MODEL_PATH`` (reloaded when it
+    changes), otherwise trained in-process and retrained after ``ALS_MAX_AGE_SECONDS``"""
+    global _als_model, _als_model_source
+    if _als_model is None or _is_stale(_als_model_source):
+        with _als_model_lock:
+            if _als_model is None or _is_stale(_als_model_source):
+                path = recommender_setting('ALS_MODEL_PATH')
+                model = None
+                if path and os.path.exists(path):
+                    try:
+                        model, source = ImplicitALS.load(path), os.path.getmtime(path)
+                    except Exception as e:
+                        logger.error(f"Could not load ALS model from {path}: {e}")
+                if model is None:
+                    model, source = ImplicitALS().fit(load_orders()), time.monotonic()
+                _als_model, _als_model_source = model, source
+    return _als_model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Smart Menu - implicit ALS model")
+    parser.add_argument("command", choices=["train"])
+    parser.add_argument("--path", type=str, default=None, help="Artifact path (default: RECOMMENDER['ALS_MODEL_PATH'])")
+    args = parser.parse_args()
+
+    path = args.path or recommender_setting('ALS_MODEL_PATH') or 'artifacts/als.npz'
+    model = ImplicitALS().fit(load_orders(mode=recommender_setting('ORDER_LINES_MODE', 'python')))
+    model.save(path)
+    print(f"Saved ALS model {model.version} ({len(model.user_ids)} users, {len(model.item_ids)} items) to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""
+Approximate nearest-neighbour search over item vectors (inverted file index)
+
+Item vectors (ALS item factors, or any other dense item embedding) are
+clustered with spherical k-means into ``n_lists`` cells. A query scores the
+cell centroids, scans only the ``n_probe`` best cells and ranks the vectors
+found there exactly, so a query costs about ``n_probe / n_lists`` of a
+brute-force scan. Vectors are kept as unit directions plus norms, so one
+index answers both cosine ("similar items") and inner-product (candidate
+retrieval for a user factor) queries.
+
+Usage:
+    python -m src.core.ann build [--path PATH]
+"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from src.data_loader import recommender_setting
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+
+def _unit(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1.0)
+
+
+def _top(scores: np.ndarray, k: int) -> np.ndarray:
+    """Positions of the ``k`` largest scores, best first"""
+    if k < len(scores):
+        top = np.argpartition(-scores, k)[:k]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind='stable')]
+
+
+def _spherical_kmeans(vectors: np.ndarray, n_lists: int, iterations: int, seed: int):
+    """Unit-norm centroids and the cell of every (unit-norm) vector"""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), n_lists, replace=False)]
+    for _ in range(iterations):
+        cells = np.argmax(vectors @ centroids.T, axis=1)
+        order = np.argsort(cells, kind='stable')
+        filled, starts = np.unique(cells[order], return_index=True)
+        # Empty cells keep their previous centroid
+        centroids[filled] = _unit(np.add.reduceat(vectors[order], starts, axis=0))
+    return centroids, np.argmax(vectors @ centroids.T, axis=1)
+
+
+class IVFIndex:
+    """Inverted file index for top-k inner-product or cosine queries.
+
+    Vectors are stored grouped by cell: cell ``c`` holds rows
+    ``offsets[c]:offsets[c + 1]`` of ``ids`` / ``vectors`` (unit-norm) /
+    ``norms``. ``metric`` is the default for :meth:`query`.
+    """
+
+    def __init__(self, metric: str = 'cosine', n_lists: int | None = None, n_probe: int | None = None,
+                 iterations: int = 10, seed: int = 42):
+        if metric not in ('cosine', 'dot'):
+            raise ValueError(f"Unknown metric {metric!r}")
+        self.metric = metric
+        self.n_lists = n_lists
+        self.n_probe = n_probe or recommender_setting('ANN_PROBES', 8)
+        self.iterations = iterations
+        self.seed = seed
+        self.ids = np.empty(0, dtype=np.int64)
+        self.vectors = np.empty((0, 0), dtype=np.float32)
+        self.norms = np.empty(0, dtype=np.float32)
+        self.centroids = np.empty((0, 0), dtype=np.float32)
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self._positions = None
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def build(self, ids, vectors: np.ndarray) -> 'IVFIndex':
+        ids = np.asarray(ids, dtype=np.int64)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        start = time.perf_counter()
+        unit = _unit(vectors)
+
+        n_lists = self.n_lists or recommender_setting('ANN_LISTS', None) or int(np.sqrt(len(ids)))
+        n_lists = max(min(n_lists, len(ids)), 1)
+        if len(ids):
+            centroids, cells = _spherical_kmeans(unit, n_lists, self.iterations, self.seed)
+        else:
+            centroids, cells = np.zeros((0, vectors.shape[1]), dtype=np.float32), np.empty(0, dtype=np.int64)
+
+        order = np.argsort(cells, kind='stable')
+        self.ids, self.vectors = ids[order], unit[order]
+        self.norms = np.linalg.norm(vectors, axis=1)[order]
+        self.centroids = centroids.astype(np.float32)
+        self.offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(cells, minlength=len(centroids)), out=self.offsets[1:])
+        self._positions = None
+        logger.info(f"Built IVF index over {len(ids)} vectors ({len(centroids)} lists) "
+                    f"in {time.perf_counter() - start:.2f}s")
+        return self
+
+    def _position(self, item_id: int):
+        if self._positions is None:
+            self._positions = pd.Series(np.arange(len(self.ids)), index=self.ids)
+        return self._positions.get(item_id)
+
+    def query(self, vector: np.ndarray, k: int = 10, n_probe: int | None = None,
+              exclude=None, metric: str | None = None) -> tuple[np.ndarray, np.ndarray]:
+        """Approximate top-``k`` (ids, scores) for ``vector``, best first"""
+        if not len(self.ids):
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        vector = np.asarray(vector, dtype=np.float32)
+        n_probe = min(n_probe or self.n_probe, len(self.centroids))
+
+        cells = _top(self.centroids @ vector, n_probe)
+        rows = np.concatenate([np.arange(self.offsets[c], self.offsets[c + 1]) for c in cells])
+        scores = self.vectors[rows] @ vector
+        if (metric or self.metric) == 'dot':
+            scores = scores * self.norms[rows]
+        else:
+            scores = scores / (np.linalg.norm(vector) or 1.0)
+        if exclude is not None:
+            keep = ~np.isin(self.ids[rows], np.asarray(exclude))
+            rows, scores = rows[keep], scores[keep]
+        top = _top(scores, k)
+        return self.ids[rows[top]], scores[top]
+
+    def query_item(self, item_id: int, k: int = 10, n_probe: int | None = None):
+        """Items most similar to ``item_id`` (excluding itself); None when it is not indexed"""
+        position = self._position(item_id)
+        if position is None:
+            return None
+        return self.query(self.vectors[position], k, n_probe, exclude=[item_id], metric='cosine')
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+    def save(self, path) -> Path:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(tmp, 'wb') as f:
+            np.savez(
+                f,
+                format_version=np.array(FORMAT_VERSION),
+                metric=np.array(self.metric),
+                n_probe=np.array(self.n_probe),
+                ids=self.ids,
+                vectors=self.vectors,
+                norms=self.norms,
+                centroids=self.centroids,
+                offsets=self.offsets,
+            )
+        os.replace(tmp, path)
+        logger.info(f"Saved IVF index ({len(self.ids)} vectors) to {path}")
+        return path
+
+    @classmethod
+    def load(cls, path) -> 'IVFIndex':
+        with np.load(path) as arrays:
+            format_version = int(arrays['format_version'])
+            if format_version != FORMAT_VERSION:
+                raise ValueError(f"Unsupported ANN index format {format_version}")
+            index = cls(metric=str(arrays['metric']), n_probe=int(arrays['n_probe']))
+            index.ids = arrays['ids']
+            index.vectors = arrays['vectors']
+            index.norms = arrays['norms']
+            index.centroids = arrays['centroids']
+            index.offsets = arrays['offsets']
+            index.n_lists = len(index.centroids)
+        return index
+
+
+_item_index = None
+_item_index_source = None  # ALS model the index was built from, or the artifact mtime
+_item_index_lock = threading.Lock()
+
+
+def get_item_index() -> IVFIndex:
+    """Process-wide cosine index over the ALS item factors.
+
+    Loaded from ``ANN_INDEX_PATH`` (reloaded when it changes) when set,
+    otherwise built from the current ALS model and rebuilt when that model is
+    replaced.
+    """
+    global _item_index, _item_index_source
+    from .als import get_als_model
+
+    path = recommender_setting('ANN_INDEX_PATH')
+    with _item_index_lock:
+        if path and os.path.exists(path):
+            if _item_index is None or _item_index_source != os.path.getmtime(path):
+                _item_index, _item_index_source = IVFIndex.load(path), os.path.getmtime(path)
+        else:
+            model = get_als_model()
+            if _item_index is None or _item_index_source is not model:
+                _item_index, _item_index_source = IVFIndex('cosine').build(*model.item_vectors()), model
+        return _item_index
+
+
+def similar_items(item_id: int, k: int = 10) -> pd.Series | None:
+    """Items most similar to ``item_id`` as item_id -> similarity, from the
+    CF source in ``RECOMMENDER["CF_SOURCE"]``; None when the item is unknown"""
+    if recommender_setting('CF_SOURCE', 'item_cf') == 'als':
+        found = get_item_index().query_item(item_id, k)
+        if found is None:
+            return None
+        ids, scores = found
+        return pd.Series(scores.astype(float), index=pd.Index(ids, name="item_id"))
+
+    from .cf_model import get_cf_model
+    return get_cf_model().similar_items(item_id, k)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Smart Menu - item ANN index")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("--path", type=str, default=None, help="Artifact path (default: RECOMMENDER['ANN_INDEX_PATH'])")
+    args = parser.parse_args()
+
+    from .als import get_als_model
+    path = args.path or recommender_setting('ANN_INDEX_PATH') or 'artifacts/items.ivf.npz'
+    index = IVFIndex('cosine').build(*get_als_model().item_vectors())
+    index.save(path)
+    print(f"Saved IVF index ({len(index)} items, {len(index.centroids)} lists) to {path}")
+
+
+if __name__ == "__main__":
+    main()
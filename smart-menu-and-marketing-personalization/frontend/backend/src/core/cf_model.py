@@ -0,0 +1,515 @@
+"""
+Persisted item-item collaborative-filtering model
+
+The model keeps the user x item interaction matrix ``X`` and its Gram matrix
+``G = X.T @ X`` (item co-occurrence). Cosine similarity is
+``D^-1 G D^-1`` with ``D`` the item norms (``sqrt(diag(G))``), so scoring a
+user is a single sparse matrix-vector product against ``G``.
+
+New orders do not trigger a rebuild: :meth:`ItemCFModel.apply` changes the
+affected users' rows and records only the co-occurrence entries and norms of
+the items they touched in a small delta buffer, which is folded into ``G``
+once it grows past ``RECOMMENDER["CF_MODEL_COMPACT_ENTRIES"]``.
+
+The artifact records the watermark of the newest order line it covers. A
+model loaded from it and attached to the order snapshot only catches up with
+the lines placed after that watermark instead of being rebuilt.
+
+Usage:
+    python -m src.core.cf_model build [--path PATH]
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import threading
+import time
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from src.data_loader import load_orders, recommender_setting
+from .collaborative import SparseUserItemMatrix, TopKNeighbours, cf_neighbours, interaction_strengths
+from .popularity import lines_after, newest_line
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+
+def _save_csr(arrays: dict, name: str, matrix: sparse.csr_matrix):
+    arrays[f"{name}_data"] = matrix.data
+    arrays[f"{name}_indices"] = matrix.indices
+    arrays[f"{name}_indptr"] = matrix.indptr
+    arrays[f"{name}_shape"] = np.array(matrix.shape)
+
+
+def _load_csr(arrays, name: str) -> sparse.csr_matrix:
+    return sparse.csr_matrix(
+        (arrays[f"{name}_data"], arrays[f"{name}_indices"], arrays[f"{name}_indptr"]),
+        shape=tuple(arrays[f"{name}_shape"])
+    )
+
+
+class ItemCFModel:
+    """Item-item CF model over a co-occurrence (Gram) matrix with incremental updates.
+
+    Also an order-snapshot listener: ``reset(lines)`` rebuilds the model and
+    ``apply(added, removed)`` updates it in place. After :meth:`load`, the
+    first ``reset`` only applies the lines newer than the saved watermark.
+    """
+
+    def __init__(self, user_ids, item_ids, matrix: sparse.csr_matrix, gram: sparse.csr_matrix,
+                 version: str | None = None, watermark: tuple | None = None):
+        self._lock = threading.RLock()
+        self._set_state(user_ids, item_ids, matrix, gram)
+        self._neighbours = None
+        self._neighbours_built = 0.0
+        self._neighbours_dirty = False
+        self.version = version or time.strftime('%Y%m%dT%H%M%S')
+        self.updates = 0
+        self.watermark = watermark  # (epoch seconds, order_id) of the newest line seen
+        self._restored = False
+
+    def _set_state(self, user_ids, item_ids, matrix, gram):
+        self.user_ids = [int(u) for u in user_ids]
+        self.item_ids = [int(i) for i in item_ids]
+        self._user_rows = {u: row for row, u in enumerate(self.user_ids)}
+        self._item_cols = {i: col for col, i in enumerate(self.item_ids)}
+        self._matrix = sparse.csr_matrix(matrix, dtype=np.float64)
+        self._gram = sparse.csr_matrix(gram, dtype=np.float64)
+        self._sq_norms = self._gram.diagonal().copy()
+        self._rows = {}  # user row -> (cols, values) for rows changed since the last compaction
+        self._delta = []  # (rows, cols, values) co-occurrence changes since the last compaction
+        self._delta_entries = 0
+        self._delta_matrix = None
+
+    @classmethod
+    def from_orders(cls, orders: pd.DataFrame | None = None) -> 'ItemCFModel':
+        if orders is None:
+            orders = load_orders()
+        interactions = SparseUserItemMatrix.from_orders(orders)
+        matrix = interactions.matrix.astype(np.float64)
+        return cls(interactions.users, interactions.items, matrix, (matrix.T @ matrix).tocsr(),
+                   watermark=newest_line(orders))
+
+    # ------------------------------------------------------------------
+    # Order snapshot listener
+    # ------------------------------------------------------------------
+    def reset(self, lines: pd.DataFrame):
+        with self._lock:
+            if self._restored and self.watermark is not None and not lines.empty:
+                # Loaded from an artifact: only catch up with lines placed after it was built
+                self._restored = False
+                self.apply(lines_after(lines, self.watermark), lines.iloc[:0])
+                self.updates = 0
+                return
+
+        rebuilt = ItemCFModel.from_orders(lines)
+        with self._lock:
+            self._set_state(rebuilt.user_ids, rebuilt.item_ids, rebuilt._matrix, rebuilt._gram)
+            self._neighbours = None
+            self.version = rebuilt.version
+            self.watermark = rebuilt.watermark
+            self._restored = False
+            self.updates = 0
+
+    def apply(self, added: pd.DataFrame, removed: pd.DataFrame):
+        mark = newest_line(added)
+        if mark is not None:
+            with self._lock:
+                if self.watermark is None or mark > self.watermark:
+                    self.watermark = mark
+        changes = [interaction_strengths(added)] if not added.empty else []
+        if not removed.empty:
+            changes.append(-interaction_strengths(removed))
+        if not changes:
+            return
+        delta = pd.concat(changes).groupby(level=[0, 1]).sum()
+        delta = delta[delta != 0]
+
+        with self._lock:
+            for user_id, user_delta in delta.groupby(level=0):
+                self._update_user(int(user_id), user_delta.index.get_level_values(1), user_delta.to_numpy())
+            self.updates += 1
+            if self._delta_entries > recommender_setting('CF_MODEL_COMPACT_ENTRIES', 200_000):
+                self.compact()
+
+    # ------------------------------------------------------------------
+    # Incremental updates
+    # ------------------------------------------------------------------
+    def _user_row(self, user_id: int) -> int:
+        row = self._user_rows.get(user_id)
+        if row is None:
+            row = len(self.user_ids)
+            self.user_ids.append(user_id)
+            self._user_rows[user_id] = row
+            self._rows[row] = (np.empty(0, dtype=np.int64), np.empty(0))
+        return row
+
+    def _item_col(self, item_id: int) -> int:
+        col = self._item_cols.get(item_id)
+        if col is None:
+            col = len(self.item_ids)
+            self.item_ids.append(item_id)
+            self._item_cols[item_id] = col
+            self._sq_norms = np.append(self._sq_norms, 0.0)
+        return col
+
+    def _row(self, row: int):
+        if row in self._rows:
+            return self._rows[row]
+        start, end = self._matrix.indptr[row], self._matrix.indptr[row + 1]
+        return self._matrix.indices[start:end].astype(np.int64), self._matrix.data[start:end]
+
+    def _record_outer(self, cols: np.ndarray, values: np.ndarray, sign: float, touched: np.ndarray):
+        """Add ``sign * v v^T`` entries that involve a touched item to the delta buffer"""
+        if not len(cols):
+            return
+        hit = np.isin(cols, touched)
+        i, j = np.meshgrid(np.arange(len(cols)), np.arange(len(cols)), indexing='ij')
+        keep = hit[i] | hit[j]
+        i, j = i[keep], j[keep]
+        self._delta.append((cols[i], cols[j], sign * values[i] * values[j]))
+        self._delta_entries += len(i)
+
+    def _update_user(self, user_id: int, item_ids, changes: np.ndarray):
+        row = self._user_row(user_id)
+        old_cols, old_values = self._row(row)
+        touched = np.array([self._item_col(int(i)) for i in item_ids], dtype=np.int64)
+
+        new = pd.Series(old_values, index=old_cols, dtype=float).add(
+            pd.Series(changes, index=touched, dtype=float), fill_value=0.0
+        )
+        new = new[new.abs() > 1e-9].sort_index()
+        new_cols, new_values = new.index.to_numpy(dtype=np.int64), new.to_numpy()
+        self._rows[row] = (new_cols, new_values)
+
+        # G' = G - r r^T + r' r'^T; entries between untouched items cancel out
+        self._record_outer(old_cols, old_values, -1.0, touched)
+        self._record_outer(new_cols, new_values, 1.0, touched)
+        np.add.at(self._sq_norms, old_cols, -old_values ** 2)
+        np.add.at(self._sq_norms, new_cols, new_values ** 2)
+        self._delta_matrix = None
+        self._neighbours_dirty = True
+
+    def _delta_csr(self) -> sparse.csr_matrix | None:
+        if not self._delta:
+            return None
+        if self._delta_matrix is None or self._delta_matrix.shape[0] != len(self.item_ids):
+            rows, cols, values = (np.concatenate(parts) for parts in zip(*self._delta))
+            n = len(self.item_ids)
+            self._delta_matrix = sparse.csr_matrix((values, (rows, cols)), shape=(n, n))
+        return self._delta_matrix
+
+    def compact(self):
+        """Fold changed rows into ``X`` and the delta buffer into ``G``"""
+        with self._lock:
+            n_users, n_items = len(self.user_ids), len(self.item_ids)
+            gram = self._gram.copy()
+            gram.resize((n_items, n_items))
+            delta = self._delta_csr()
+            if delta is not None:
+                gram = (gram + delta).tocsr()
+                gram.eliminate_zeros()
+
+            matrix = self._matrix.tocoo()
+            keep = ~np.isin(matrix.row, np.fromiter(self._rows, dtype=np.int64, count=len(self._rows)))
+            rows, cols, values = [matrix.row[keep]], [matrix.col[keep]], [matrix.data[keep]]
+            for row, (row_cols, row_values) in self._rows.items():
+                rows.append(np.full(len(row_cols), row))
+                cols.append(row_cols)
+                values.append(row_values)
+            matrix = sparse.csr_matrix(
+                (np.concatenate(values), (np.concatenate(rows), np.concatenate(cols))), shape=(n_users, n_items)
+            )
+            sq_norms = self._sq_norms
+            self._set_state(self.user_ids, self.item_ids, matrix, gram)
+            self._sq_norms = sq_norms
+
+    # ------------------------------------------------------------------
+    # Scoring
+    # ------------------------------------------------------------------
+    def _norms(self) -> np.ndarray:
+        return np.sqrt(np.clip(self._sq_norms, 0, None)) + 1e-9
+
+    def _gram_dot(self, x: np.ndarray) -> np.ndarray:
+        base = self._gram.shape[0]
+        y = np.zeros(len(x))
+        y[:base] = self._gram @ x[:base]
+        delta = self._delta_csr()
+        if delta is not None:
+            y += delta @ x
+        return y
+
+    def user_vector(self, user_id: int) -> np.ndarray | None:
+        with self._lock:
+            row = self._user_rows.get(user_id)
+            if row is None:
+                return None
+            cols, values = self._row(row)
+            weights = np.zeros(len(self.item_ids))
+            weights[cols] = values
+            return weights
+
+    def neighbours(self) -> TopKNeighbours | None:
+        """Top-K neighbour index (``CF_NEIGHBOURS``), or None to score from the full similarity.
+
+        After updates the index is rebuilt at most every
+        ``CF_NEIGHBOURS_REFRESH_SECONDS``; users' own vectors are always current.
+        """
+        k = cf_neighbours()
+        if not k:
+            return None
+        with self._lock:
+            index = self._neighbours
+            stale = index is None or index.k != k or (
+                self._neighbours_dirty
+                and time.monotonic() - self._neighbours_built >= recommender_setting('CF_NEIGHBOURS_REFRESH_SECONDS', 60)
+            )
+            if stale:
+                self._neighbours = TopKNeighbours.from_similarity(self.similarity(), k)
+                self._neighbours_built = time.monotonic()
+                self._neighbours_dirty = False
+            return self._neighbours
+
+    def scores_for_user(self, user_id: int) -> pd.Series:
+        """Cosine item-item CF scores, minus the already-consumed penalty, clipped at 0"""
+        with self._lock:
+            weights = self.user_vector(user_id)
+            if weights is None or np.all(weights == 0):
+                return pd.Series(dtype=float)
+            index = self.neighbours()
+            if index is not None:
+                scores = index.scores(weights)
+            else:
+                norms = self._norms()
+                scores = self._gram_dot(weights / norms) / norms
+            items = pd.Index(self.item_ids, name="item_id")
+        # Do not recommend items already consumed heavily
+        scores = np.clip(scores - weights * 0.5, 0, None)
+        return pd.Series(scores, index=items)
+
+    def iter_scores(self, user_ids=None, chunk_size: int = 2048):
+        """Yield ``(user_ids, item_ids, scores)`` for chunks of users, scored by one matrix multiply each"""
+        with self._lock:
+            rows = (
+                list(range(len(self.user_ids))) if user_ids is None
+                else [self._user_rows[u] for u in user_ids if u in self._user_rows]
+            )
+        for start in range(0, len(rows), chunk_size):
+            chunk = rows[start:start + chunk_size]
+            with self._lock:
+                n = len(self.item_ids)
+                weights = self._weights_matrix(chunk, n)
+                index = self.neighbours()
+                if index is not None:
+                    scores = (weights @ index.as_matrix(n)).toarray()
+                else:
+                    scaled = weights @ sparse.diags(1.0 / self._norms())
+                    gram = self._gram.copy()
+                    gram.resize((n, n))
+                    delta = self._delta_csr()
+                    if delta is not None:
+                        gram = gram + delta
+                    scores = (scaled @ gram).toarray() / self._norms()
+                users = [self.user_ids[row] for row in chunk]
+                items = pd.Index(self.item_ids, name="item_id")
+            # Do not recommend items already consumed heavily
+            scores = np.clip(scores - weights.toarray() * 0.5, 0, None)
+            yield users, items, scores
+
+    def _weights_matrix(self, rows, n: int) -> sparse.csr_matrix:
+        """CSR of the given user rows, with updated rows taken from the change buffer"""
+        indptr, indices, data = [0], [], []
+        for row in rows:
+            cols, values = self._row(row)
+            indices.append(cols)
+            data.append(values)
+            indptr.append(indptr[-1] + len(cols))
+        return sparse.csr_matrix(
+            (np.concatenate(data) if data else np.empty(0),
+             np.concatenate(indices) if indices else np.empty(0, dtype=np.int64), indptr),
+            shape=(len(rows), n)
+        )
+
+    def similar_items(self, item_id: int, k: int = 10) -> pd.Series | None:
+        """Most cosine-similar other items (item_id -> similarity); None when the item is unknown"""
+        with self._lock:
+            col = self._item_cols.get(item_id)
+            if col is None:
+                return None
+            index = self.neighbours()
+            if index is not None and col < len(index):
+                cols, values = index.indices[col], index.weights[col]
+                cols, values = cols[cols >= 0][:k], values[cols >= 0][:k]
+            else:
+                row = self.similarity().getrow(col)
+                keep = (row.indices != col) & (row.data > 0)
+                cols, values = row.indices[keep], row.data[keep]
+                top = np.argsort(-values, kind='stable')[:k]
+                cols, values = cols[top], values[top]
+            ids = pd.Index(np.asarray(self.item_ids)[cols], name="item_id")
+            return pd.Series(values.astype(float), index=ids)
+
+    def pairwise_similarity(self, item_ids) -> np.ndarray:
+        """Dense cosine similarity between the given items (rows of unknown items are 0)"""
+        with self._lock:
+            cols = np.array([self._item_cols.get(int(i), -1) for i in item_ids], dtype=np.int64)
+            similarity = np.zeros((len(cols), len(cols)))
+            known = np.flatnonzero(cols >= 0)
+            if not len(known):
+                return similarity
+            n, base = len(self.item_ids), self._gram.shape[0]
+            picked = cols[known]
+            selector = sparse.csr_matrix((np.ones(len(picked)), (picked, np.arange(len(picked)))),
+                                         shape=(n, len(picked)))
+            block = sparse.vstack([self._gram @ selector[:base], sparse.csr_matrix((n - base, len(picked)))]).tocsr()
+            delta = self._delta_csr()
+            if delta is not None:
+                block = block + delta @ selector
+            norms = self._norms()[picked]
+            similarity[np.ix_(known, known)] = block[picked].toarray() / np.outer(norms, norms)
+            return similarity
+
+    def similarity(self) -> sparse.csr_matrix:
+        """Materialized sparse items x items cosine similarity"""
+        with self._lock:
+            n = len(self.item_ids)
+            gram = self._gram.copy()
+            gram.resize((n, n))
+            delta = self._delta_csr()
+            if delta is not None:
+                gram = gram + delta
+            scale = sparse.diags(1.0 / self._norms())
+            return (scale @ gram @ scale).tocsr()
+
+    def stats(self) -> dict:
+        return {
+            'version': self.version,
+            'users': len(self.user_ids),
+            'items': len(self.item_ids),
+            'gram_nnz': int(self._gram.nnz),
+            'pending_entries': self._delta_entries,
+            'changed_users': len(self._rows),
+            'updates': self.updates,
+            'neighbours_k': None if self._neighbours is None else self._neighbours.k,
+            'neighbours_bytes': None if self._neighbours is None else self._neighbours.nbytes(),
+        }
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+    def save(self, path) -> Path:
+        """Write the model as a versioned ``.npz`` artifact, replacing ``path`` atomically"""
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            self.compact()
+            arrays = {
+                'format_version': np.array(FORMAT_VERSION),
+                'version': np.array(self.version),
+                'watermark': np.array(self.watermark if self.watermark is not None else (np.nan, -1), dtype=float),
+                'user_ids': np.array(self.user_ids, dtype=np.int64),
+                'item_ids': np.array(self.item_ids, dtype=np.int64),
+            }
+            _save_csr(arrays, 'matrix', self._matrix)
+            _save_csr(arrays, 'gram', self._gram)
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+        logger.info(f"Saved CF model {self.version} to {path}")
+        return path
+
+    @classmethod
+    def load(cls, path) -> 'ItemCFModel':
+        with np.load(path) as arrays:
+            format_version = int(arrays['format_version'])
+            if format_version != FORMAT_VERSION:
+                raise ValueError(f"Unsupported CF model format {format_version}")
+            watermark = None
+            if 'watermark' in arrays.files:  # absent from artifacts written before it was recorded
+                seconds, order_id = arrays['watermark']
+                watermark = None if np.isnan(seconds) else (float(seconds), int(order_id))
+            model = cls(arrays['user_ids'], arrays['item_ids'], _load_csr(arrays, 'matrix'),
+                        _load_csr(arrays, 'gram'), version=str(arrays['version']), watermark=watermark)
+        model._restored = True
+        return model
+
+
+_cf_model = None
+_cf_model_source = None  # artifact mtime, or build time for in-process models
+_cf_model_lock = threading.Lock()
+
+
+def _build_cf_model() -> tuple:
+    """A fresh model plus the marker used to decide when it is stale"""
+    path = recommender_setting('CF_MODEL_PATH')
+    model = source = None
+    if path and os.path.exists(path):
+        try:
+            model, source = ItemCFModel.load(path), os.path.getmtime(path)
+        except Exception as e:
+            logger.error(f"Could not load CF model from {path}: {e}")
+
+    if recommender_setting('ORDER_SNAPSHOT', False):
+        from src.order_snapshot import get_order_snapshot
+
+        # Kept current by the order snapshot from now on; a loaded artifact
+        # only catches up with the lines placed after its watermark
+        model = model or ItemCFModel.from_orders(pd.DataFrame())
+        snapshot = get_order_snapshot()
+        snapshot.refresh()
+        snapshot.subscribe(model)
+        return model, None
+
+    if model is not None:
+        return model, source
+    model = ItemCFModel.from_orders(load_orders())
+    return model, time.monotonic()
+
+
+def _is_stale(source) -> bool:
+    if source is None:
+        return False
+    path = recommender_setting('CF_MODEL_PATH')
+    if path and os.path.exists(path):
+        return os.path.getmtime(path) != source
+    return time.monotonic() - source > recommender_setting('CF_MODEL_MAX_AGE_SECONDS', 300)
+
+
+def get_cf_model() -> ItemCFModel:
+    """Process-wide CF model.
+
+    Loaded from ``CF_MODEL_PATH`` when it exists. With the order snapshot
+    enabled it then follows the snapshot incrementally; otherwise the
+    artifact is reloaded when a new one is published, or, without one, the
+    model is built in-process and rebuilt after ``CF_MODEL_MAX_AGE_SECONDS``.
+    """
+    global _cf_model, _cf_model_source
+    if _cf_model is None or _is_stale(_cf_model_source):
+        with _cf_model_lock:
+            if _cf_model is None or _is_stale(_cf_model_source):
+                _cf_model, _cf_model_source = _build_cf_model()
+    return _cf_model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Smart Menu - item-item CF model")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("--path", type=str, default=None, help="Artifact path (default: RECOMMENDER['CF_MODEL_PATH'])")
+    args = parser.parse_args()
+
+    path = args.path or recommender_setting('CF_MODEL_PATH') or 'artifacts/item_cf.npz'
+    model = ItemCFModel.from_orders(load_orders(mode=recommender_setting('ORDER_LINES_MODE', 'python')))
+    model.save(path)
+    print(f"Saved CF model {model.version} ({len(model.user_ids)} users, {len(model.item_ids)} items) to {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,40 +2,109 @@ from __future__ import annotations
 
 import numpy as np
 import pandas as pd
+from scipy import sparse
 from typing import Tuple
 from pathlib import Path
-from src.data_loader import load_orders
+from src.data_loader import load_orders, recommender_setting
 #from .collaborative import user_item_matrix, item_similarity, cf_scores_for_user
 
 
-def user_item_matrix() -> pd.DataFrame:
-    orders = load_orders()
-    mat = orders.pivot_table(
-        index="user_id",
-        columns="item_id",
-        values="quantity",
-        aggfunc="sum",  # If a user orders the same item multiple times 
-        fill_value=0,
-    ).astype(float)
-    
+def _list_lengths(values: pd.Series) -> np.ndarray:
+    return np.fromiter((len(v) if isinstance(v, list) else 0 for v in values), dtype=np.int64, count=len(values))
+
+
+def interaction_strengths(orders: pd.DataFrame) -> pd.Series:
+    """Interaction strength per (user_id, item_id): quantities plus weighted customizations"""
     # Add weight for customizations (added/removed ingredients)
     customization_weight = 0.2  # Adjust this value based on how much you want to emphasize modifications
-    
-    for user_id in mat.index:
-        user_orders = orders[orders["user_id"] == user_id]
-        for item_id in mat.columns:
-            item_orders = user_orders[user_orders["item_id"] == item_id]
-            if not item_orders.empty:
-                # Count number of modifications
-                modifications = sum(
-                    len(mods) if isinstance(mods, list) else 0
-                    for mods in item_orders["added_ingredients"].tolist() + 
-                    item_orders["removed_ingredients"].tolist()
-                )
-                # Add weighted modification score to the interaction strength
-                mat.loc[user_id, item_id] += modifications * customization_weight
-    
-    return mat
+
+    # If a user orders the same item multiple times, quantities and modification counts add up
+    modifications = _list_lengths(orders["added_ingredients"]) + _list_lengths(orders["removed_ingredients"])
+    grouped = pd.DataFrame({
+        "user_id": orders["user_id"].to_numpy(),
+        "item_id": orders["item_id"].to_numpy(),
+        "quantity": orders["quantity"].to_numpy(),
+        "modifications": modifications,
+    }).groupby(["user_id", "item_id"])[["quantity", "modifications"]].sum()
+
+    return grouped["quantity"].astype(float) + grouped["modifications"] * customization_weight
+
+
+def user_item_matrix(orders: pd.DataFrame | None = None) -> pd.DataFrame:
+    if orders is None:
+        orders = load_orders()
+    if orders.empty:
+        return pd.DataFrame(dtype=float)
+    return interaction_strengths(orders).unstack(fill_value=0.0)
+
+
+class SparseUserItemMatrix:
+    """CSR user x item interaction matrix (float32) with cosine item similarity.
+
+    Scoring a user goes through the column-normalized matrix twice
+    (``N.T @ (N @ w)``), which equals ``similarity() @ w`` without ever
+    materializing the items x items matrix.
+    """
+
+    def __init__(self, matrix: sparse.csr_matrix, users: pd.Index, items: pd.Index):
+        self.matrix = matrix
+        self.users = users
+        self.items = items
+        self._user_rows = pd.Series(np.arange(len(users)), index=users)
+        self._normalized = None
+        self._similarity = None
+
+    @classmethod
+    def from_orders(cls, orders: pd.DataFrame | None = None) -> 'SparseUserItemMatrix':
+        if orders is None:
+            orders = load_orders()
+        if orders.empty:
+            return cls(sparse.csr_matrix((0, 0), dtype=np.float32), pd.Index([], name="user_id"),
+                       pd.Index([], name="item_id"))
+        strengths = interaction_strengths(orders)
+        users, items = strengths.index.levels
+        rows, cols = strengths.index.codes
+        matrix = sparse.csr_matrix(
+            (strengths.to_numpy(dtype=np.float32), (rows, cols)), shape=(len(users), len(items))
+        )
+        return cls(matrix, users, items)
+
+    @property
+    def shape(self):
+        return self.matrix.shape
+
+    def normalized(self) -> sparse.csr_matrix:
+        """Columns scaled to unit L2 norm, as in ``_cosine_similarity``"""
+        if self._normalized is None:
+            norms = np.sqrt(np.asarray(self.matrix.multiply(self.matrix).sum(axis=0)).ravel()) + 1e-9
+            self._normalized = (self.matrix @ sparse.diags((1.0 / norms).astype(np.float32))).tocsr()
+        return self._normalized
+
+    def similarity(self) -> sparse.csr_matrix:
+        """Sparse items x items cosine similarity (only co-purchased pairs are stored)"""
+        if self._similarity is None:
+            normalized = self.normalized()
+            self._similarity = (normalized.T @ normalized).tocsr().astype(np.float32)
+        return self._similarity
+
+    def user_vector(self, user_id: int) -> np.ndarray | None:
+        row = self._user_rows.get(user_id)
+        if row is None:
+            return None
+        return self.matrix.getrow(row).toarray().ravel()
+
+    def scores_for_user(self, user_id: int) -> pd.Series:
+        weights = self.user_vector(user_id)
+        if weights is None or np.all(weights == 0):
+            return pd.Series(dtype=float)
+        if self._similarity is not None:
+            scores = self._similarity @ weights
+        else:
+            normalized = self.normalized()
+            scores = normalized.T @ (normalized @ weights)
+        # Do not recommend items already consumed heavily
+        scores = np.clip(scores - weights * 0.5, 0, None)
+        return pd.Series(scores.astype(float), index=self.items)
 
 
 def _cosine_similarity(matrix: np.ndarray) -> np.ndarray:
@@ -49,8 +118,106 @@ def item_similarity(mat: pd.DataFrame) -> Tuple[pd.DataFrame, pd.Index, pd.Index
     return pd.DataFrame(sim, index=mat.columns, columns=mat.columns), mat.index, mat.columns
 
 
-def cf_scores_for_user(user_id: int, top_k: int | None = None) -> pd.Series:
-    mat = user_item_matrix()
+class TopKNeighbours:
+    """Per-item K most similar other items, as sorted (index, weight) arrays.
+
+    ``indices[i]`` / ``weights[i]`` hold item ``i``'s neighbours by
+    decreasing similarity, padded with -1 / 0 when it has fewer than K.
+    The self-similarity is kept apart in ``self_weights`` so that with K at
+    least the number of items, :meth:`scores` equals ``similarity @ w``.
+    """
+
+    def __init__(self, indices: np.ndarray, weights: np.ndarray, self_weights: np.ndarray):
+        self.indices = indices
+        self.weights = weights
+        self.self_weights = self_weights
+
+    @property
+    def k(self) -> int:
+        return self.indices.shape[1]
+
+    def __len__(self) -> int:
+        return len(self.indices)
+
+    @classmethod
+    def from_similarity(cls, similarity, k: int) -> 'TopKNeighbours':
+        """Build from a full (sparse or dense) items x items similarity matrix"""
+        sim = sparse.coo_matrix(similarity)
+        n = sim.shape[0]
+        self_weights = np.zeros(n, dtype=np.float32)
+        diag = sim.row == sim.col
+        self_weights[sim.row[diag]] = sim.data[diag]
+
+        row, col, data = sim.row[~diag], sim.col[~diag], sim.data[~diag]
+        keep = data > 0
+        row, col, data = row[keep], col[keep], data[keep]
+        order = np.lexsort((-data, row))
+        row, col, data = row[order], col[order], data[order]
+        starts = np.searchsorted(row, np.arange(n))
+        rank = np.arange(len(row)) - starts[row]
+        keep = rank < k
+
+        indices = np.full((n, k), -1, dtype=np.int32)
+        weights = np.zeros((n, k), dtype=np.float32)
+        indices[row[keep], rank[keep]] = col[keep]
+        weights[row[keep], rank[keep]] = data[keep]
+        return cls(indices, weights, self_weights)
+
+    def scores(self, user_weights: np.ndarray) -> np.ndarray:
+        """Spread each consumed item's weight over its neighbours"""
+        n = len(user_weights)
+        scores = np.zeros(n)
+        consumed = np.flatnonzero(user_weights[:len(self)])
+        if not len(consumed):
+            return scores
+        w = user_weights[consumed]
+        scores[consumed] += w * self.self_weights[consumed]
+        neighbours = self.indices[consumed]
+        valid = neighbours >= 0
+        np.add.at(scores, neighbours[valid], (w[:, None] * self.weights[consumed])[valid])
+        return scores
+
+    def as_matrix(self, n: int | None = None) -> sparse.csr_matrix:
+        """Truncated similarity as a sparse matrix; ``W @ m`` scores a batch of user rows"""
+        n = n or len(self)
+        rows = np.repeat(np.arange(len(self)), self.k)
+        cols, values = self.indices.ravel(), self.weights.ravel()
+        valid = cols >= 0
+        diag = np.arange(len(self))
+        matrix = sparse.csr_matrix(
+            (np.concatenate([values[valid], self.self_weights]),
+             (np.concatenate([rows[valid], diag]), np.concatenate([cols[valid], diag]))),
+            shape=(n, n)
+        )
+        return matrix
+
+    def nbytes(self) -> int:
+        return self.indices.nbytes + self.weights.nbytes + self.self_weights.nbytes
+
+
+def cf_neighbours() -> int | None:
+    """``RECOMMENDER["CF_NEIGHBOURS"]``: neighbours kept per item, None/0 for the full similarity"""
+    return recommender_setting("CF_NEIGHBOURS", 30) or None
+
+
+def cf_backend() -> str:
+    """``RECOMMENDER["CF_BACKEND"]``: ``"sparse"`` (default) or ``"dense"``"""
+    return recommender_setting("CF_BACKEND", "sparse")
+
+
+def cf_scores_for_user(user_id: int, top_k: int | None = None, orders: pd.DataFrame | None = None) -> pd.Series:
+    """CF scores for one user; served by the shared CF model unless ``orders`` is given"""
+    if cf_backend() == "sparse":
+        if orders is None:
+            from .cf_model import get_cf_model
+            scores = get_cf_model().scores_for_user(user_id)
+        else:
+            scores = SparseUserItemMatrix.from_orders(orders).scores_for_user(user_id)
+        if top_k and not scores.empty:
+            scores = scores.nlargest(top_k)
+        return scores
+
+    mat = user_item_matrix(orders)
     if user_id not in mat.index:
         return pd.Series(dtype=float)
 
@@ -72,25 +239,63 @@ def cf_scores_for_user(user_id: int, top_k: int | None = None) -> pd.Series:
     return scores
 
 
+def cf_scores_for_users(user_ids=None, chunk_size: int | None = None) -> pd.DataFrame:
+    """CF scores for many users (all known users by default) as a users x items frame.
+
+    Scores are computed ``chunk_size`` users at a time with one matrix
+    multiply per chunk, with the same already-consumed penalty and clipping
+    as :func:`cf_scores_for_user`. Unknown users are left out.
+    """
+    chunk_size = chunk_size or recommender_setting("CF_BATCH_CHUNK_SIZE", 2048)
+    if cf_backend() == "sparse":
+        from .cf_model import get_cf_model
+        model = get_cf_model()
+        chunks = [pd.DataFrame(scores, index=pd.Index(users, name="user_id"), columns=items)
+                  for users, items, scores in model.iter_scores(user_ids, chunk_size)]
+    else:
+        mat = user_item_matrix()
+        sim, _, _ = item_similarity(mat)
+        if user_ids is not None:
+            mat = mat.loc[mat.index.intersection(pd.Index(user_ids), sort=False)]
+        chunks = []
+        for start in range(0, len(mat), chunk_size):
+            weights = mat.iloc[start:start + chunk_size]
+            scores = np.clip(weights.values @ sim.values - weights.values * 0.5, 0, None)
+            chunks.append(pd.DataFrame(scores, index=weights.index, columns=mat.columns))
+    if not chunks:
+        return pd.DataFrame(dtype=float)
+    return pd.concat(chunks)
+
+
 class CollaborativeFiltering:
     """Wrapper class for collaborative filtering functions"""
     
     def __init__(self, orders, order_items):
         self.orders = orders
         self.order_items = order_items
-        self.matrix = user_item_matrix()
-        self.similarity_matrix, _, self.items = item_similarity(self.matrix)
+        if cf_backend() == "sparse":
+            from .cf_model import get_cf_model
+            self.model = get_cf_model()
+            self.matrix = None
+            self.similarity_matrix, self.items = self.model.similarity(), pd.Index(self.model.item_ids)
+        else:
+            self.model = None
+            self.matrix = user_item_matrix()
+            self.similarity_matrix, _, self.items = item_similarity(self.matrix)
     
     def recommend_collaborative(self, user_id: int, k: int = 5) -> pd.Series:
         """Generate recommendations for a user"""
         try:
-            # Use existing cf_scores_for_user function
-            scores = cf_scores_for_user(user_id, top_k=k)
-            return scores
+            if self.model is not None:
+                scores = self.model.scores_for_user(user_id)
+            elif user_id in self.matrix.index:
+                user_vector = self.matrix.loc[user_id]
+                scores = pd.Series(self.similarity_matrix.values @ user_vector.values, index=self.items)
+                scores = (scores - user_vector * 0.5).clip(lower=0)
+            else:
+                scores = pd.Series(dtype=float)
+            return scores.nlargest(k) if not scores.empty else scores
             
         except Exception as e:
             print(f"Error generating recommendations for user {user_id}: {e}")
             return pd.Series()
-
-
-
@@ -0,0 +1,137 @@
+"""
+Per-user favourite items: each user's order-line counts per item, min-max
+normalized within the user (most ordered item ~1, least ordered 0)
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.data_loader import load_orders, recommender_setting
+
+logger = logging.getLogger(__name__)
+
+
+def _line_counts(orders: pd.DataFrame) -> pd.Series:
+    """Order lines per (user_id, item_id), sorted by user"""
+    if orders.empty:
+        return pd.Series(dtype=np.int64, index=pd.MultiIndex.from_arrays([[], []], names=["user_id", "item_id"]))
+    return orders.groupby(["user_id", "item_id"]).size()
+
+
+def _normalize(counts: pd.Series) -> pd.Series:
+    """Min-max normalize (user_id, item_id) counts within each user"""
+    by_user = counts.groupby(level=0)
+    low, high = by_user.transform("min"), by_user.transform("max")
+    return (counts - low) / (high - low + 1e-6)
+
+
+def user_favorites(orders: pd.DataFrame) -> pd.Series:
+    """Favourite score per (user_id, item_id) for every user, in one grouped pass"""
+    return _normalize(_line_counts(orders))
+
+
+def favorites_for_user(user_orders: pd.DataFrame) -> pd.Series:
+    """Favourite score per item_id from one user's own order lines"""
+    if user_orders.empty:
+        return pd.Series(dtype=float)
+    counts = user_orders["item_id"].value_counts()
+    return (counts - counts.min()) / (counts.max() - counts.min() + 1e-6)
+
+
+class FavoritesEngine:
+    """Favourites for all users, cached and looked up per user by position.
+
+    Also an order-snapshot listener: ``reset(lines)`` recounts and
+    ``apply(added, removed)`` adjusts the counts; the normalized scores are
+    recomputed in one pass on the next read.
+    """
+
+    def __init__(self, orders: pd.DataFrame | None = None):
+        self._lock = threading.RLock()
+        self.reset(orders if orders is not None else pd.DataFrame())
+
+    def reset(self, lines: pd.DataFrame):
+        counts = _line_counts(lines)
+        with self._lock:
+            self._counts = counts
+            self._favorites = None
+            self.updates = 0
+
+    def apply(self, added: pd.DataFrame, removed: pd.DataFrame):
+        changes = [_line_counts(added)] if not added.empty else []
+        if not removed.empty:
+            changes.append(-_line_counts(removed))
+        if not changes:
+            return
+        with self._lock:
+            counts = pd.concat([self._counts, *changes]).groupby(level=[0, 1]).sum()
+            self._counts = counts[counts > 0]
+            self._favorites = None
+            self.updates += 1
+
+    def favorites(self) -> pd.Series:
+        """Favourite score per (user_id, item_id), sorted by user"""
+        with self._lock:
+            if self._favorites is None:
+                favorites = _normalize(self._counts)
+                self._users = favorites.index.get_level_values(0).to_numpy()
+                self._items = favorites.index.get_level_values(1).to_numpy()
+                self._favorites = favorites
+            return self._favorites
+
+    def for_user(self, user_id: int) -> pd.Series:
+        """Favourite score per item_id for one user (empty when unknown)"""
+        with self._lock:
+            favorites = self.favorites()
+            start, end = np.searchsorted(self._users, [user_id, user_id + 1])
+            return pd.Series(favorites.to_numpy()[start:end], index=pd.Index(self._items[start:end], name="item_id"))
+
+    def stats(self) -> dict:
+        with self._lock:
+            counts = self._counts
+            return {
+                'users': int(counts.index.get_level_values(0).nunique()),
+                'pairs': len(counts),
+                'updates': self.updates,
+            }
+
+
+_favorites_engine = None
+_favorites_built = None  # build time for in-process engines, None when following the snapshot
+_favorites_lock = threading.Lock()
+
+
+def _is_stale(built) -> bool:
+    if built is None:
+        return False
+    return time.monotonic() - built > recommender_setting('FAVORITES_MAX_AGE_SECONDS', 300)
+
+
+def get_favorites_engine() -> FavoritesEngine:
+    """Process-wide favourites engine.
+
+    With the order snapshot enabled it follows the snapshot incrementally;
+    otherwise it is built from ``load_orders`` and rebuilt after
+    ``FAVORITES_MAX_AGE_SECONDS``.
+    """
+    global _favorites_engine, _favorites_built
+    if _favorites_engine is None or _is_stale(_favorites_built):
+        with _favorites_lock:
+            if _favorites_engine is None or _is_stale(_favorites_built):
+                if recommender_setting('ORDER_SNAPSHOT', False):
+                    from src.order_snapshot import get_order_snapshot
+
+                    engine = FavoritesEngine()
+                    snapshot = get_order_snapshot()
+                    snapshot.refresh()
+                    snapshot.subscribe(engine)
+                    _favorites_engine, _favorites_built = engine, None
+                else:
+                    _favorites_engine, _favorites_built = FavoritesEngine(load_orders()), time.monotonic()
+    return _favorites_engine
@@ -0,0 +1,59 @@
+from __future__ import annotations
+
+import numpy as np
+import pandas as pd
+
+
+def _lower(values: pd.Series, fill: str) -> np.ndarray:
+    return values.fillna(fill).astype(str).str.lower().to_numpy(dtype=object)
+
+
+class ItemFeatures:
+    """Per-item arrays used by the scoring engine, aligned with the items frame rows.
+
+    Built once per items frame so every scoring factor is a mask or a
+    lookup-table gather instead of a per-row Python callback.
+    """
+
+    def __init__(self, items: pd.DataFrame):
+        self.n = len(items)
+        self.item_ids = items["item_id"].to_numpy()
+        self.price = pd.to_numeric(items["price"], errors="coerce").to_numpy(dtype=float) \
+            if "price" in items.columns else None
+
+        # Dietary tags as (row position, lower-cased tag) pairs; non-list cells have no tags
+        tags = items["dietary_tags"] if "dietary_tags" in items.columns else pd.Series([[]] * self.n)
+        tags = pd.Series(
+            [t if isinstance(t, list) else [] for t in tags], dtype=object
+        ).explode().dropna()
+        self.tag_rows = tags.index.to_numpy(dtype=np.int64)
+        self.tag_values = tags.astype(str).str.lower().to_numpy(dtype=object)
+
+        self.time_preference = items["time_preference"].fillna("any").to_numpy(dtype=object)
+        self.seasonal = items["seasonal"].fillna("all").to_numpy(dtype=object) \
+            if "seasonal" in items.columns else None
+
+        budget = pd.Categorical(_lower(items["budget_category"], "mid"))
+        self.budget_codes = budget.codes
+        self.budget_categories = list(budget.categories)
+
+        category = pd.Categorical(items["category"].astype(str).str.lower())
+        self.category_codes = category.codes
+        self.category_categories = list(category.categories)
+
+    def has_any_tag(self, tags) -> np.ndarray:
+        """Rows whose dietary tags contain any of ``tags`` (lower-case)"""
+        mask = np.zeros(self.n, dtype=bool)
+        if len(self.tag_values) and tags:
+            mask[self.tag_rows[np.isin(self.tag_values, list(tags))]] = True
+        return mask
+
+    def budget_lookup(self, table: dict, default: float = 1.0) -> np.ndarray:
+        """Gather ``table[budget_category]`` for every row"""
+        values = np.array([table.get(c, default) for c in self.budget_categories] + [default])
+        return values[self.budget_codes]
+
+    def category_lookup(self, table: dict, default: float = 1.0) -> np.ndarray:
+        """Gather ``table[category]`` for every row"""
+        values = np.array([table.get(c, default) for c in self.category_categories] + [default])
+        return values[self.category_codes]
@@ -1,11 +1,15 @@
 from __future__ import annotations
 
-import math
+import numpy as np
 import pandas as pd
-from typing import List, Dict
-from src.data_loader import load_all
+from src.data_loader import load_all, recommender_setting
 from .contextual import Context
-from .collaborative import cf_scores_for_user
+from .features import ItemFeatures
+from .favorites import FavoritesEngine, favorites_for_user, get_favorites_engine, user_favorites
+from .popularity import get_decayed_popularity
+from .recent import get_recent_purchases
+from .rerank import PairwiseSimilarity, cf_pairwise_similarity, rerank
+from .collaborative import cf_scores_for_user, cf_scores_for_users
 from src.utils import season_of
 import logging
 
@@ -18,251 +22,205 @@ def compute_user_favorites(orders: pd.DataFrame) -> pd.Series:
         return pd.Series(dtype=float)
     
     try:
-        return orders.groupby(["user_id", "item_id"]).size().groupby(level=0).apply(
-            lambda s: (s - s.min()) / (s.max() - s.min() + 1e-6)
-        )
+        return user_favorites(orders)
     except Exception as e:
         logger.error(f"Error computing user favorites: {e}")
         return pd.Series(dtype=float)
 
 
-def score_items(user_id: int, ctx: Context, users: pd.DataFrame, items: pd.DataFrame, orders: pd.DataFrame) -> pd.DataFrame:
-    """Score items with comprehensive validation and error handling"""
-    ctx.ensure()
+VEGETARIAN_DIETS = ("végétarien", "vegetarian")
+NO_RESTRICTION_DIETS = ("aucun", "none", "no")
+MEAT_TAGS = ("meat", "chicken", "beef", "pork")
+NON_VEGAN_TAGS = ("meat", "chicken", "beef", "pork", "dairy", "cheese", "milk", "egg")
 
-    if items.empty:
-        logger.warning("No items available for scoring")
-        return pd.DataFrame()
+BUDGET_MULTIPLIERS = {
+    "low": {"low": 1.2, "mid": 1.0, "high": 0.8},
+    "medium": {"low": 1.1, "mid": 1.1, "high": 0.95},
+    "high": {"low": 0.9, "mid": 1.0, "high": 1.2},
+}
 
-    # Validate user exists
+# Favorite cuisines mapped onto the item categories they boost
+CUISINE_CATEGORY_BOOSTS = {
+    "italienne": {"pizza": 1.3, "pasta": 1.2, "dessert": 1.1},
+    "italian": {"pizza": 1.3, "pasta": 1.2, "dessert": 1.1},
+    "algérienne": {"pizza": 1.2, "dessert": 1.1, "cold drink": 1.1},
+    "algerian": {"pizza": 1.2, "dessert": 1.1, "cold drink": 1.1},
+    "végétarienne": {"pizza": 1.2, "dessert": 1.1, "salad": 1.3},
+    "vegetarian": {"pizza": 1.2, "dessert": 1.1, "salad": 1.3},
+}
+
+
+def _user_profile(user_id: int, users: pd.DataFrame) -> tuple[dict, bool]:
     user_exists = not users.empty and user_id in users['user_id'].values
     if not user_exists:
         logger.warning(f"User {user_id} not found in database. Using default preferences.")
-        user = {
-            "diet": "none", 
+        return {
+            "diet": "none",
             "budget_sensitivity": "medium",
             "favorite_categories": [],
             "allergies": [],
             "time_preferences": []
-        }
-    else:
-        user_row = users.loc[users.user_id == user_id].iloc[0]
-        user = {
-            "diet": user_row.get("diet", "none"),
-            "budget_sensitivity": user_row.get("budget_sensitivity", "medium"),
-            "favorite_categories": user_row.get("favorite_categories", []),
-            "allergies": user_row.get("allergies", []),
-            "time_preferences": user_row.get("time_preferences", [])
-        }
+        }, False
+    user_row = users.loc[users.user_id == user_id].iloc[0]
+    return {
+        "diet": user_row.get("diet", "none"),
+        "budget_sensitivity": user_row.get("budget_sensitivity", "medium"),
+        "favorite_categories": user_row.get("favorite_categories", []),
+        "allergies": user_row.get("allergies", []),
+        "time_preferences": user_row.get("time_preferences", [])
+    }, True
 
-    # Base score: recency-decayed popularity
+
+def _popularity(ctx: Context, orders: pd.DataFrame) -> pd.Series | None:
+    """Recency-decayed popularity per item_id, min-max normalized (None: use 0.5)"""
     if orders.empty:
         logger.warning("No orders available for popularity calculation. Using default scores.")
-        popularity = pd.Series(0.5, index=items['item_id'])
+        return None
+    try:
+        now = ctx.now if hasattr(ctx.now, 'tz') and ctx.now.tz is not None else pd.Timestamp.now()
+
+        # Handle timezone compatibility
+        orders_ts = orders["timestamp"]
+        if hasattr(now, 'tz') and now.tz is not None:
+            if not hasattr(orders_ts.dtype, 'tz') or orders_ts.dt.tz is None:
+                orders_ts = pd.to_datetime(orders_ts, utc=True)
+        else:
+            if hasattr(orders_ts.dtype, 'tz') and orders_ts.dt.tz is not None:
+                orders_ts = orders_ts.dt.tz_localize(None)
+
+        age_days = (now - orders_ts).dt.days.clip(lower=0)
+        decay = 0.5 ** (age_days / 30.0)  # half-life ~30 days
+        popularity = (0.2 + decay).groupby(orders["item_id"].to_numpy()).sum()
+        if popularity.empty:
+            return None
+        return (popularity - popularity.min()) / (popularity.max() - popularity.min() + 1e-6)
+    except Exception as e:
+        logger.error(f"Error calculating popularity scores: {e}")
+        return None
+
+
+def _diet_multiplier(user: dict, features: ItemFeatures) -> np.ndarray:
+    diet = str(user.get("diet", "none")).lower()
+    if diet in VEGETARIAN_DIETS:
+        blocked = features.has_any_tag(MEAT_TAGS)
+        boosted = features.has_any_tag(("vegetarian", "veggie")) & ~blocked
+        boost = 1.2
+    elif diet == "vegan":
+        blocked = features.has_any_tag(NON_VEGAN_TAGS)
+        boosted = features.has_any_tag(("vegan",)) & ~blocked
+        boost = 1.3
     else:
-        try:
-            now = ctx.now if hasattr(ctx.now, 'tz') and ctx.now.tz is not None else pd.Timestamp.now()
-            
-            # Handle timezone compatibility
-            orders_ts = orders["timestamp"]
-            if hasattr(now, 'tz') and now.tz is not None:
-                if not hasattr(orders_ts.dtype, 'tz') or orders_ts.dt.tz is None:
-                    orders_ts = pd.to_datetime(orders_ts, utc=True)
-            else:
-                if hasattr(orders_ts.dtype, 'tz') and orders_ts.dt.tz is not None:
-                    orders_ts = orders_ts.dt.tz_localize(None)
-            
-            orders = orders.assign(_age_days=(now - orders_ts).dt.days.clip(lower=0))
-            decay = 0.5 ** (orders["_age_days"] / 30.0)  # half-life ~30 days
-            popularity = orders.groupby("item_id").apply(lambda g: (0.2 + decay.loc[g.index]).sum())
-            
-            if not popularity.empty:
-                popularity = (popularity - popularity.min()) / (popularity.max() - popularity.min() + 1e-6)
-            else:
-                popularity = pd.Series(0.5, index=items['item_id'])
-        except Exception as e:
-            logger.error(f"Error calculating popularity scores: {e}")
-            popularity = pd.Series(0.5, index=items['item_id'])
+        # No or unknown dietary restrictions: no filtering
+        return np.ones(features.n)
+
+    # Allergies only veto items the diet rules did not already decide
+    allergies = user.get("allergies", [])
+    allergic = np.zeros(features.n, dtype=bool)
+    if isinstance(allergies, list):
+        allergic = features.has_any_tag({str(a).lower() for a in allergies})
+    return np.where(blocked, 0.0, np.where(boosted, boost, np.where(allergic, 0.0, 1.0)))
+
+
+def _category_boosts(favorite_categories) -> dict:
+    category_boosts = {}
+    for fc in favorite_categories:
+        fc_lower = str(fc).lower()
+        # Generic boost for any category match
+        category_boosts.update(CUISINE_CATEGORY_BOOSTS.get(fc_lower, {fc_lower: 1.2}))
+    return category_boosts
+
+
+def score_items(user_id: int, ctx: Context, users: pd.DataFrame, items: pd.DataFrame, orders: pd.DataFrame,
+                features: ItemFeatures | None = None, favorites: pd.Series | None = None,
+                popularity: pd.Series | None = None, recent_items: list | None = None) -> pd.DataFrame:
+    """Score items with comprehensive validation and error handling
+
+    Every factor is computed for the whole menu at once from ``features``
+    (built from ``items`` when not given), so callers scoring several users
+    against the same items can build it once. ``favorites`` (item_id ->
+    score, e.g. from ``FavoritesEngine.for_user``) skips recounting the
+    user's order lines, and ``popularity`` (normalized, item_id -> score,
+    e.g. from ``DecayedPopularity.normalized``) skips the decay over ``orders``.
+    ``recent_items`` (e.g. from ``RecentPurchases.recent_items``) replaces
+    sorting the user's lines for the recent-purchase penalty.
+    """
+    ctx.ensure()
+
+    if items.empty:
+        logger.warning("No items available for scoring")
+        return pd.DataFrame()
+
+    user, user_exists = _user_profile(user_id, users)
+    features = features or ItemFeatures(items)
+    n = features.n
 
     df = items.copy()
-    # Ensure popularity is a proper Series with correct index
-    if isinstance(popularity, pd.Series):
-        # Convert to dict to avoid pandas map issues
-        popularity_dict = popularity.to_dict()
-        df["base"] = df["item_id"].map(popularity_dict).fillna(0.2)
+
+    # Base score: recency-decayed popularity
+    if popularity is None:
+        popularity = _popularity(ctx, orders)
+    if popularity is None:
+        df["base"] = 0.5
     else:
-        df["base"] = 0.2
+        df["base"] = popularity.reindex(features.item_ids).fillna(0.2).to_numpy()
 
-    # Diet filter/boost - IMPROVED
-    diet = str(user.get("diet", "none")).lower()
-    def diet_ok(tags: List[str]) -> float:
-        if not isinstance(tags, list):
-            tags = []
-        tags = set(str(tag).lower() for tag in tags)
-        
-        # Handle different diet types from the database
-        if diet in ["végétarien", "vegetarian"]:
-            if "meat" in tags or "chicken" in tags or "beef" in tags or "pork" in tags:
-                return 0.0
-            # Boost vegetarian items
-            if "vegetarian" in tags or "veggie" in tags:
-                return 1.2
-        elif diet in ["vegan"]:
-            if any(t in tags for t in ["meat", "chicken", "beef", "pork", "dairy", "cheese", "milk", "egg"]):
-                return 0.0
-            # Boost vegan items
-            if "vegan" in tags:
-                return 1.3
-        elif diet in ["aucun", "none", "no"]:
-            # No dietary restrictions - slight boost for all items
-            return 1.0
-        else:
-            # Unknown diet - no filtering
-            return 1.0
-        
-        # Check for user allergies
-        allergies = user.get("allergies", [])
-        if isinstance(allergies, list):
-            allergy_set = set(str(a).lower() for a in allergies)
-            if any(allergy in tags for allergy in allergy_set):
-                return 0.0
-        
-        return 1.0
-
-    # Handle dietary_tags properly - ensure it's a list
-    def safe_diet_ok(tags):
-        try:
-            if tags is None or (hasattr(tags, '__len__') and len(tags) == 0):
-                return diet_ok([])
-            if isinstance(tags, list):
-                return diet_ok(tags)
-            return diet_ok([])
-        except Exception:
-            return diet_ok([])
-    
-    df["diet_multiplier"] = df["dietary_tags"].apply(safe_diet_ok)
+    # Diet filter/boost
+    df["diet_multiplier"] = _diet_multiplier(user, features)
 
     # Time-of-day boosts
-    df["time_multiplier"] = (df["time_preference"].fillna("any").apply(
-        lambda t: 1.2 if t == ctx.time_of_day else (1.05 if t in ["any", "all"] else 1.0)
-    ))
+    df["time_multiplier"] = np.where(
+        features.time_preference == ctx.time_of_day, 1.2,
+        np.where(np.isin(features.time_preference, ["any", "all"]), 1.05, 1.0)
+    )
 
     # Seasonality boost
-    current_season = season_of(ctx.now)
-    if "seasonal" in df.columns:
-        df["season_multiplier"] = df["seasonal"].fillna("all").apply(
-            lambda s: 1.15 if s == current_season or s in ["all", "any"] else 1.0
+    if features.seasonal is not None:
+        current_season = season_of(ctx.now)
+        df["season_multiplier"] = np.where(
+            (features.seasonal == current_season) | np.isin(features.seasonal, ["all", "any"]), 1.15, 1.0
         )
     else:
         df["season_multiplier"] = 1.0
 
     # Budget sensitivity
-    budget = ctx.budget_level or str(user.get("budget_sensitivity", "medium"))
-    def budget_mult(cat: str) -> float:
-        if pd.isna(cat):
-            cat = "mid"
-        cat = str(cat).lower()
-        
-        budget_lower = str(budget).lower()
-        if budget_lower in ["low", "high", "mid", "medium"]:
-            mapping = {
-                "low": {"low": 1.2, "mid": 1.0, "high": 0.8},
-                "medium": {"low": 1.1, "mid": 1.1, "high": 0.95},
-                "mid": {"low": 1.1, "mid": 1.1, "high": 0.95},
-                "high": {"low": 0.9, "mid": 1.0, "high": 1.2},
-            }
-            budget_key = "medium" if budget_lower == "mid" else budget_lower
-            return mapping[budget_key].get(cat, 1.0)
-        return 1.0
-    
-    df["budget_multiplier"] = df["budget_category"].fillna("mid").apply(budget_mult)
+    budget = str(ctx.budget_level or str(user.get("budget_sensitivity", "medium"))).lower()
+    budget = "medium" if budget == "mid" else budget
+    if budget in BUDGET_MULTIPLIERS:
+        df["budget_multiplier"] = features.budget_lookup(BUDGET_MULTIPLIERS[budget])
+    else:
+        df["budget_multiplier"] = 1.0
+
+    mine = orders.loc[orders["user_id"].to_numpy() == user_id] if user_exists and not orders.empty else None
 
     # User favorites from orders
-    try:
-        if orders.empty or not user_exists:
-            df["favorite_boost"] = 1.0
-        else:
-            fav_series = compute_user_favorites(orders)
-            if user_id in fav_series.index.get_level_values(0):
-                user_favs = fav_series.xs(user_id, level=0)
-                if isinstance(user_favs, pd.Series):
-                    # Convert to dict to avoid pandas map issues
-                    user_favs_dict = user_favs.to_dict()
-                    df["favorite_boost"] = df["item_id"].map(user_favs_dict).fillna(0.0) * 0.6 + 1.0
-                else:
-                    df["favorite_boost"] = 1.0
-            else:
-                df["favorite_boost"] = 1.0
-    except (KeyError, IndexError, Exception) as e:
-        logger.warning(f"Error calculating favorite boost: {e}")
-        df["favorite_boost"] = 1.0
+    df["favorite_boost"] = 1.0
+    if favorites is None and mine is not None:
+        favorites = favorites_for_user(mine)
+    if user_exists and favorites is not None and not favorites.empty:
+        df["favorite_boost"] = favorites.reindex(features.item_ids).fillna(0.0).to_numpy() * 0.6 + 1.0
 
     # Price alignment to user's historical spend
-    try:
-        if orders.empty or not user_exists:
-            df["price_align"] = 1.0
-        else:
-            user_spend = orders.loc[orders.user_id == user_id]
-            if not user_spend.empty and "price" in df.columns:
-                # Join with items to get prices
-                joined = user_spend.merge(df[["item_id", "price"]], on="item_id", how="left")
-                price_col = "price_y" if "price_y" in joined.columns else "price"
-                
-                if price_col in joined.columns:
-                    valid_prices = joined[price_col].dropna()
-                    if not valid_prices.empty:
-                        target = valid_prices.mean()
-                        df["price_align"] = (1.0 - (df["price"] - target).abs() / (target + 1e-6)).clip(0.8, 1.2)
-                    else:
-                        df["price_align"] = 1.0
-                else:
-                    df["price_align"] = 1.0
-            else:
-                df["price_align"] = 1.0
-    except Exception as e:
-        logger.warning(f"Error calculating price alignment: {e}")
-        df["price_align"] = 1.0
+    df["price_align"] = 1.0
+    if mine is not None and not mine.empty and features.price is not None:
+        item_price = pd.Series(features.price, index=features.item_ids)
+        item_price = item_price[~item_price.index.duplicated()]
+        valid_prices = mine["item_id"].map(item_price).dropna()
+        if not valid_prices.empty:
+            target = valid_prices.mean()
+            df["price_align"] = np.clip(1.0 - np.abs(features.price - target) / (target + 1e-6), 0.8, 1.2)
 
-    # Recent-purchase penalty
-    try:
-        if orders.empty or not user_exists:
-            df["recent_penalty"] = 1.0
-        else:
-            recent = orders.sort_values("timestamp").groupby("user_id").tail(3)
-            recent_ids = set(recent.loc[recent.user_id == user_id, "item_id"].tolist())
-            df["recent_penalty"] = df["item_id"].apply(lambda x: 0.85 if x in recent_ids else 1.0)
-    except Exception as e:
-        logger.warning(f"Error calculating recent penalty: {e}")
-        df["recent_penalty"] = 1.0
+    # Recent-purchase penalty: the user's last three order lines
+    df["recent_penalty"] = 1.0
+    if recent_items is None and mine is not None and not mine.empty:
+        recent_items = mine.sort_values("timestamp", kind="stable")["item_id"].tail(3).to_numpy()
+    if user_exists and recent_items is not None and len(recent_items):
+        df["recent_penalty"] = np.where(np.isin(features.item_ids, recent_items), 0.85, 1.0)
 
-    # Category preference boost - IMPROVED
-    try:
-        favorite_categories = user.get("favorite_categories", [])
-        if isinstance(favorite_categories, list) and favorite_categories:
-            # Create a mapping of category names to boost values
-            category_boosts = {}
-            for fc in favorite_categories:
-                fc_lower = str(fc).lower()
-                # Map different category names to actual item categories
-                if fc_lower in ['italienne', 'italian']:
-                    category_boosts.update({'pizza': 1.3, 'pasta': 1.2, 'dessert': 1.1})
-                elif fc_lower in ['algérienne', 'algerian']:
-                    category_boosts.update({'pizza': 1.2, 'dessert': 1.1, 'cold drink': 1.1})
-                elif fc_lower in ['végétarienne', 'vegetarian']:
-                    category_boosts.update({'pizza': 1.2, 'dessert': 1.1, 'salad': 1.3})
-                else:
-                    # Generic boost for any category match
-                    category_boosts[fc_lower] = 1.2
-            
-            def get_category_boost(cat):
-                cat_lower = str(cat).lower()
-                return category_boosts.get(cat_lower, 1.0)
-            
-            df["category_boost"] = df["category"].apply(get_category_boost)
-        else:
-            df["category_boost"] = 1.0
-    except Exception as e:
-        logger.warning(f"Error calculating category boost: {e}")
+    # Category preference boost
+    favorite_categories = user.get("favorite_categories", [])
+    if isinstance(favorite_categories, list) and favorite_categories:
+        df["category_boost"] = features.category_lookup(_category_boosts(favorite_categories))
+    else:
         df["category_boost"] = 1.0
 
     # Final score (content/context)
@@ -277,101 +235,200 @@ def score_items(user_id: int, ctx: Context, users: pd.DataFrame, items: pd.DataF
         * df["recent_penalty"]
         * df["category_boost"]
     )
-    
+
     # Add small randomization to break ties and provide variety
-    import numpy as np
-    np.random.seed(user_id)  # Consistent randomization per user
-    df["tie_breaker"] = np.random.uniform(0.95, 1.05, len(df))
+    rng = np.random.RandomState(user_id)  # Consistent randomization per user
+    df["tie_breaker"] = rng.uniform(0.95, 1.05, n)
     df["final_score"] = df["score"] * df["tie_breaker"]
-    
+
     return df.sort_values("final_score", ascending=False)
 
 
-def recommend_hybrid(user_id: int, top_k: int = 10, ctx: Context | None = None) -> pd.DataFrame:
-    """Generate hybrid recommendations with comprehensive error handling and validation"""
+def cf_scores(user_id: int, orders: pd.DataFrame) -> pd.Series:
+    """CF scores from the source picked by ``RECOMMENDER["CF_SOURCE"]``: ``"item_cf"`` or ``"als"``"""
+    if recommender_setting("CF_SOURCE", "item_cf") == "als":
+        from .als import get_als_model
+        # Fold the user in from their current orders so recent orders count without retraining
+        return get_als_model().scores_for_user(user_id, orders.loc[orders["user_id"] == user_id])
+    return cf_scores_for_user(user_id)
+
+
+def recommend_hybrid(user_id: int, top_k: int = 10, ctx: Context | None = None,
+                     data: tuple | None = None) -> pd.DataFrame:
+    """Generate hybrid recommendations with comprehensive error handling and validation
+
+    ``data`` is the ``load_all(user_id=user_id)`` result when the caller
+    has already loaded it.
+    """
     logger.info(f"Generating recommendations for user_id: {user_id}, top_k: {top_k}")
     
     try:
         # Load data with validation
-        users, items, orders = load_all(user_id=user_id)
-        
-        # Check if we have data
-        if items.empty:
-            logger.warning("No items available in database")
-            return _create_empty_recommendation_df()
-        
-        # Create context
-        ctx = ctx or Context(user_id=user_id, now=pd.Timestamp.now()).ensure()
-        
-        # Validate user exists
-        user_exists = not users.empty and user_id in users['user_id'].values
-        if not user_exists:
-            logger.warning(f"User {user_id} not found in database. Generating content-based recommendations.")
-        
-        # Score items using content-based approach
-        content_scored = score_items(user_id, ctx, users, items, orders)
-        
-        if content_scored.empty:
-            logger.warning("No items could be scored")
-            return _create_empty_recommendation_df()
-
-        # Collaborative filtering scores
-        try:
-            if user_exists and not orders.empty:
-                cf = cf_scores_for_user(user_id)
-                if not cf.empty and isinstance(cf, pd.Series):
-                    # Normalize CF to 0..1
-                    cf_norm = (cf - cf.min()) / (cf.max() - cf.min() + 1e-6)
-                    # Convert to dict to avoid pandas map issues
-                    cf_norm_dict = cf_norm.to_dict()
-                    content_scored["cf_score"] = content_scored["item_id"].map(cf_norm_dict).fillna(0.0)
-                else:
-                    content_scored["cf_score"] = 0.0
+        users, items, orders = data if data is not None else load_all(user_id=user_id)
+        return rank_hybrid(user_id, top_k, ctx, users, items, orders)
+    except Exception as e:
+        logger.error(f"Error in recommend_hybrid: {e}")
+        return _create_empty_recommendation_df()
+
+
+def rank_hybrid(user_id: int, top_k: int, ctx: Context | None, users: pd.DataFrame, items: pd.DataFrame,
+                orders: pd.DataFrame, features: ItemFeatures | None = None, cf: pd.Series | None = None,
+                popularity: pd.Series | None = None, favorites: FavoritesEngine | None = None,
+                similarity: PairwiseSimilarity | None = None) -> pd.DataFrame:
+    """Hybrid recommendations from already loaded data; raises on failure.
+
+    ``orders`` holds the lines ``load_all(user_id=user_id)`` would load, i.e.
+    the user's own. ``features``, ``cf`` (raw CF scores, item_id -> score),
+    ``popularity``, ``favorites`` (an engine covering the user) and
+    ``similarity`` (the MMR item similarity, see ``cf_pairwise_similarity``)
+    let batch callers compute them once or in bulk; left as None they are
+    computed here.
+    """
+    # Check if we have data
+    if items.empty:
+        logger.warning("No items available in database")
+        return _create_empty_recommendation_df()
+    
+    # Create context
+    ctx = ctx or Context(user_id=user_id, now=pd.Timestamp.now()).ensure()
+    
+    # Validate user exists
+    user_exists = not users.empty and user_id in users['user_id'].values
+    if not user_exists:
+        logger.warning(f"User {user_id} not found in database. Generating content-based recommendations.")
+    
+    # Score items using content-based approach
+    if popularity is None and recommender_setting("POPULARITY_SOURCE", "orders") == "state":
+        popularity = get_decayed_popularity().normalized(now=ctx.now)
+    recent_items = None
+    if recommender_setting("ORDER_SNAPSHOT", False):
+        # The snapshot keeps the recent-purchase buffers and favourites current
+        recent_items = get_recent_purchases().recent_items(user_id, 3)
+        if favorites is None:
+            favorites = get_favorites_engine()
+    content_scored = score_items(user_id, ctx, users, items, orders, features=features,
+                                 favorites=favorites.for_user(user_id) if favorites is not None else None,
+                                 popularity=popularity, recent_items=recent_items)
+    
+    if content_scored.empty:
+        logger.warning("No items could be scored")
+        return _create_empty_recommendation_df()
+
+    # Collaborative filtering scores
+    try:
+        if user_exists and not orders.empty:
+            if cf is None:
+                cf = cf_scores(user_id, orders)
+            if not cf.empty and isinstance(cf, pd.Series):
+                # Normalize CF to 0..1
+                cf_norm = (cf - cf.min()) / (cf.max() - cf.min() + 1e-6)
+                # Convert to dict to avoid pandas map issues
+                cf_norm_dict = cf_norm.to_dict()
+                content_scored["cf_score"] = content_scored["item_id"].map(cf_norm_dict).fillna(0.0)
             else:
                 content_scored["cf_score"] = 0.0
-        except Exception as e:
-            logger.warning(f"Collaborative filtering failed: {e}. Using content-based only.")
+        else:
             content_scored["cf_score"] = 0.0
-
-        # Hybrid combine: weighted geometric mean with content/context dominant
-        content_scored["hybrid_score"] = (
-            (content_scored["score"] + 1e-6) ** 0.7 * (content_scored["cf_score"] + 1e-6) ** 0.3
-        )
-        scored = content_scored.sort_values("hybrid_score", ascending=False)
-
-        # Simple diversity re-ranking: limit top-N per category
-        max_per_category = max(1, top_k // 3)
-        seen = {}
-        diversified = []
-        for _, row in scored.iterrows():
-            cat = row.get("category", "unknown")
-            count = seen.get(cat, 0)
-            if count < max_per_category or len(diversified) < top_k:
-                diversified.append(row)
-                seen[cat] = count + 1
-            if len(diversified) >= top_k * 2:  # Limit processing
-                break
-        
-        scored = pd.DataFrame(diversified) if diversified else scored.head(top_k * 2)
-        
-        # Ensure required columns exist and select them
-        required_cols = [
-            "item_id", "name", "category", "subcategory", "price", 
-            "dietary_tags", "time_preference", "budget_category", 
-            "score", "cf_score", "hybrid_score"
-        ]
-        
-        for col in required_cols:
-            if col not in scored.columns:
-                scored[col] = None
-        
-        final_result = scored[required_cols].head(top_k)
-        logger.info(f"Generated {len(final_result)} recommendations for user {user_id}")
-        return final_result
-        
     except Exception as e:
-        logger.error(f"Error in recommend_hybrid: {e}")
-        return _create_empty_recommendation_df()
+        logger.warning(f"Collaborative filtering failed: {e}. Using content-based only.")
+        content_scored["cf_score"] = 0.0
+
+    # Hybrid combine: weighted geometric mean with content/context dominant
+    content_scored["hybrid_score"] = (
+        (content_scored["score"] + 1e-6) ** 0.7 * (content_scored["cf_score"] + 1e-6) ** 0.3
+    )
+    scored = content_scored.sort_values("hybrid_score", ascending=False)
+
+    # Diversity re-ranking (per-category cap or MMR), keeping at most 2 * top_k candidates
+    if similarity is None:
+        similarity = cf_pairwise_similarity()
+    scored = rerank(scored, top_k, "hybrid_score", limit=top_k * 2, similarity=similarity)
+    
+    # Ensure required columns exist and select them
+    required_cols = [
+        "item_id", "name", "category", "subcategory", "price", 
+        "dietary_tags", "time_preference", "budget_category", 
+        "score", "cf_score", "hybrid_score"
+    ]
+    
+    for col in required_cols:
+        if col not in scored.columns:
+            scored[col] = None
+    
+    final_result = scored[required_cols].head(top_k)
+    logger.info(f"Generated {len(final_result)} recommendations for user {user_id}")
+    return final_result
+
+
+def _batch_cf_scores(user_ids: list, orders_by_user: dict) -> dict:
+    """Raw CF scores per user_id; item CF scores a chunk of users per matrix multiply"""
+    if recommender_setting("CF_SOURCE", "item_cf") == "als":
+        return {}  # folded in per user by rank_hybrid
+    scored = {}
+    known = [u for u in user_ids if u in orders_by_user]
+    chunk_size = recommender_setting("CF_BATCH_CHUNK_SIZE", 2048)
+    for start in range(0, len(known), chunk_size):
+        chunk = known[start:start + chunk_size]
+        try:
+            frame = cf_scores_for_users(chunk, chunk_size)
+        except Exception as e:
+            logger.warning(f"Batch collaborative filtering failed: {e}. Using content-based only.")
+            frame = pd.DataFrame(dtype=float)
+        for user_id in chunk:
+            # Users unknown to the CF model score nothing, as in cf_scores_for_user
+            scored[user_id] = frame.loc[user_id] if user_id in frame.index else pd.Series(dtype=float)
+    return scored
+
+
+def recommend_hybrid_batch(requests: list[tuple], data: tuple | None = None) -> list:
+    """Hybrid recommendations for many ``(user_id, top_k, ctx)`` requests at once.
+
+    Users, items and orders are loaded once (or taken from ``data``, a
+    ``(users, items, orders)`` tuple holding at least the requested users
+    and their order lines) and the item features built once; item CF scores
+    come from :func:`cf_scores_for_users`. Every user is ranked from their
+    own order lines, as :func:`recommend_hybrid` would. Returns one entry per
+    request, in order: the recommendations frame, or the exception that
+    ranking that user raised.
+    """
+    if not requests:
+        return []
+    users, items, orders = data if data is not None else load_all()
+    features = ItemFeatures(items) if not items.empty else None
+
+    user_ids = list(dict.fromkeys(user_id for user_id, _, _ in requests))
+    empty_orders = orders.iloc[:0]
+    mine = empty_orders
+    orders_by_user = {}
+    if not orders.empty:
+        mine = orders.loc[orders["user_id"].isin(user_ids)]
+        orders_by_user = {user_id: lines for user_id, lines in mine.groupby("user_id", sort=False)}
+    cf_by_user = _batch_cf_scores(user_ids, orders_by_user)
+    favorites = None
+    if not recommender_setting("ORDER_SNAPSHOT", False):
+        # Every requested user's favourites in one grouped pass
+        favorites = FavoritesEngine(mine)
+
+    similarity = cf_pairwise_similarity()
+    state_popularity = {}
+    results = []
+    for user_id, top_k, ctx in requests:
+        try:
+            ctx = ctx or Context(user_id=user_id, now=pd.Timestamp.now()).ensure()
+            popularity = None
+            if recommender_setting("POPULARITY_SOURCE", "orders") == "state":
+                if ctx.now not in state_popularity:
+                    state_popularity[ctx.now] = get_decayed_popularity().normalized(now=ctx.now)
+                popularity = state_popularity[ctx.now]
+            results.append(rank_hybrid(
+                user_id, top_k, ctx, users, items, orders_by_user.get(user_id, empty_orders),
+                features=features, cf=cf_by_user.get(user_id), popularity=popularity, favorites=favorites,
+                similarity=similarity
+            ))
+        except Exception as e:
+            logger.error(f"Error in recommend_hybrid_batch for user {user_id}: {e}")
+            results.append(e)
+    return results
 
 
 def _create_empty_recommendation_df() -> pd.DataFrame:
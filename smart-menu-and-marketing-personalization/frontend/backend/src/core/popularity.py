@@ -1,6 +1,20 @@
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+import threading
+import time
+from pathlib import Path
+
 import pandas as pd
 import numpy as np
-from src.data_loader import load_orders
+from src.data_loader import load_orders, parse_timestamps, recommender_setting
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+SECONDS_PER_DAY = 86400.0
 
 
 class PopularityRecommender:
@@ -40,5 +54,303 @@ def item_popularity() -> pd.Series:
     return orders.groupby("item_id").size().sort_values(ascending=False)
 
 
+def _epoch_seconds(timestamps: pd.Series) -> np.ndarray:
+    """UTC epoch seconds; naive timestamps are taken to be UTC (USE_TZ)"""
+    parsed = parse_timestamps(timestamps)
+    if parsed.dt.tz is None:
+        parsed = parsed.dt.tz_localize('UTC')
+    return parsed.dt.tz_convert('UTC').to_numpy(dtype='datetime64[ns]').view(np.int64) / 1e9
+
+
+def _now_seconds(now=None) -> float:
+    if now is None:
+        return time.time()
+    now = pd.Timestamp(now)
+    return (now.tz_localize('UTC') if now.tz is None else now).timestamp()
+
+
+def newest_line(lines: pd.DataFrame) -> tuple | None:
+    """Watermark ``(epoch seconds, order_id)`` of the newest line in ``lines``, None if there is none"""
+    if lines.empty:
+        return None
+    seconds = _epoch_seconds(lines['timestamp'])
+    valid = ~np.isnan(seconds)
+    if not valid.any():
+        return None
+    seconds, order_ids = seconds[valid], lines['order_id'].to_numpy()[valid]
+    newest = np.lexsort((order_ids, seconds))[-1]
+    return float(seconds[newest]), int(order_ids[newest])
+
+
+def lines_after(lines: pd.DataFrame, watermark: tuple) -> pd.DataFrame:
+    """The lines placed after ``watermark`` (ties on the timestamp broken by order_id)"""
+    seconds, order_id = watermark
+    placed = _epoch_seconds(lines['timestamp'])
+    return lines.loc[(placed > seconds) | ((placed == seconds) & (lines['order_id'].to_numpy() > order_id))]
+
+
+class DecayedPopularity:
+    """Recency-decayed order-line counts per item, per store and overall.
+
+    An item's popularity at time ``t`` is ``0.2 * lines + sum(0.5 ** (age / half_life))``
+    over its order lines, as in ``score_items``. The decayed part is kept as a
+    running sum of ``2 ** ((t_line - epoch) / half_life)``, so adding a line is
+    O(1) and reading all items at ``t`` is one rescale by
+    ``2 ** ((epoch - t) / half_life)``.
+
+    Also an order-snapshot listener (``reset`` / ``apply``). After
+    :meth:`load`, the first ``reset`` only adds lines newer than the saved
+    watermark instead of replaying the whole history.
+    """
+
+    GLOBAL = -1  # scope key of the all-stores counters
+
+    def __init__(self, half_life_days: float | None = None):
+        self.half_life = (half_life_days or recommender_setting('POPULARITY_HALF_LIFE_DAYS', 30)) * SECONDS_PER_DAY
+        self._lock = threading.RLock()
+        self._clear()
+        self._restored = False
+
+    def _clear(self):
+        self.epoch = None
+        self._counts = {}   # scope -> {item_id: order lines}
+        self._weights = {}  # scope -> {item_id: sum of 2 ** ((t - epoch) / half_life)}
+        self.watermark = None  # (epoch seconds, order_id) of the newest line seen
+        self.updates = 0
+
+    # ------------------------------------------------------------------
+    # Updates
+    # ------------------------------------------------------------------
+    def _rebase(self, seconds: float):
+        """Move the epoch forward so the running sums stay well inside float range"""
+        if self.epoch is None:
+            self.epoch = seconds
+            return
+        if (seconds - self.epoch) / self.half_life < 512:
+            return
+        scale = 2.0 ** ((self.epoch - seconds) / self.half_life)
+        for weights in self._weights.values():
+            for item_id in weights:
+                weights[item_id] *= scale
+        self.epoch = seconds
+
+    def _add(self, scope: int, item_id: int, lines: float, weight: float):
+        counts = self._counts.setdefault(scope, {})
+        weights = self._weights.setdefault(scope, {})
+        count = counts.get(item_id, 0) + lines
+        if count <= 0:
+            counts.pop(item_id, None)
+            weights.pop(item_id, None)
+        else:
+            counts[item_id] = count
+            weights[item_id] = max(weights.get(item_id, 0.0) + weight, 0.0)
+
+    def add_line(self, item_id: int, store_id: int, seconds: float, sign: int = 1):
+        """Count (or, with ``sign=-1``, uncount) one order line placed at ``seconds``"""
+        with self._lock:
+            self._rebase(seconds)
+            weight = sign * 2.0 ** ((seconds - self.epoch) / self.half_life)
+            self._add(self.GLOBAL, int(item_id), sign, weight)
+            self._add(int(store_id), int(item_id), sign, weight)
+
+    def _add_lines(self, lines: pd.DataFrame, sign: int):
+        if lines.empty:
+            return
+        seconds = _epoch_seconds(lines['timestamp'])
+        valid = ~np.isnan(seconds)
+        frame = pd.DataFrame({
+            'store_id': lines['store_id'].to_numpy()[valid],
+            'item_id': lines['item_id'].to_numpy()[valid],
+            'seconds': seconds[valid],
+        })
+        if frame.empty:
+            return
+        self._rebase(float(frame['seconds'].max()))
+        frame['weight'] = sign * 2.0 ** ((frame['seconds'] - self.epoch) / self.half_life)
+        frame['lines'] = sign
+        for keys in (['item_id'], ['store_id', 'item_id']):
+            grouped = frame.groupby(keys)[['lines', 'weight']].sum()
+            for key, row_lines, row_weight in zip(grouped.index, grouped['lines'], grouped['weight']):
+                scope, item_id = (self.GLOBAL, key) if len(keys) == 1 else key
+                self._add(int(scope), int(item_id), row_lines, row_weight)
+
+        if sign > 0:
+            mark = newest_line(lines)
+            if self.watermark is None or mark > self.watermark:
+                self.watermark = mark
+
+    def reset(self, lines: pd.DataFrame):
+        with self._lock:
+            if self._restored and self.watermark is not None and not lines.empty:
+                # Restored from disk: only catch up with lines placed after the saved state
+                self._add_lines(lines_after(lines, self.watermark), 1)
+            else:
+                self._clear()
+                self._add_lines(lines, 1)
+            self._restored = False
+            self.updates = 0
+
+    def apply(self, added: pd.DataFrame, removed: pd.DataFrame):
+        with self._lock:
+            self._add_lines(removed, -1)
+            self._add_lines(added, 1)
+            self.updates += 1
+            self._maybe_save()
+
+    def _maybe_save(self):
+        path = recommender_setting('POPULARITY_STATE_PATH')
+        interval = recommender_setting('POPULARITY_SAVE_SECONDS', 300)
+        if path and time.monotonic() - getattr(self, '_last_save', 0.0) >= interval:
+            try:
+                self.save(path)
+            except Exception as e:
+                logger.error(f"Could not save popularity state to {path}: {e}")
+            self._last_save = time.monotonic()
+
+    # ------------------------------------------------------------------
+    # Reads
+    # ------------------------------------------------------------------
+    def scores(self, store_id: int | None = None, now=None) -> pd.Series:
+        """Decayed popularity per item_id at ``now`` (default: the current time)"""
+        scope = self.GLOBAL if store_id is None else int(store_id)
+        with self._lock:
+            counts = self._counts.get(scope)
+            if not counts:
+                return pd.Series(dtype=float)
+            items = np.fromiter(counts.keys(), dtype=np.int64, count=len(counts))
+            lines = np.fromiter(counts.values(), dtype=float, count=len(counts))
+            weights = np.fromiter((self._weights[scope][i] for i in counts), dtype=float, count=len(counts))
+            scale = 2.0 ** ((self.epoch - _now_seconds(now)) / self.half_life)
+        return pd.Series(0.2 * lines + weights * scale, index=pd.Index(items, name="item_id"))
+
+    def normalized(self, store_id: int | None = None, now=None) -> pd.Series | None:
+        """:meth:`scores` min-max normalized, as used by ``score_items`` (None when empty)"""
+        popularity = self.scores(store_id, now)
+        if popularity.empty:
+            return None
+        return (popularity - popularity.min()) / (popularity.max() - popularity.min() + 1e-6)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'items': len(self._counts.get(self.GLOBAL, {})),
+                'stores': len(self._counts) - (self.GLOBAL in self._counts),
+                'watermark': None if self.watermark is None else list(self.watermark),
+                'updates': self.updates,
+            }
+
+    # ------------------------------------------------------------------
+    # Persistence
+    # ------------------------------------------------------------------
+    def save(self, path) -> Path:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with self._lock:
+            scopes, items, lines, weights = [], [], [], []
+            for scope, counts in self._counts.items():
+                scopes.extend([scope] * len(counts))
+                items.extend(counts.keys())
+                lines.extend(counts.values())
+                weights.extend(self._weights[scope][i] for i in counts)
+            arrays = dict(
+                format_version=np.array(FORMAT_VERSION),
+                half_life=np.array(self.half_life),
+                epoch=np.array(np.nan if self.epoch is None else self.epoch),
+                watermark=np.array(self.watermark if self.watermark is not None else (np.nan, -1), dtype=float),
+                scopes=np.array(scopes, dtype=np.int64),
+                items=np.array(items, dtype=np.int64),
+                lines=np.array(lines, dtype=float),
+                weights=np.array(weights, dtype=float),
+            )
+        tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        with open(tmp, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp, path)
+        logger.info(f"Saved popularity state ({len(items)} counters) to {path}")
+        return path
+
+    @classmethod
+    def load(cls, path) -> 'DecayedPopularity':
+        with np.load(path) as arrays:
+            format_version = int(arrays['format_version'])
+            if format_version != FORMAT_VERSION:
+                raise ValueError(f"Unsupported popularity state format {format_version}")
+            state = cls(float(arrays['half_life']) / SECONDS_PER_DAY)
+            epoch = float(arrays['epoch'])
+            state.epoch = None if np.isnan(epoch) else epoch
+            seconds, order_id = arrays['watermark']
+            state.watermark = None if np.isnan(seconds) else (float(seconds), int(order_id))
+            for scope, item_id, lines, weight in zip(arrays['scopes'].tolist(), arrays['items'].tolist(),
+                                                     arrays['lines'].tolist(), arrays['weights'].tolist()):
+                state._counts.setdefault(scope, {})[item_id] = lines
+                state._weights.setdefault(scope, {})[item_id] = weight
+        state._restored = True
+        return state
+
+
+_decayed_popularity = None
+_decayed_popularity_built = None  # build time for in-process state, None when following the snapshot
+_decayed_popularity_lock = threading.Lock()
+
+
+def _is_stale(built) -> bool:
+    if built is None:
+        return False
+    return time.monotonic() - built > recommender_setting('POPULARITY_MAX_AGE_SECONDS', 300)
+
+
+def _build_decayed_popularity() -> tuple:
+    path = recommender_setting('POPULARITY_STATE_PATH')
+    state = None
+    if path and os.path.exists(path):
+        try:
+            state = DecayedPopularity.load(path)
+        except Exception as e:
+            logger.error(f"Could not load popularity state from {path}: {e}")
+
+    if recommender_setting('ORDER_SNAPSHOT', False):
+        from src.order_snapshot import get_order_snapshot
+
+        # Kept current by the order snapshot from now on
+        state = state or DecayedPopularity()
+        snapshot = get_order_snapshot()
+        snapshot.refresh()
+        snapshot.subscribe(state)
+        return state, None
+
+    state = state or DecayedPopularity()
+    state.reset(load_orders())
+    return state, time.monotonic()
+
+
+def get_decayed_popularity() -> DecayedPopularity:
+    """Process-wide decayed popularity.
+
+    Restored from ``POPULARITY_STATE_PATH`` when it exists. With the order
+    snapshot enabled it then follows the snapshot (saving itself every
+    ``POPULARITY_SAVE_SECONDS``); otherwise it is rebuilt from ``load_orders``
+    after ``POPULARITY_MAX_AGE_SECONDS``.
+    """
+    global _decayed_popularity, _decayed_popularity_built
+    if _decayed_popularity is None or _is_stale(_decayed_popularity_built):
+        with _decayed_popularity_lock:
+            if _decayed_popularity is None or _is_stale(_decayed_popularity_built):
+                _decayed_popularity, _decayed_popularity_built = _build_decayed_popularity()
+    return _decayed_popularity
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Smart Menu - decayed popularity state")
+    parser.add_argument("command", choices=["build"])
+    parser.add_argument("--path", type=str, default=None, help="State path (default: RECOMMENDER['POPULARITY_STATE_PATH'])")
+    args = parser.parse_args()
+
+    path = args.path or recommender_setting('POPULARITY_STATE_PATH') or 'artifacts/popularity.npz'
+    state = DecayedPopularity()
+    state.reset(load_orders(mode=recommender_setting('ORDER_LINES_MODE', 'python')))
+    state.save(path)
+    print(f"Saved popularity state ({state.stats()['items']} items, {state.stats()['stores']} stores) to {path}")
 
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""
+Per-user recent order lines, for the recent-purchase penalty
+"""
+
+from __future__ import annotations
+
+import bisect
+import logging
+import threading
+
+import numpy as np
+import pandas as pd
+
+from src.data_loader import parse_timestamps, recommender_setting
+
+logger = logging.getLogger(__name__)
+
+
+def _line_keys(lines: pd.DataFrame) -> pd.DataFrame:
+    """user_id plus the (timestamp, order_id, line number) ordering key and item_id of every line"""
+    timestamps = parse_timestamps(lines['timestamp'])
+    if timestamps.dt.tz is not None:
+        timestamps = timestamps.dt.tz_convert('UTC').dt.tz_localize(None)
+    return pd.DataFrame({
+        'user_id': lines['user_id'].to_numpy(),
+        'timestamp': timestamps.to_numpy(dtype='datetime64[ns]').view(np.int64),
+        'order_id': lines['order_id'].to_numpy(),
+        'line': lines.groupby('order_id', sort=False).cumcount().to_numpy(),
+        'item_id': lines['item_id'].to_numpy(),
+    })
+
+
+class RecentPurchases:
+    """The last ``size`` order lines of every user, oldest first.
+
+    Each user's buffer is a short list sorted by (timestamp, order_id, line),
+    the order ``score_items`` used when sorting the user's lines, trimmed to
+    ``size`` entries. An order-snapshot listener: ``apply`` drops the
+    replaced lines and inserts the new ones in place.
+    """
+
+    def __init__(self, size: int | None = None):
+        self.size = size or recommender_setting('RECENT_HISTORY_SIZE', 10)
+        self._lock = threading.Lock()
+        self._buffers = {}
+        self.updates = 0
+
+    def reset(self, lines: pd.DataFrame):
+        buffers = {}
+        if not lines.empty:
+            keys = _line_keys(lines).sort_values(['user_id', 'timestamp', 'order_id', 'line'], kind='stable')
+            keys = keys.groupby('user_id', sort=False).tail(self.size)
+            entries = zip(keys['timestamp'].tolist(), keys['order_id'].tolist(),
+                          keys['line'].tolist(), keys['item_id'].tolist())
+            for user_id, entry in zip(keys['user_id'].tolist(), entries):
+                buffers.setdefault(user_id, []).append(entry)
+        with self._lock:
+            self._buffers = buffers
+            self.updates = 0
+
+    def apply(self, added: pd.DataFrame, removed: pd.DataFrame):
+        with self._lock:
+            if not removed.empty:
+                for user_id, order_ids in removed.groupby('user_id')['order_id']:
+                    buffer = self._buffers.get(user_id)
+                    if buffer:
+                        order_ids = set(order_ids.tolist())
+                        buffer[:] = [entry for entry in buffer if entry[1] not in order_ids]
+            if not added.empty:
+                keys = _line_keys(added)
+                for user_id, timestamp, order_id, line, item_id in keys.itertuples(index=False, name=None):
+                    buffer = self._buffers.setdefault(user_id, [])
+                    bisect.insort(buffer, (timestamp, order_id, line, item_id))
+                    del buffer[:-self.size]
+            self.updates += 1
+
+    def recent_items(self, user_id: int, n: int = 3) -> list:
+        """item_ids of the user's last ``n`` order lines, oldest first"""
+        with self._lock:
+            buffer = self._buffers.get(user_id, ())
+            return [entry[3] for entry in buffer[-n:]]
+
+    def stats(self) -> dict:
+        return {'users': len(self._buffers), 'size': self.size, 'updates': self.updates}
+
+
+_recent_purchases = None
+_recent_purchases_lock = threading.Lock()
+
+
+def get_recent_purchases() -> RecentPurchases:
+    """Process-wide recent-purchase buffers, kept current by the order snapshot"""
+    global _recent_purchases
+    if _recent_purchases is None:
+        with _recent_purchases_lock:
+            if _recent_purchases is None:
+                from src.order_snapshot import get_order_snapshot
+
+                recent = RecentPurchases()
+                snapshot = get_order_snapshot()
+                snapshot.refresh()
+                snapshot.subscribe(recent)
+                _recent_purchases = recent
+    return _recent_purchases
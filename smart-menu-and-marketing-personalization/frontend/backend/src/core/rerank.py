@@ -0,0 +1,136 @@
+"""
+Diversity re-ranking shared by the hybrid and smart recommenders
+
+Both modes work on positions into a score-ordered candidate list:
+
+* ``"cap"``: per-category cap. The first ``top_k`` candidates are always
+  kept, later ones only while their category has fewer than
+  ``max_per_category`` candidates ahead of them.
+* ``"mmr"``: maximal marginal relevance. Candidates are picked greedily by
+  ``lambda * relevance - (1 - lambda) * max similarity to the picked ones``.
+  Item similarity comes from a ``pairwise(item_ids)`` callable the caller
+  resolves once (see :func:`cf_pairwise_similarity`); without one, or for
+  items it does not know, candidates are compared by category.
+"""
+
+from __future__ import annotations
+
+import logging
+from typing import Callable, Optional
+
+import numpy as np
+import pandas as pd
+
+from src.data_loader import recommender_setting
+
+logger = logging.getLogger(__name__)
+
+PairwiseSimilarity = Callable[[np.ndarray], np.ndarray]
+
+
+def category_codes(categories) -> np.ndarray:
+    """Integer code per candidate; missing categories share one code"""
+    codes, _ = pd.factorize(pd.Series(categories, dtype=object).fillna("unknown"), sort=False)
+    return codes
+
+
+def rank_in_category(codes: np.ndarray) -> np.ndarray:
+    """0-based position of every candidate among the earlier candidates of its category"""
+    order = np.argsort(codes, kind='stable')
+    starts = np.searchsorted(codes[order], codes[order], side='left')
+    ranks = np.empty(len(codes), dtype=np.int64)
+    ranks[order] = np.arange(len(codes)) - starts
+    return ranks
+
+
+def cap_per_category(codes: np.ndarray, top_k: int, max_per_category: int,
+                     limit: int | None = None) -> np.ndarray:
+    """Positions kept by the per-category cap, in candidate order (at most ``limit``)"""
+    accepted = (np.arange(len(codes)) < top_k) | (rank_in_category(codes) < max_per_category)
+    positions = np.flatnonzero(accepted)
+    return positions[:limit] if limit is not None else positions
+
+
+def mmr(relevance: np.ndarray, similarity: np.ndarray, k: int, diversity_lambda: float = 0.7) -> np.ndarray:
+    """Positions picked by maximal marginal relevance, in pick order"""
+    n = len(relevance)
+    k = min(k, n)
+    picked = np.empty(k, dtype=np.int64)
+    weighted_relevance = diversity_lambda * np.asarray(relevance, dtype=float)
+    # Similarity penalties, pre-scaled; picked candidates get -inf gain through ``taken``
+    penalty = (1.0 - diversity_lambda) * np.asarray(similarity, dtype=float)
+    worst = np.zeros(n)
+    taken = np.zeros(n)
+    gain = np.empty(n)
+    for step in range(k):
+        np.subtract(weighted_relevance, worst, out=gain)
+        gain += taken
+        best = int(gain.argmax())
+        picked[step] = best
+        taken[best] = -np.inf
+        np.maximum(worst, penalty[best], out=worst)
+    return picked
+
+
+def category_similarity(codes: np.ndarray) -> np.ndarray:
+    """1 for candidates of the same category, 0 otherwise"""
+    return (codes[:, None] == codes[None, :]).astype(float)
+
+
+def cf_pairwise_similarity(mode: str | None = None) -> Optional[PairwiseSimilarity]:
+    """``pairwise(item_ids)`` from the shared CF model when re-ranking by MMR, else None.
+
+    Resolve it once per request or batch and hand it to :func:`rerank`.
+    """
+    if (mode or recommender_setting('RERANK_MODE', 'cap')) != "mmr":
+        return None
+    try:
+        from .cf_model import get_cf_model
+        return get_cf_model().pairwise_similarity
+    except Exception as e:
+        logger.warning(f"CF model unavailable for MMR re-ranking, comparing by category: {e}")
+        return None
+
+
+def item_similarity(item_ids, codes: np.ndarray, pairwise: PairwiseSimilarity | None = None) -> np.ndarray:
+    """Item-item similarity between candidates from ``pairwise``, falling back to shared category"""
+    if pairwise is None:
+        return category_similarity(codes)
+    try:
+        similarity = pairwise(item_ids)
+    except Exception as e:
+        logger.warning(f"CF similarity failed for MMR re-ranking, comparing by category: {e}")
+        return category_similarity(codes)
+    # Items the CF model has not seen are compared by category
+    unseen = ~similarity.any(axis=1)
+    if unseen.any():
+        same = category_similarity(codes)
+        similarity[unseen, :] = same[unseen, :]
+        similarity[:, unseen] = same[:, unseen]
+    return similarity
+
+
+def rerank(candidates: pd.DataFrame, top_k: int, score_column: str, mode: str | None = None,
+           limit: int | None = None, similarity: PairwiseSimilarity | None = None) -> pd.DataFrame:
+    """Diversify score-ordered ``candidates`` (mode from ``RECOMMENDER["RERANK_MODE"]``)
+
+    ``similarity`` is the ``pairwise(item_ids)`` MMR compares candidates by.
+    """
+    if candidates.empty:
+        return candidates
+    mode = mode or recommender_setting('RERANK_MODE', 'cap')
+    categories = candidates["category"] if "category" in candidates.columns else [None] * len(candidates)
+    codes = category_codes(categories)
+
+    if mode == "mmr":
+        pool = min(len(candidates), recommender_setting('RERANK_MMR_POOL', 100))
+        codes = codes[:pool]
+        relevance = candidates[score_column].to_numpy(dtype=float)[:pool]
+        span = relevance.max() - relevance.min()
+        relevance = (relevance - relevance.min()) / span if span > 0 else np.ones(pool)
+        pairs = item_similarity(candidates["item_id"].to_numpy()[:pool], codes, similarity)
+        positions = mmr(relevance, pairs, limit or top_k,
+                        recommender_setting('RERANK_MMR_LAMBDA', 0.7))
+    else:
+        positions = cap_per_category(codes, top_k, max(1, top_k // 3), limit)
+    return candidates.iloc[positions]
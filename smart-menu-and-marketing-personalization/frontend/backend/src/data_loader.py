@@ -1,5 +1,6 @@
 import os
 import django
+import numpy as np
 import pandas as pd
 from datetime import datetime
 from typing import Tuple, Optional
@@ -7,7 +8,11 @@ from django.conf import settings
 from django.db import connection
 import json
 import logging
+import threading
+import time
+from collections import deque
 from sqlalchemy import create_engine
+from sqlalchemy.exc import TimeoutError as SATimeoutError
 import warnings
 
 logger = logging.getLogger(__name__)
@@ -26,10 +31,54 @@ except Exception as e:
     raise
 
 
-def get_db_engine():
+def recommender_setting(name: str, default=None):
+    """Read a key from the ``RECOMMENDER`` dict in Django settings"""
+    return getattr(settings, 'RECOMMENDER', {}).get(name, default)
+
+
+class PoolStats:
+    """Checkout latency and saturation counters for the shared engine pool"""
+
+    def __init__(self, window: int = 1000):
+        self._lock = threading.Lock()
+        self._recent = deque(maxlen=window)
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record_checkout(self, wait: float):
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self._recent.append(wait)
+
+    def record_timeout(self):
+        with self._lock:
+            self.timeouts += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            recent = np.array(self._recent) if self._recent else np.zeros(1)
+            return {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'avg_checkout_ms': 1000 * self.total_wait / max(1, self.checkouts),
+                'max_checkout_ms': 1000 * self.max_wait,
+                'p50_checkout_ms': 1000 * float(np.percentile(recent, 50)),
+                'p95_checkout_ms': 1000 * float(np.percentile(recent, 95)),
+            }
+
+
+_engine = None
+_engine_lock = threading.Lock()
+_pool_stats = PoolStats()
+
+
+def _create_db_engine():
     """Create SQLAlchemy engine from Django database settings"""
     try:
-        from django.conf import settings
         db_settings = settings.DATABASES['default']
         
         # Build database URL based on engine type
@@ -48,12 +97,15 @@ def get_db_engine():
             logger.warning(f"Unsupported database engine: {db_settings['ENGINE']}. Using Django connection.")
             return connection
             
-        from sqlalchemy import create_engine
-        # Create engine with proper configuration
+        # Create engine with proper configuration. The pool is separate from
+        # Django's own per-thread connection, which the ORM keeps using.
         engine = create_engine(
             db_url,
-            pool_pre_ping=True,  # Verify connections before use
-            pool_recycle=300,    # Recycle connections every 5 minutes
+            pool_size=recommender_setting('DB_POOL_SIZE', 5),
+            max_overflow=recommender_setting('DB_MAX_OVERFLOW', 10),
+            pool_timeout=recommender_setting('DB_POOL_TIMEOUT', 30),
+            pool_pre_ping=recommender_setting('DB_POOL_PRE_PING', True),  # Verify connections before use
+            pool_recycle=recommender_setting('DB_POOL_RECYCLE', 300),     # Recycle connections every 5 minutes
             echo=False           # Set to True for SQL debugging
         )
         logger.info(f"Created SQLAlchemy engine for {db_settings['ENGINE']}")
@@ -63,6 +115,49 @@ def get_db_engine():
         return connection
 
 
+def get_db_engine():
+    """Return the process-wide SQLAlchemy engine, creating it on first use"""
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = _create_db_engine()
+    return _engine
+
+
+def _dispose_engine_after_fork():
+    # Pooled connections must not be shared with a forked worker; drop them
+    # without closing the parent's sockets.
+    if _engine is not None and hasattr(_engine, 'dispose'):
+        _engine.dispose(close=False)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_dispose_engine_after_fork)
+
+
+def get_pool_stats() -> dict:
+    """Pool size, checked-out connections, saturation and checkout latency"""
+    engine = get_db_engine()
+    stats = _pool_stats.snapshot()
+    pool = getattr(engine, 'pool', None)
+    if pool is None or not hasattr(pool, 'checkedout'):
+        stats['pool'] = 'django-connection' if pool is None else type(pool).__name__
+        return stats
+
+    capacity = pool.size() + max(0, getattr(pool, '_max_overflow', 0))
+    stats.update({
+        'pool': type(pool).__name__,
+        'pool_size': pool.size(),
+        'max_overflow': getattr(pool, '_max_overflow', 0),
+        'checked_out': pool.checkedout(),
+        'checked_in': pool.checkedin(),
+        'overflow': pool.overflow(),
+        'saturation': pool.checkedout() / capacity if capacity > 0 else 0.0,
+    })
+    return stats
+
+
 def safe_read_sql(query, params=None):
     """Safely execute SQL query with proper parameter handling"""
     try:
@@ -84,11 +179,23 @@ def safe_read_sql(query, params=None):
                 params = tuple(cleaned_params)  # Convert to tuple for database compatibility
         
         logger.debug(f"Executing query with params: {params}")
+
+        # Queries are written with %s placeholders; sqlite3 expects qmark style
+        if getattr(getattr(engine, 'dialect', None), 'paramstyle', None) == 'qmark':
+            query = query.replace('%s', '?')
         
         # Check if we have a SQLAlchemy engine
-        if hasattr(engine, 'execute') and hasattr(engine, 'connect'):
-            # Use SQLAlchemy engine
-            return pd.read_sql(query, engine, params=params)
+        if hasattr(engine, 'pool') and hasattr(engine, 'connect'):
+            # Check a connection out of the shared pool, timing the wait
+            start = time.perf_counter()
+            try:
+                conn = engine.connect()
+            except SATimeoutError:
+                _pool_stats.record_timeout()
+                raise
+            _pool_stats.record_checkout(time.perf_counter() - start)
+            with conn:
+                return pd.read_sql(query, conn, params=params)
         else:
             # Fallback to Django connection - suppress warnings
             import warnings
@@ -135,8 +242,13 @@ def validate_store_exists(store_id: int) -> bool:
         return False
 
 
-def load_users(user_id: Optional[int] = None) -> pd.DataFrame:
-    """Load users from PostgreSQL database with proper validation"""
+def load_users(user_id: Optional[int] = None, after: Optional[int] = None,
+               limit: Optional[int] = None) -> pd.DataFrame:
+    """Load users from PostgreSQL database with proper validation
+
+    ``after`` and ``limit`` page through users in user_id order: the page
+    holds at most ``limit`` users with a user_id above ``after``.
+    """
     
     # Normalize user_id parameter
     if isinstance(user_id, (list, tuple)):
@@ -180,6 +292,14 @@ def load_users(user_id: Optional[int] = None) -> pd.DataFrame:
     if user_id:
         query += " WHERE uid = %s"
         params = (user_id,)  # Pass as tuple
+    elif after is not None or limit is not None:
+        params = ()
+        if after is not None:
+            query += " WHERE uid > %s"
+            params = (int(after),)
+        query += " ORDER BY uid"
+        if limit is not None:
+            query += f" LIMIT {int(limit)}"
     
     try:
         users = safe_read_sql(query, params)
@@ -376,8 +496,346 @@ def load_items(store_id: Optional[int] = None) -> pd.DataFrame:
     return items
 
 
-def load_orders(user_id: Optional[int] = None, store_id: Optional[int] = None) -> pd.DataFrame:
-    """Load orders with their items from PostgreSQL database with proper validation"""
+ORDER_LINE_COLUMNS = [
+    'order_id', 'user_id', 'store_id', 'timestamp', 'item_id', 'item_name', 'quantity',
+    'size', 'price', 'added_ingredients', 'removed_ingredients',
+    'total_amount', 'pickup_type', 'status', 'time_of_day'
+]
+
+
+def _decode_rows(values: list) -> list:
+    parsed = []
+    for value in values:
+        try:
+            parsed.append(json.loads(value))
+        except ValueError as e:
+            logger.warning(f"Error parsing items JSON: {e}")
+            parsed.append([])
+    return parsed
+
+
+def _decode_items_column(raw: pd.Series) -> list:
+    """Decode the ``items`` JSON column into one list of line dicts per order.
+
+    All string payloads are decoded with a single ``json.loads`` call over a
+    JSON array built from the column; if any payload is malformed, or one
+    holds several comma-separated values so the array no longer lines up
+    with the rows, we fall back to decoding row by row.
+    """
+    values = raw.tolist()
+    decoded = [v if isinstance(v, list) else [] for v in values]
+
+    text_pos = [i for i, v in enumerate(values)
+                if isinstance(v, str) and v.strip() not in ('', '{}')]
+    if not text_pos:
+        return decoded
+
+    texts = [values[i] for i in text_pos]
+    try:
+        parsed = json.loads('[' + ','.join(texts) + ']')
+    except ValueError:
+        parsed = None
+    if parsed is None or len(parsed) != len(text_pos):
+        parsed = _decode_rows(texts)
+
+    for i, items_data in zip(text_pos, parsed):
+        decoded[i] = items_data if isinstance(items_data, list) else []
+    return decoded
+
+
+def _first_present(records: pd.DataFrame, keys) -> pd.Series:
+    """Coalesce alternative JSON keys (e.g. ``itemId``/``item_id``) column-wise"""
+    result = pd.Series(None, index=records.index, dtype=object)
+    for key in reversed(keys):
+        if key in records.columns:
+            column = records[key].astype(object)
+            result = column.where(column.notna(), result)
+    return result
+
+
+def parse_timestamps(timestamps: pd.Series) -> pd.Series:
+    """Order timestamps as a datetime series, whatever the driver handed back"""
+    if pd.api.types.is_datetime64_any_dtype(timestamps):
+        return timestamps
+    # SQLite hands back ISO strings, with or without a UTC offset
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        try:
+            parsed = pd.to_datetime(timestamps, errors='coerce', format='ISO8601')
+        except (ValueError, TypeError):
+            parsed = timestamps
+    if not pd.api.types.is_datetime64_any_dtype(parsed):
+        parsed = pd.to_datetime(timestamps, errors='coerce', utc=True, format='ISO8601')
+    return parsed
+
+
+def _time_of_day(timestamps: pd.Series) -> pd.Series:
+    """Vectorized morning/lunch/afternoon/dinner bucketing of order timestamps"""
+    timestamps = parse_timestamps(timestamps)
+    hours = timestamps.dt.hour
+    buckets = np.select(
+        [(hours >= 6) & (hours < 11), (hours >= 11) & (hours < 15), (hours >= 15) & (hours < 18)],
+        ['morning', 'lunch', 'afternoon'],
+        default='dinner'
+    )
+    return pd.Series(buckets, index=timestamps.index)
+
+
+def _as_list(values: pd.Series) -> pd.Series:
+    """Coerce ingredient values to lists; SQLite hands JSON arrays back as text"""
+    def to_list(v):
+        if isinstance(v, str):
+            try:
+                v = json.loads(v)
+            except ValueError:
+                return []
+        return v if isinstance(v, list) else []
+    return pd.Series([to_list(v) for v in values], index=values.index, dtype=object)
+
+
+def _normalize_order_lines(raw: pd.DataFrame) -> pd.DataFrame:
+    """Type and clean raw line columns into the order-line frame.
+
+    ``raw`` carries the order columns plus untyped ``item_id``, ``quantity``,
+    ``price``, ``item_name``, ``size`` and ingredient columns, whether they
+    came from the Python explosion or from the database unnesting them.
+    Lines without a usable item id, quantity or price are dropped.
+    """
+    item_id = pd.to_numeric(raw['item_id'], errors='coerce')
+    quantity = pd.to_numeric(raw['quantity'], errors='coerce').where(raw['quantity'].notna(), 1)
+    price = pd.to_numeric(raw['price'], errors='coerce').where(raw['price'].notna(), 0)
+    valid = item_id.notna() & quantity.notna() & price.notna()
+    if not valid.all():
+        logger.debug(f"Dropped {int((~valid).sum())} order lines with missing or invalid fields")
+
+    lines = pd.DataFrame({
+        'order_id': raw['order_id'],
+        'user_id': raw['user_id'],
+        'store_id': raw['store_id'],
+        'timestamp': raw['timestamp'],
+        'item_id': item_id.astype('float64'),
+        'item_name': raw['item_name'].where(raw['item_name'].notna(), 'Unknown').astype(str).str[:100],
+        'quantity': quantity.clip(lower=1),
+        'size': raw['size'].where(raw['size'].notna(), 'regular').astype(str).str[:20],
+        'price': price.clip(lower=0).astype(float),
+        'added_ingredients': _as_list(raw['added_ingredients']),
+        'removed_ingredients': _as_list(raw['removed_ingredients']),
+        'total_amount': raw['total_amount'],
+        'pickup_type': raw['pickup_type'],
+        'status': raw['status'],
+    }).loc[valid].reset_index(drop=True)
+
+    lines['item_id'] = lines['item_id'].astype('int64')
+    lines['quantity'] = lines['quantity'].astype('int64')
+    lines['time_of_day'] = _time_of_day(lines['timestamp'])
+    return lines
+
+
+def explode_order_items(orders: pd.DataFrame) -> pd.DataFrame:
+    """Turn raw order rows (one ``items_json`` array each) into the order-line frame.
+
+    Replaces the per-order ``iterrows`` loop: the JSON column is decoded in one
+    pass, exploded to one row per line and normalized with column operations.
+    """
+    if orders.empty:
+        return pd.DataFrame(columns=ORDER_LINE_COLUMNS)
+
+    exploded = orders[['order_id', 'user_id', 'store_id', 'timestamp', 'total_amount', 'pickup_type', 'status']].assign(
+        _line=_decode_items_column(orders['items_json'])
+    ).explode('_line', ignore_index=True)
+
+    is_line = np.fromiter((isinstance(v, dict) for v in exploded['_line']), dtype=bool, count=len(exploded))
+    exploded = exploded.loc[is_line].reset_index(drop=True)
+    if exploded.empty:
+        return pd.DataFrame(columns=ORDER_LINE_COLUMNS)
+
+    records = pd.DataFrame.from_records(exploded['_line'].tolist())
+    raw = exploded.drop(columns='_line').assign(
+        item_id=_first_present(records, ['itemId', 'item_id', 'id']),
+        quantity=_first_present(records, ['qty', 'quantity']),
+        price=_first_present(records, ['price']),
+        item_name=_first_present(records, ['name']),
+        size=_first_present(records, ['size']),
+        added_ingredients=_first_present(records, ['addedIngredients', 'added_ingredients']),
+        removed_ingredients=_first_present(records, ['removedIngredients', 'removed_ingredients']),
+    )
+    return _normalize_order_lines(raw)
+
+
+# Order lines unnested by the database itself, one query per vendor. Values
+# come back as text/JSON and are typed by _normalize_order_lines.
+ORDER_LINES_SQL = {
+    'postgresql': """
+        SELECT
+            o.id as order_id,
+            o.user_id,
+            o.store_id,
+            o.created_at as timestamp,
+            o.total as total_amount,
+            o.pickup_type,
+            o.status,
+            COALESCE(l.line->>'itemId', l.line->>'item_id', l.line->>'id') as item_id,
+            COALESCE(l.line->>'qty', l.line->>'quantity') as quantity,
+            l.line->>'price' as price,
+            l.line->>'name' as item_name,
+            l.line->>'size' as size,
+            COALESCE(l.line->'addedIngredients', l.line->'added_ingredients') as added_ingredients,
+            COALESCE(l.line->'removedIngredients', l.line->'removed_ingredients') as removed_ingredients
+        FROM slice_order o
+        CROSS JOIN LATERAL jsonb_array_elements(
+            CASE WHEN jsonb_typeof(o.items) = 'array' THEN o.items ELSE '[]'::jsonb END
+        ) WITH ORDINALITY AS l(line, pos)
+        WHERE o.user_id IS NOT NULL AND jsonb_typeof(l.line) = 'object'
+    """,
+    'sqlite': """
+        SELECT
+            o.id as order_id,
+            o.user_id,
+            o.store_id,
+            o.created_at as timestamp,
+            o.total as total_amount,
+            o.pickup_type,
+            o.status,
+            COALESCE(json_extract(l.value, '$.itemId'), json_extract(l.value, '$.item_id'), json_extract(l.value, '$.id')) as item_id,
+            COALESCE(json_extract(l.value, '$.qty'), json_extract(l.value, '$.quantity')) as quantity,
+            json_extract(l.value, '$.price') as price,
+            json_extract(l.value, '$.name') as item_name,
+            json_extract(l.value, '$.size') as size,
+            COALESCE(json_extract(l.value, '$.addedIngredients'), json_extract(l.value, '$.added_ingredients')) as added_ingredients,
+            COALESCE(json_extract(l.value, '$.removedIngredients'), json_extract(l.value, '$.removed_ingredients')) as removed_ingredients
+        FROM slice_order o,
+            json_each(CASE WHEN json_type(o.items) = 'array' THEN o.items ELSE '[]' END) AS l
+        WHERE o.user_id IS NOT NULL AND l.type = 'object'
+    """,
+}
+
+ORDER_LINES_SQL_ORDER = {
+    'postgresql': " ORDER BY o.created_at DESC, o.id, l.pos",
+    'sqlite': " ORDER BY o.created_at DESC, o.id, l.key",
+}
+
+
+def _in_clause(column: str, values) -> str:
+    """``column IN (%s, ...)`` with one placeholder per value"""
+    return f"{column} IN ({', '.join(['%s'] * len(values))})"
+
+
+def load_order_lines_sql(user_id: Optional[int] = None, store_id: Optional[int] = None,
+                         user_ids: Optional[list] = None) -> pd.DataFrame:
+    """Load the order-line frame with the JSON unnesting done in the database.
+
+    Returns None when the database vendor has no unnesting query, so the
+    caller can fall back to exploding ``items`` in Python.
+    """
+    vendor = connection.vendor
+    if vendor not in ORDER_LINES_SQL:
+        logger.warning(f"SQL order-line unnesting not supported for {vendor}. Using Python explosion.")
+        return None
+
+    query = ORDER_LINES_SQL[vendor]
+    params = []
+    if user_id is not None:
+        query += " AND o.user_id = %s"
+        params.append(user_id)
+    if user_ids is not None:
+        query += " AND " + _in_clause("o.user_id", user_ids)
+        params.extend(user_ids)
+    if store_id is not None:
+        query += " AND o.store_id = %s"
+        params.append(store_id)
+    query += ORDER_LINES_SQL_ORDER[vendor]
+
+    raw = safe_read_sql(query, tuple(params) if params else None)
+    logger.info(f"Loaded {len(raw)} order lines unnested by {vendor}")
+    if raw.empty:
+        return pd.DataFrame(columns=ORDER_LINE_COLUMNS)
+    return _normalize_order_lines(raw)
+
+
+def load_order_lines_table(user_id: Optional[int] = None, store_id: Optional[int] = None,
+                           user_ids: Optional[list] = None) -> pd.DataFrame:
+    """Load the order-line frame from the normalized ``slice_orderline`` table"""
+    query = """
+        SELECT
+            o.id as order_id,
+            o.user_id,
+            o.store_id,
+            o.created_at as timestamp,
+            ol.item_id,
+            ol.qty as quantity,
+            ol.price,
+            ol.name as item_name,
+            ol.size,
+            ol.added_ingredients,
+            ol.removed_ingredients,
+            o.total as total_amount,
+            o.pickup_type,
+            o.status
+        FROM slice_orderline ol
+        JOIN slice_order o ON o.id = ol.order_id
+        WHERE o.user_id IS NOT NULL
+    """
+    params = []
+    if user_id is not None:
+        query += " AND ol.user_id = %s"
+        params.append(user_id)
+    if user_ids is not None:
+        query += " AND " + _in_clause("ol.user_id", user_ids)
+        params.extend(user_ids)
+    if store_id is not None:
+        query += " AND ol.store_id = %s"
+        params.append(store_id)
+    query += " ORDER BY o.created_at DESC, o.id, ol.position"
+
+    raw = safe_read_sql(query, tuple(params) if params else None)
+    logger.info(f"Loaded {len(raw)} order lines from slice_orderline")
+    if raw.empty:
+        return pd.DataFrame(columns=ORDER_LINE_COLUMNS)
+    return _normalize_order_lines(raw)
+
+
+def load_raw_orders(conditions: Optional[list] = None, params: Optional[list] = None) -> pd.DataFrame:
+    """Fetch raw ``slice_order`` rows, newest first, with ``items`` still as JSON
+
+    ``conditions`` are extra SQL predicates on alias ``o``, AND-ed together.
+    """
+    query = """
+        SELECT 
+            o.id as order_id,
+            o.store_id,
+            o.user_id,
+            o.display_id,
+            o.created_at as timestamp,
+            o.updated_at,
+            o.pickup_type,
+            o.status,
+            o.total as total_amount,
+            o.payment,
+            o.source,
+            o.meta,
+            o.items as items_json
+        FROM slice_order o
+        WHERE o.user_id IS NOT NULL
+    """
+    if conditions:
+        query += " AND " + " AND ".join(conditions)
+    
+    query += " ORDER BY o.created_at DESC, o.id"
+    return safe_read_sql(query, tuple(params) if params else None)
+
+
+def load_orders(user_id: Optional[int] = None, store_id: Optional[int] = None,
+                mode: Optional[str] = None) -> pd.DataFrame:
+    """Load orders with their items from PostgreSQL database with proper validation
+
+    ``mode`` picks where order lines come from: ``"python"`` downloads
+    ``Order.items`` and explodes it here, ``"sql"`` lets the database unnest
+    it and ``"table"`` reads the normalized ``OrderLine`` table. Defaults to
+    ``RECOMMENDER["ORDER_LINES_MODE"]``.
+
+    With ``RECOMMENDER["ORDER_SNAPSHOT"]`` enabled and no explicit ``mode``,
+    lines are served from the in-process order snapshot instead.
+    """
     
     # Normalize parameters - CRITICAL: ensure these are scalars
     if isinstance(user_id, (list, tuple)):
@@ -402,6 +860,10 @@ def load_orders(user_id: Optional[int] = None, store_id: Optional[int] = None) -
         except (ValueError, TypeError):
             logger.warning(f"Invalid store_id: {store_id}")
             store_id = None
+
+    if mode is None and recommender_setting('ORDER_SNAPSHOT', False):
+        from src.order_snapshot import get_order_snapshot
+        return get_order_snapshot().frame(user_id, store_id)
     
     # Debug: Check if orders table has data
     try:
@@ -415,27 +877,25 @@ def load_orders(user_id: Optional[int] = None, store_id: Optional[int] = None) -
             return pd.DataFrame()
     except Exception as e:
         logger.error(f"Error checking order count: {e}")
-    
-    query = """
-        SELECT 
-            o.id as order_id,
-            o.store_id,
-            o.user_id,
-            o.display_id,
-            o.created_at as timestamp,
-            o.pickup_type,
-            o.status,
-            o.total as total_amount,
-            o.payment,
-            o.source,
-            o.meta,
-            o.items as items_json
-        FROM slice_order o
-        WHERE o.user_id IS NOT NULL
-    """
-    
-    params = []
+
+    mode = mode or recommender_setting('ORDER_LINES_MODE', 'python')
+    if mode in ('sql', 'table'):
+        try:
+            if mode == 'table':
+                complete_orders = load_order_lines_table(user_id, store_id)
+            else:
+                complete_orders = load_order_lines_sql(user_id, store_id)
+        except Exception as e:
+            logger.error(f"Error loading order lines: {e}")
+            return pd.DataFrame()
+        if complete_orders is not None:
+            if complete_orders.empty:
+                logger.warning("No order items found in database")
+                return pd.DataFrame()
+            return complete_orders
+
     conditions = []
+    params = []
     
     if user_id is not None:
         conditions.append("o.user_id = %s")
@@ -445,15 +905,10 @@ def load_orders(user_id: Optional[int] = None, store_id: Optional[int] = None) -
         conditions.append("o.store_id = %s")
         params.append(store_id)
     
-    if conditions:
-        query += " AND " + " AND ".join(conditions)
-    
-    query += " ORDER BY o.created_at DESC"
-    
     logger.info(f"Executing order query with params: {params}")
     
     try:
-        orders = safe_read_sql(query, tuple(params) if params else None)
+        orders = load_raw_orders(conditions, params)
         logger.info(f"Loaded {len(orders)} orders from database")
     except Exception as e:
         logger.error(f"Error loading orders: {e}")
@@ -463,102 +918,49 @@ def load_orders(user_id: Optional[int] = None, store_id: Optional[int] = None) -
         logger.warning("No orders found in database")
         return pd.DataFrame()
 
-    # Continue with the rest of the order processing...
-    # [Rest of the function remains the same as before]
-    order_items_list = []
-    
-    for idx, order_row in orders.iterrows():
-        try:
-            items_data = order_row['items_json']
-            
-            if pd.isna(items_data) or items_data is None:
-                items_data = []
-            elif isinstance(items_data, str):
-                if items_data.strip() == '' or items_data.strip() == '{}':
-                    items_data = []
-                else:
-                    items_data = json.loads(items_data)
-            elif not isinstance(items_data, list):
-                items_data = []
-                
-        except (json.JSONDecodeError, ValueError) as e:
-            logger.warning(f"Error parsing items JSON for order {order_row['order_id']}: {e}")
-            items_data = []
-        except Exception as e:
-            logger.warning(f"Unexpected error parsing items JSON for order {order_row['order_id']}: {e}")
-            items_data = []
-        
-        for item in items_data:
-            if not isinstance(item, dict):
-                continue
-                
-            try:
-                item_id = item.get('itemId') or item.get('item_id') or item.get('id')
-                if item_id is None:
-                    continue
-                    
-                item_id = int(item_id)
-                quantity = max(1, int(item.get('qty', item.get('quantity', 1))))
-                price = max(0, float(item.get('price', 0)))
-                
-                order_item = {
-                    'order_id': order_row['order_id'],
-                    'user_id': order_row['user_id'],
-                    'timestamp': order_row['timestamp'],
-                    'item_id': item_id,
-                    'item_name': str(item.get('name', 'Unknown'))[:100],
-                    'quantity': quantity,
-                    'size': str(item.get('size', 'regular'))[:20],
-                    'price': price,
-                    'added_ingredients': item.get('addedIngredients', item.get('added_ingredients', [])),
-                    'removed_ingredients': item.get('removedIngredients', item.get('removed_ingredients', [])),
-                    'total_amount': order_row['total_amount'],
-                    'pickup_type': order_row['pickup_type'],
-                    'status': order_row['status']
-                }
-                order_items_list.append(order_item)
-                
-            except Exception as e:
-                logger.warning(f"Error processing item in order {order_row['order_id']}: {e}")
-                continue
-    
-    if not order_items_list:
+    complete_orders = explode_order_items(orders)
+    if complete_orders.empty:
         logger.warning("No order items found after parsing")
         return pd.DataFrame()
 
-    complete_orders = pd.DataFrame(order_items_list)
-    
-    # Add time_of_day field
-    def _infer_time_of_day(ts) -> str:
-        if pd.isna(ts):
-            return "dinner"
-        try:
-            if isinstance(ts, str):
-                ts = pd.to_datetime(ts)
-            h = ts.hour
-            if 6 <= h < 11:
-                return "morning"
-            elif 11 <= h < 15:
-                return "lunch"  
-            elif 15 <= h < 18:
-                return "afternoon"
-            return "dinner"
-        except Exception as e:
-            logger.warning(f"Error inferring time of day: {e}")
-            return "dinner"
-    
-    complete_orders['time_of_day'] = complete_orders['timestamp'].apply(_infer_time_of_day)
-    
-    # Ensure lists are properly formatted
-    for col in ['added_ingredients', 'removed_ingredients']:
-        complete_orders[col] = complete_orders[col].apply(
-            lambda x: x if isinstance(x, list) else []
-        )
-    
     logger.info(f"Successfully processed {len(complete_orders)} order items")
     return complete_orders
 
 
+def budget_categories(avg_order_value: pd.Series) -> pd.Series:
+    """low / medium / high budget sensitivity from average order values"""
+    values = pd.to_numeric(avg_order_value, errors='coerce').to_numpy(dtype=float)
+    categories = np.select([values < 1500, values > 3500], ['low', 'high'], default='medium')
+    # Missing or non-positive averages say nothing about the budget
+    categories = np.where(np.isnan(values) | (values <= 0), 'medium', categories)
+    return pd.Series(categories, index=avg_order_value.index)
+
+
+def _join_aggregates(users: pd.DataFrame, items: pd.DataFrame, store_id: Optional[int]):
+    """Fill popularity_score / budget_sensitivity from the process-wide order aggregates"""
+    from src.order_aggregates import get_order_aggregates
+
+    try:
+        aggregates = get_order_aggregates()
+    except Exception as e:
+        logger.error(f"Error loading order aggregates: {e}")
+        return
+    if not items.empty:
+        popularity = aggregates.popularity(store_id)
+        if not popularity.empty:
+            items['popularity_score'] = items['item_id'].map(popularity).fillna(0.1)
+    if not users.empty:
+        users['budget_sensitivity'] = users['user_id'].map(aggregates.budget_categories()).fillna('medium')
+
+
+def _columnar_snapshot():
+    """A published columnar snapshot recent enough to serve users and items, or None"""
+    if not recommender_setting('COLUMNAR_SNAPSHOT_DIR'):
+        return None
+    from src.columnar_snapshot import fresh_columnar_snapshot
+    return fresh_columnar_snapshot()
+
+
 def load_all(user_id: Optional[int] = None, store_id: Optional[int] = None) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
     """Load all data with parameter safety"""
     
@@ -586,11 +988,24 @@ def load_all(user_id: Optional[int] = None, store_id: Optional[int] = None) -> T
     
     logger.info(f"Loading data - user_id: {user_id}, store_id: {store_id}")
     
-    users = load_users(user_id)
-    items = load_items(store_id)
+    # Users and items come from a recent columnar snapshot when one is
+    # published; orders always come from load_orders, which keeps current
+    snapshot = _columnar_snapshot()
+    if snapshot is not None:
+        users = snapshot.users(user_id)
+        items = snapshot.items(store_id)
+    else:
+        users = load_users(user_id)
+        items = load_items(store_id)
     orders = load_orders(user_id, store_id)
     
     # Update item popularity and user budget sensitivity
+    if recommender_setting('ORDER_AGGREGATES', False):
+        # Joined from aggregates over every order, whatever slice was loaded
+        _join_aggregates(users, items, store_id)
+        logger.info(f"Data loading complete - Users: {len(users)}, Items: {len(items)}, Orders: {len(orders)}")
+        return users, items, orders
+
     if not orders.empty and not items.empty:
         try:
             popularity = orders.groupby('item_id')['quantity'].sum()
@@ -603,16 +1018,7 @@ def load_all(user_id: Optional[int] = None, store_id: Optional[int] = None) -> T
     if not orders.empty and not users.empty:
         try:
             avg_order_value = orders.groupby('user_id')['total_amount'].mean()
-            def categorize_budget(avg_value):
-                if pd.isna(avg_value) or avg_value <= 0:
-                    return 'medium'
-                if avg_value < 1500:
-                    return 'low'
-                elif avg_value > 3500:
-                    return 'high'
-                return 'medium'
-            
-            budget_map = avg_order_value.apply(categorize_budget)
+            budget_map = budget_categories(avg_order_value)
             users['budget_sensitivity'] = users['user_id'].map(budget_map).fillna('medium')
         except Exception as e:
             logger.error(f"Error updating user budget sensitivity: {e}")
@@ -621,6 +1027,61 @@ def load_all(user_id: Optional[int] = None, store_id: Optional[int] = None) -> T
     return users, items, orders
 
 
+def load_orders_for_users(user_ids: list) -> pd.DataFrame:
+    """Order lines of the given users, from the same source as :func:`load_orders`"""
+    user_ids = [int(u) for u in user_ids]
+    if not user_ids:
+        return pd.DataFrame()
+
+    if recommender_setting('ORDER_SNAPSHOT', False):
+        from src.order_snapshot import get_order_snapshot
+        return get_order_snapshot().frame_for_users(user_ids)
+
+    mode = recommender_setting('ORDER_LINES_MODE', 'python')
+    try:
+        if mode == 'table':
+            return load_order_lines_table(user_ids=user_ids)
+        if mode == 'sql':
+            lines = load_order_lines_sql(user_ids=user_ids)
+            if lines is not None:
+                return lines
+        orders = load_raw_orders([_in_clause("o.user_id", user_ids)], user_ids)
+    except Exception as e:
+        logger.error(f"Error loading orders for {len(user_ids)} users: {e}")
+        return pd.DataFrame()
+    return explode_order_items(orders) if not orders.empty else pd.DataFrame()
+
+
+def load_user_chunk(after: Optional[int], limit: int,
+                    items: Optional[pd.DataFrame] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """The next ``limit`` users after user_id ``after`` and their order lines.
+
+    Users get ``budget_sensitivity`` as in :func:`load_all`; with
+    ``ORDER_AGGREGATES`` on, ``items`` get their ``popularity_score`` too.
+    """
+    snapshot = _columnar_snapshot()
+    if snapshot is not None:
+        users = snapshot.frames['users']
+        if after is not None:
+            users = users.loc[users['user_id'] > after]
+        users = users.sort_values('user_id').head(limit).reset_index(drop=True)
+    else:
+        users = load_users(after=after if after is not None else 0, limit=limit)
+    if users.empty:
+        return users, pd.DataFrame()
+
+    orders = load_orders_for_users(users['user_id'].tolist())
+    if recommender_setting('ORDER_AGGREGATES', False):
+        _join_aggregates(users, items if items is not None else pd.DataFrame(), None)
+    elif not orders.empty:
+        try:
+            budget_map = budget_categories(orders.groupby('user_id')['total_amount'].mean())
+            users['budget_sensitivity'] = users['user_id'].map(budget_map).fillna('medium')
+        except Exception as e:
+            logger.error(f"Error updating user budget sensitivity: {e}")
+    return users, orders
+
+
 def get_sample_data() -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
     """Get sample data for testing"""
     try:
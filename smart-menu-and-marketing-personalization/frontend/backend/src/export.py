@@ -0,0 +1,221 @@
+"""
+Nightly export of every user's top-K recommendations
+
+Users are walked in user_id order, ``EXPORT_CHUNK_SIZE`` at a time. Each
+chunk loads only its users and their order lines and is scored with one
+``recommend_hybrid_batch`` call, so memory does not grow with the user base.
+The last exported user_id is the cursor an export resumes from.
+
+Output is newline-delimited JSON (one user per line) or Parquet (one part
+file per chunk, one row per recommendation).
+
+    python -m src.export --format ndjson --output recs.ndjson --top 10
+    python -m src.export --format parquet --output recs/ --resume
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Iterator, Optional
+
+import pandas as pd
+
+from src.core.contextual import Context
+from src.core.hybrid import recommend_hybrid_batch
+from src.data_loader import load_items, load_user_chunk, recommender_setting
+
+logger = logging.getLogger(__name__)
+
+# One Parquet row per recommendation
+PARQUET_COLUMNS = {
+    'user_id': 'int64',
+    'rank': 'int32',
+    'item_id': 'int64',
+    'name': 'string',
+    'category': 'string',
+    'price': 'float64',
+    'score': 'float64',
+    'cf_score': 'float64',
+    'hybrid_score': 'float64',
+}
+
+
+def _require_pyarrow():
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet  # noqa: F401
+    except ImportError as e:
+        raise ImportError("Parquet export needs pyarrow (pip install pyarrow)") from e
+    return pa
+
+
+def score_chunk(users: pd.DataFrame, items: pd.DataFrame, orders: pd.DataFrame, top_k: int, now: pd.Timestamp,
+                time_of_day: Optional[str] = None, budget_level: Optional[str] = None) -> tuple:
+    """``(user_ids, results)`` for one chunk loaded by ``load_user_chunk``.
+
+    ``results`` holds one ``recommend_hybrid_batch`` entry per user: the
+    recommendations frame or the exception raised for that user.
+    """
+    user_ids = [int(u) for u in users['user_id']]
+    requests = [
+        (user_id, top_k, Context(user_id=user_id, now=now, time_of_day=time_of_day, budget_level=budget_level))
+        for user_id in user_ids
+    ]
+    return user_ids, recommend_hybrid_batch(requests, data=(users, items, orders))
+
+
+def iter_chunks(top_k: int = 10, after: Optional[int] = None, chunk_size: Optional[int] = None,
+                time_of_day: Optional[str] = None, budget_level: Optional[str] = None,
+                now: Optional[pd.Timestamp] = None) -> Iterator[tuple]:
+    """Yield :func:`score_chunk` results per chunk of users with a user_id above ``after``"""
+    chunk_size = chunk_size or recommender_setting('EXPORT_CHUNK_SIZE', 1000)
+    now = now or pd.Timestamp.now()
+    items = load_items()
+    while True:
+        users, orders = load_user_chunk(after, chunk_size, items)
+        if users.empty:
+            return
+        user_ids, results = score_chunk(users, items, orders, top_k, now, time_of_day, budget_level)
+        yield user_ids, results
+        after = user_ids[-1]
+        if len(user_ids) < chunk_size:
+            return
+
+
+def ndjson_chunk(user_ids: list, results: list) -> str:
+    """One JSON line per user: ``{"user_id", "recommendations"}`` or ``{"user_id", "error"}``"""
+    lines = []
+    for user_id, result in zip(user_ids, results):
+        if isinstance(result, Exception):
+            lines.append(json.dumps({"user_id": user_id, "error": str(result)}))
+        else:
+            lines.append(f'{{"user_id": {user_id}, "recommendations": {result.to_json(orient="records")}}}')
+    return "\n".join(lines) + "\n" if lines else ""
+
+
+def iter_ndjson(**kwargs) -> Iterator[str]:
+    """NDJSON text, one chunk of users at a time (arguments as :func:`iter_chunks`)"""
+    for user_ids, results in iter_chunks(**kwargs):
+        yield ndjson_chunk(user_ids, results)
+
+
+def parquet_frame(user_ids: list, results: list) -> pd.DataFrame:
+    """Long frame of one chunk: a row per (user, recommendation); failed users are left out"""
+    frames = []
+    for user_id, result in zip(user_ids, results):
+        if isinstance(result, Exception) or result.empty:
+            continue
+        frame = result.reindex(columns=list(PARQUET_COLUMNS)[2:]).reset_index(drop=True)
+        frame.insert(0, 'rank', range(1, len(frame) + 1))
+        frame.insert(0, 'user_id', user_id)
+        frames.append(frame)
+    if not frames:
+        return pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in PARQUET_COLUMNS.items()})
+    frame = pd.concat(frames, ignore_index=True)
+    for col in ('name', 'category'):
+        frame[col] = frame[col].where(frame[col].isna(), frame[col].astype(str))
+    return frame.astype(PARQUET_COLUMNS)
+
+
+def _write_atomic(path: Path, write):
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    write(tmp)
+    os.replace(tmp, path)
+
+
+def _write_parquet(path: Path, frame: pd.DataFrame):
+    pa = _require_pyarrow()
+    table = pa.Table.from_pandas(frame, preserve_index=False)
+    _write_atomic(path, lambda tmp: pa.parquet.write_table(table, tmp))
+
+
+def cursor_path(output) -> Path:
+    output = Path(output)
+    return output.with_name(output.name + '.cursor')
+
+
+def export(output, fmt: str = 'ndjson', top_k: int = 10, after: Optional[int] = None,
+           resume: bool = False, chunk_size: Optional[int] = None, time_of_day: Optional[str] = None,
+           budget_level: Optional[str] = None) -> dict:
+    """Export recommendations to ``output`` (a file for NDJSON, a directory for Parquet).
+
+    After every chunk the cursor file next to ``output`` records the last
+    exported user_id (and, for NDJSON, the file size at that point).
+    ``resume`` continues from it, dropping anything written past the cursor;
+    it refuses a cursor saved with another format, top_k, time or budget.
+    """
+    output = Path(output)
+    cursor_file = cursor_path(output)
+    state = {'format': fmt, 'top_k': top_k, 'time_of_day': time_of_day, 'budget_level': budget_level,
+             'after': after, 'offset': 0, 'users': 0, 'errors': 0}
+    if resume and cursor_file.exists():
+        saved = json.loads(cursor_file.read_text())
+        if saved.get('format') != fmt:
+            raise ValueError(f"Cursor {cursor_file} belongs to a {saved.get('format')} export")
+        # The rest of the export has to be scored as its first part was
+        for key in ('top_k', 'time_of_day', 'budget_level'):
+            if key in saved and saved[key] != state[key]:
+                raise ValueError(f"Cursor {cursor_file} belongs to an export with {key}={saved[key]!r}")
+        state.update(saved)
+        logger.info(f"Resuming export after user {state['after']}")
+
+    if fmt == 'ndjson':
+        if state['offset'] and not output.exists():
+            raise ValueError(f"Cannot resume: {output} is missing")
+        output.parent.mkdir(parents=True, exist_ok=True)
+        sink = open(output, 'r+b' if state['offset'] else 'wb')
+        sink.truncate(state['offset'])
+        sink.seek(state['offset'])
+    elif fmt == 'parquet':
+        _require_pyarrow()
+        output.mkdir(parents=True, exist_ok=True)
+        sink = None
+    else:
+        raise ValueError(f"Unknown export format: {fmt}")
+
+    try:
+        for user_ids, results in iter_chunks(top_k, state['after'], chunk_size, time_of_day, budget_level):
+            errors = sum(isinstance(result, Exception) for result in results)
+            if sink is not None:
+                sink.write(ndjson_chunk(user_ids, results).encode('utf-8'))
+                sink.flush()
+                os.fsync(sink.fileno())
+                state['offset'] = sink.tell()
+            else:
+                _write_parquet(output / f"part-{user_ids[0]:012d}.parquet", parquet_frame(user_ids, results))
+                if errors:
+                    logger.warning(f"{errors} users failed in the chunk starting at user {user_ids[0]}")
+            state['after'] = user_ids[-1]
+            state['users'] += len(user_ids)
+            state['errors'] += errors
+            _write_atomic(cursor_file, lambda tmp: tmp.write_text(json.dumps(state)))
+            logger.info(f"Exported {state['users']} users (cursor {state['after']})")
+    finally:
+        if sink is not None:
+            sink.close()
+    return state
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Smart Menu - export recommendations for all users")
+    parser.add_argument("--output", type=str, required=True, help="NDJSON file or Parquet directory")
+    parser.add_argument("--format", choices=["ndjson", "parquet"], default="ndjson")
+    parser.add_argument("--top", type=int, default=10, help="Top K recommendations per user")
+    parser.add_argument("--after", type=int, default=None, help="Start after this user_id")
+    parser.add_argument("--resume", action="store_true", help="Continue from the cursor file next to --output")
+    parser.add_argument("--chunk-size", type=int, default=None, help="Users per chunk (default: RECOMMENDER['EXPORT_CHUNK_SIZE'])")
+    parser.add_argument("--time", type=str, default=None, help="Time of day: morning|lunch|afternoon|dinner")
+    parser.add_argument("--budget", type=str, default=None, help="Budget level: low|mid|high")
+    args = parser.parse_args()
+
+    state = export(args.output, args.format, args.top, after=args.after, resume=args.resume,
+                   chunk_size=args.chunk_size, time_of_day=args.time, budget_level=args.budget)
+    print(f"Exported {state['users']} users ({state['errors']} failed), cursor {state['after']}")
+
+
+if __name__ == "__main__":
+    main()
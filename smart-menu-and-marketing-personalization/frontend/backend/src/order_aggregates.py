@@ -0,0 +1,143 @@
+"""
+In-process aggregates over the whole order history
+
+``load_all`` derives item popularity and user budget categories from the
+orders it loaded, which for a user-scoped call is only that user's orders.
+:class:`OrderAggregates` keeps the totals those columns need, over every
+order, so ``load_all`` can join against them whatever slice it loaded:
+
+* quantity ordered per (store_id, item_id), summed across stores for the
+  global popularity
+* order-line count and summed ``total_amount`` per user, for the average
+  order value behind ``budget_sensitivity``
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+
+import pandas as pd
+
+from src.data_loader import budget_categories, load_orders, recommender_setting
+
+logger = logging.getLogger(__name__)
+
+
+def _item_quantities(lines: pd.DataFrame) -> pd.Series:
+    return lines.groupby(['store_id', 'item_id'])['quantity'].sum().astype(float)
+
+
+def _user_amounts(lines: pd.DataFrame) -> pd.DataFrame:
+    amounts = pd.to_numeric(lines['total_amount'], errors='coerce')
+    return pd.DataFrame({
+        'amount': amounts.fillna(0.0).to_numpy(),
+        'lines': amounts.notna().to_numpy().astype(float),
+        'user_id': lines['user_id'].to_numpy(),
+    }).groupby('user_id')[['amount', 'lines']].sum()
+
+
+class OrderAggregates:
+    """Item quantities and user spend over all orders, updated incrementally.
+
+    An order-snapshot listener: ``reset(lines)`` recomputes everything and
+    ``apply(added, removed)`` adds the new lines' totals and takes the
+    replaced lines' totals out.
+    """
+
+    def __init__(self, lines: pd.DataFrame | None = None):
+        self._lock = threading.RLock()
+        self.reset(lines if lines is not None else pd.DataFrame())
+
+    def reset(self, lines: pd.DataFrame):
+        with self._lock:
+            if lines.empty:
+                self._quantities = pd.Series(dtype=float, index=pd.MultiIndex.from_arrays(
+                    [[], []], names=['store_id', 'item_id']))
+                self._amounts = pd.DataFrame(columns=['amount', 'lines'], dtype=float,
+                                             index=pd.Index([], name='user_id'))
+            else:
+                self._quantities = _item_quantities(lines)
+                self._amounts = _user_amounts(lines)
+            self._popularity = {}
+            self._budgets = None
+            self.updates = 0
+
+    def apply(self, added: pd.DataFrame, removed: pd.DataFrame):
+        with self._lock:
+            quantities, amounts = self._quantities, self._amounts
+            if not added.empty:
+                quantities = quantities.add(_item_quantities(added), fill_value=0.0)
+                amounts = amounts.add(_user_amounts(added), fill_value=0.0)
+            if not removed.empty:
+                quantities = quantities.sub(_item_quantities(removed), fill_value=0.0)
+                amounts = amounts.sub(_user_amounts(removed), fill_value=0.0)
+            self._quantities = quantities[quantities > 0]
+            self._amounts = amounts[amounts['lines'] > 0]
+            self._popularity = {}
+            self._budgets = None
+            self.updates += 1
+
+    def popularity(self, store_id: int | None = None) -> pd.Series:
+        """Quantity ordered per item_id, min-max normalized (one store, or all stores)"""
+        with self._lock:
+            if store_id not in self._popularity:
+                if store_id is None:
+                    quantities = self._quantities.groupby(level='item_id').sum()
+                else:
+                    quantities = self._quantities.xs(store_id, level='store_id') \
+                        if store_id in self._quantities.index.get_level_values('store_id') else pd.Series(dtype=float)
+                if not quantities.empty:
+                    quantities = (quantities - quantities.min()) / (quantities.max() - quantities.min() + 1e-6)
+                self._popularity[store_id] = quantities
+            return self._popularity[store_id]
+
+    def budget_categories(self) -> pd.Series:
+        """``budget_sensitivity`` per user_id from their average order value"""
+        with self._lock:
+            if self._budgets is None:
+                self._budgets = budget_categories(self._amounts['amount'] / self._amounts['lines'])
+            return self._budgets
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                'items': int(self._quantities.index.get_level_values('item_id').nunique()),
+                'users': len(self._amounts),
+                'updates': self.updates,
+            }
+
+
+_order_aggregates = None
+_order_aggregates_built = None  # build time for in-process aggregates, None when following the snapshot
+_order_aggregates_lock = threading.Lock()
+
+
+def _is_stale(built) -> bool:
+    if built is None:
+        return False
+    return time.monotonic() - built > recommender_setting('ORDER_AGGREGATES_MAX_AGE_SECONDS', 300)
+
+
+def get_order_aggregates() -> OrderAggregates:
+    """Process-wide order aggregates.
+
+    With the order snapshot enabled they follow it incrementally; otherwise
+    they are rebuilt from ``load_orders`` after ``ORDER_AGGREGATES_MAX_AGE_SECONDS``.
+    """
+    global _order_aggregates, _order_aggregates_built
+    if _order_aggregates is None or _is_stale(_order_aggregates_built):
+        with _order_aggregates_lock:
+            if _order_aggregates is None or _is_stale(_order_aggregates_built):
+                if recommender_setting('ORDER_SNAPSHOT', False):
+                    from src.order_snapshot import get_order_snapshot
+
+                    aggregates = OrderAggregates()
+                    snapshot = get_order_snapshot()
+                    snapshot.refresh()
+                    snapshot.subscribe(aggregates)
+                    _order_aggregates, _order_aggregates_built = aggregates, None
+                else:
+                    _order_aggregates, _order_aggregates_built = OrderAggregates(load_orders()), time.monotonic()
+    return _order_aggregates
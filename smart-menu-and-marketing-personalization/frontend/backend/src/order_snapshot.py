@@ -0,0 +1,332 @@
+"""
+In-process snapshot of the exploded order-line frame
+
+The first read loads every order once; later reads only fetch orders newer
+than the (created_at, id) watermark plus orders whose ``updated_at`` moved
+(status changes, edited items), so serving ``load_orders`` no longer costs a
+full table scan per request.
+
+Reads never wait for a refresh in progress: the loaded frame is swapped in
+as a whole, and a reader that finds another thread refreshing serves the
+current frame. Listeners are notified after the swap, outside the refresh
+lock, in the order the refreshes happened.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+import logging
+from collections import deque
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from src.data_loader import (
+    ORDER_LINE_COLUMNS,
+    explode_order_items,
+    load_raw_orders,
+    recommender_setting,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def _sql_value(value):
+    """Turn a value read back from the database into a query parameter"""
+    if hasattr(value, 'to_pydatetime'):
+        return value.to_pydatetime()
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+
+class _View:
+    """One loaded frame and, computed on first use, the row positions of each user's lines"""
+
+    __slots__ = ('lines', '_positions')
+
+    def __init__(self, lines: pd.DataFrame):
+        self.lines = lines
+        self._positions = None
+
+    def positions(self) -> dict:
+        # Two readers may both compute them; either result is the same
+        if self._positions is None:
+            self._positions = self.lines.groupby('user_id').indices if len(self.lines) else {}
+        return self._positions
+
+
+class OrderSnapshot:
+    """Order lines kept in memory and refreshed from a created_at/id watermark.
+
+    Listeners registered with :meth:`subscribe` are kept in step with the
+    snapshot: ``reset(lines)`` receives the full frame after a (re)load and
+    ``apply(added, removed)`` receives the lines that appeared and the lines
+    that were replaced by each incremental refresh.
+    """
+
+    def __init__(self, refresh_interval: float | None = None, full_reload_interval: float | None = None):
+        self.refresh_interval = (
+            refresh_interval if refresh_interval is not None
+            else recommender_setting('ORDER_SNAPSHOT_REFRESH_SECONDS', 1.0)
+        )
+        self.full_reload_interval = (
+            full_reload_interval if full_reload_interval is not None
+            else recommender_setting('ORDER_SNAPSHOT_FULL_RELOAD_SECONDS', 3600)
+        )
+        self._refresh_lock = threading.Lock()  # one refresh at a time; readers only try it
+        self._view: Optional[_View] = None
+        self._notify_lock = threading.Lock()  # held while listeners are called
+        self._events = deque()  # ('reset', lines) / ('apply', added, removed, lines) not yet delivered
+        self._notified_lines: Optional[pd.DataFrame] = None  # frame the listeners are in step with
+        self._created_watermark = None  # (created_at, id) of the newest order seen
+        self._updated_watermark = None  # newest updated_at seen
+        self._listeners = []
+        self._last_refresh = 0.0
+        self._last_full_load = 0.0
+        self.version = 0
+        self.refreshes = 0
+        self.full_loads = 0
+        self.last_delta_orders = 0
+
+    # ------------------------------------------------------------------
+    # Listeners
+    # ------------------------------------------------------------------
+    def subscribe(self, listener):
+        """Register a listener; it is reset immediately if data is already loaded.
+
+        The reset uses the frame the other listeners are in step with, so
+        updates still waiting to be delivered reach it exactly once.
+        """
+        with self._notify_lock:
+            self._listeners.append(listener)
+            if self._notified_lines is not None:
+                listener.reset(self._notified_lines)
+        self._notify()  # events queued while we held the lock
+
+    def _deliver(self, event: tuple):
+        kind, args, lines = event[0], event[1:-1], event[-1]
+        for listener in self._listeners:
+            try:
+                getattr(listener, kind)(*args)
+            except Exception as e:
+                logger.error(f"Order snapshot listener {listener!r} failed on {kind}: {e}")
+        self._notified_lines = lines
+
+    def _notify(self):
+        """Deliver queued events in order; returns at once if another thread is delivering them"""
+        while self._events:
+            if not self._notify_lock.acquire(blocking=False):
+                return  # the delivering thread picks up our events before it lets go
+            try:
+                while self._events:
+                    self._deliver(self._events.popleft())
+            finally:
+                self._notify_lock.release()
+
+    # ------------------------------------------------------------------
+    # Loading
+    # ------------------------------------------------------------------
+    def _advance_watermarks(self, raw: pd.DataFrame):
+        newest = raw.sort_values(['timestamp', 'order_id']).iloc[-1]
+        created = (newest['timestamp'], int(newest['order_id']))
+        if self._created_watermark is None or created > self._created_watermark:
+            self._created_watermark = created
+        if 'updated_at' in raw.columns and raw['updated_at'].notna().any():
+            updated = raw['updated_at'].max()
+            if self._updated_watermark is None or updated > self._updated_watermark:
+                self._updated_watermark = updated
+
+    def _seed_from_columnar(self) -> bool:
+        """Start from the published columnar snapshot, if any, instead of a full scan"""
+        from src.columnar_snapshot import get_columnar_snapshot
+
+        snapshot = get_columnar_snapshot()
+        watermark = snapshot.watermark if snapshot is not None else None
+        if watermark is None or watermark['created_at'] is None:
+            return False
+        lines = snapshot.frames['orders'].copy(deep=False)
+        self._created_watermark = (watermark['created_at'], watermark['order_id'])
+        self._updated_watermark = watermark['updated_at']
+        self._swap(lines, ('reset', lines, lines))
+        self.full_loads += 1
+        self._last_full_load = time.monotonic()
+        logger.info(f"Order snapshot seeded from columnar snapshot {snapshot.version} ({len(lines)} lines)")
+        self._incremental_load()
+        return True
+
+    def watermark(self) -> Optional[dict]:
+        """Watermarks of the loaded lines, as stored alongside a columnar snapshot"""
+        if self._created_watermark is None:
+            return None
+        created_at, order_id = self._created_watermark
+        return {'created_at': created_at, 'order_id': order_id, 'updated_at': self._updated_watermark}
+
+    def _full_load(self):
+        if self.full_loads == 0 and self._seed_from_columnar():
+            return
+        raw = load_raw_orders()
+        self._created_watermark = None
+        self._updated_watermark = None
+        if raw.empty:
+            lines = pd.DataFrame(columns=ORDER_LINE_COLUMNS)
+        else:
+            lines = explode_order_items(raw)
+            self._advance_watermarks(raw)
+        self._swap(lines, ('reset', lines, lines))
+        self.full_loads += 1
+        self._last_full_load = time.monotonic()
+        logger.info(f"Order snapshot loaded {len(raw)} orders ({len(lines)} lines)")
+
+    def _incremental_load(self):
+        if self._created_watermark is None:
+            # Nothing seen yet: an empty table, so just look again
+            return self._full_load()
+
+        created_at, order_id = self._created_watermark
+        conditions = ["(o.created_at > %s OR (o.created_at = %s AND o.id > %s)"]
+        params = [_sql_value(created_at), _sql_value(created_at), order_id]
+        if self._updated_watermark is not None:
+            conditions[0] += " OR o.updated_at > %s"
+            params.append(_sql_value(self._updated_watermark))
+        conditions[0] += ")"
+
+        raw = load_raw_orders(conditions, params)
+        self.last_delta_orders = len(raw)
+        if raw.empty:
+            return
+
+        current = self._view.lines
+        changed = current['order_id'].isin(raw['order_id'])
+        removed = current.loc[changed]
+        added = explode_order_items(raw)
+
+        is_new = (raw['timestamp'] > created_at) | (
+            (raw['timestamp'] == created_at) & (raw['order_id'] > order_id)
+        )
+        lines = pd.concat([added, current.loc[~changed]], ignore_index=True)
+        if not is_new.all():
+            # Edited orders keep their original created_at; put them back in place
+            lines = lines.sort_values(['timestamp', 'order_id'], ascending=[False, True],
+                                      kind='stable', ignore_index=True)
+
+        self._advance_watermarks(raw)
+        self._swap(lines, ('apply', added, removed, lines))
+        logger.info(f"Order snapshot refreshed: {int(is_new.sum())} new, "
+                    f"{int((~is_new).sum())} updated orders")
+
+    def _swap(self, lines: pd.DataFrame, event: tuple):
+        """Publish a new frame to readers and queue its listener event (caller holds the refresh lock)"""
+        self._events.append(event)
+        self._view = _View(lines)
+        self.version += 1
+
+    def _refresh_locked(self, force: bool):
+        """Load what is due (caller holds the refresh lock)"""
+        now = time.monotonic()
+        if self._view is None or (
+            self.full_reload_interval and now - self._last_full_load >= self.full_reload_interval
+        ):
+            self._full_load()
+        elif force or now - self._last_refresh >= self.refresh_interval:
+            self._incremental_load()
+        else:
+            return
+        self._last_refresh = now
+        self.refreshes += 1
+
+    def refresh(self, force: bool = False) -> pd.DataFrame:
+        """Bring the snapshot up to date; throttled to ``refresh_interval``.
+
+        Waits for a refresh already running in another thread. Listeners
+        are notified after the refresh lock is released.
+        """
+        try:
+            with self._refresh_lock:
+                self._refresh_locked(force)
+        finally:
+            self._notify()
+        return self._view.lines
+
+    # ------------------------------------------------------------------
+    # Reads
+    # ------------------------------------------------------------------
+    def _current(self, with_positions: bool = False) -> tuple:
+        """The refreshed frame and, if asked, its per-user positions, from one view.
+
+        A refresh swaps in a frame with a different row order, so positions
+        are only valid for the frame they were computed from. When another
+        thread is refreshing, the current frame is served without waiting;
+        only the very first load is waited for.
+        """
+        try:
+            if self._view is None:
+                self.refresh()
+            elif self._refresh_lock.acquire(blocking=False):
+                try:
+                    self._refresh_locked(False)
+                finally:
+                    self._refresh_lock.release()
+                    self._notify()
+        except Exception as e:
+            logger.error(f"Error refreshing order snapshot: {e}")
+        view = self._view
+        if view is None:
+            return None, {}
+        return view.lines, view.positions() if with_positions else None
+
+    def frame(self, user_id: Optional[int] = None, store_id: Optional[int] = None) -> pd.DataFrame:
+        """Current order-line frame, optionally narrowed to one user and/or store"""
+        lines, positions = self._current(with_positions=user_id is not None)
+        if lines is None:
+            return pd.DataFrame()
+
+        if user_id is not None:
+            positions = positions.get(user_id)
+            if positions is None:
+                return pd.DataFrame()
+            lines = lines.take(positions)
+        if store_id is not None:
+            lines = lines.loc[lines['store_id'] == store_id]
+        if lines.empty:
+            return pd.DataFrame()
+        return lines.reset_index(drop=True) if user_id is not None or store_id is not None else lines.copy(deep=False)
+
+    def frame_for_users(self, user_ids) -> pd.DataFrame:
+        """Current order lines of the given users"""
+        lines, positions = self._current(with_positions=True)
+        if lines is None:
+            return pd.DataFrame()
+        found = [positions[u] for u in user_ids if u in positions]
+        if not found:
+            return pd.DataFrame()
+        return lines.take(np.sort(np.concatenate(found))).reset_index(drop=True)
+
+    def stats(self) -> dict:
+        lines = None if self._view is None else self._view.lines
+        return {
+            'version': self.version,
+            'lines': 0 if lines is None else len(lines),
+            'orders': 0 if lines is None else int(lines['order_id'].nunique()),
+            'watermark': None if self._created_watermark is None else [str(v) for v in self._created_watermark],
+            'updated_watermark': None if self._updated_watermark is None else str(self._updated_watermark),
+            'refreshes': self.refreshes,
+            'full_loads': self.full_loads,
+            'last_delta_orders': self.last_delta_orders,
+        }
+
+
+_order_snapshot = None
+_order_snapshot_lock = threading.Lock()
+
+
+def get_order_snapshot() -> OrderSnapshot:
+    """Get the process-wide order snapshot"""
+    global _order_snapshot
+    if _order_snapshot is None:
+        with _order_snapshot_lock:
+            if _order_snapshot is None:
+                _order_snapshot = OrderSnapshot()
+    return _order_snapshot
@@ -0,0 +1,342 @@
+"""
+Bounded LRU + TTL cache for recommendation responses
+
+Entries are stored pickled, so a hit always hands back a fresh copy that the
+caller may modify, and the byte bound is the size of what is stored. Keys
+are tuples whose first element is the user_id, which lets
+:meth:`RecommendationCache.invalidate_user` drop every entry of one user.
+
+:class:`OrderChangeWatcher` keeps the cache honest without the order
+snapshot: it polls ``slice_order`` for orders created or edited since its
+``updated_at`` watermark and invalidates their users.
+
+:class:`SingleFlight` covers the misses: concurrent callers with the same key
+wait for one computation instead of each running it. :class:`AsyncSingleFlight`
+does the same for coroutines, so the waiting callers hold no thread.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+from src.data_loader import recommender_setting, safe_read_sql
+
+logger = logging.getLogger(__name__)
+
+
+class RecommendationCache:
+    """LRU cache bounded by entry count and total bytes, with a per-entry TTL.
+
+    Also an order-snapshot listener: ``apply(added, removed)`` invalidates
+    the users whose orders changed and ``reset(lines)`` clears everything.
+
+    A computation that may race with an invalidation takes a
+    :meth:`generation` token before it loads its data and hands it to
+    :meth:`put`, which drops the result if the user was invalidated since.
+    """
+
+    def __init__(self, max_entries: int | None = None, max_bytes: int | None = None,
+                 ttl: float | None = None):
+        self.max_entries = max_entries or recommender_setting('RECOMMENDATION_CACHE_MAX_ENTRIES', 1024)
+        self.max_bytes = max_bytes or recommender_setting('RECOMMENDATION_CACHE_MAX_BYTES', 64 * 2**20)
+        self.ttl = ttl if ttl is not None else recommender_setting('RECOMMENDATION_CACHE_TTL_SECONDS', 300)
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, pickled value)
+        self._user_keys = {}  # user_id -> keys cached for that user
+        self._generation = 0  # bumped by clear()
+        self._user_generations = {}  # user_id -> bumped by invalidate_user()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.stale_puts = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _remove(self, key):
+        _, data = self._entries.pop(key)
+        self.bytes -= len(data)
+        keys = self._user_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._user_keys[key[0]]
+
+    def get(self, key):
+        """A fresh copy of the cached value, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            data = entry[1]
+        return pickle.loads(data)
+
+    def generation(self, user_id: int) -> tuple:
+        """Token for a computation of ``user_id``'s entries that starts now"""
+        with self._lock:
+            return self._generation, self._user_generations.get(user_id, 0)
+
+    def put(self, key, value, generation: tuple | None = None):
+        self.put_pickled(key, pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), generation)
+
+    def put_pickled(self, key, data: bytes, generation: tuple | None = None):
+        """Store a value the caller has already pickled.
+
+        With a ``generation`` token, the value is dropped if the user was
+        invalidated (or the cache cleared) after the token was taken.
+        """
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            if generation is not None and generation != (self._generation, self._user_generations.get(key[0], 0)):
+                self.stale_puts += 1
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, data)
+            self._user_keys.setdefault(key[0], set()).add(key)
+            self.bytes += len(data)
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate_user(self, user_id: int) -> int:
+        """Drop every entry of ``user_id``; returns how many were dropped"""
+        with self._lock:
+            # Bumped even with nothing cached: a computation may be in flight
+            self._user_generations[user_id] = self._user_generations.get(user_id, 0) + 1
+            keys = list(self._user_keys.get(user_id, ()))
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._user_keys.clear()
+            self.bytes = 0
+
+    # ------------------------------------------------------------------
+    # Order snapshot listener
+    # ------------------------------------------------------------------
+    def reset(self, lines):
+        self.clear()
+
+    def apply(self, added, removed):
+        users = set(added['user_id'].tolist()) if not added.empty else set()
+        if not removed.empty:
+            users.update(removed['user_id'].tolist())
+        for user_id in users:
+            self.invalidate_user(user_id)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self.bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'ttl_seconds': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'stale_puts': self.stale_puts,
+            }
+
+
+class OrderChangeWatcher:
+    """Invalidates a cache's entries for users whose orders changed, by polling the database.
+
+    Orders are placed through the Django app, usually in another process, so
+    there is no in-process hook to call: :meth:`poll` asks for the users of
+    orders whose ``updated_at`` (set on create and on every save) moved past
+    the watermark, at most every ``RECOMMENDATION_CACHE_POLL_SECONDS``.
+    """
+
+    def __init__(self, cache: RecommendationCache, interval: float | None = None):
+        self.cache = cache
+        self.interval = interval if interval is not None else recommender_setting('RECOMMENDATION_CACHE_POLL_SECONDS', 2.0)
+        self._lock = threading.Lock()
+        self._watermark = None  # newest updated_at seen
+        self._started = False
+        self._last_poll = 0.0
+        self.polls = 0
+        self.changed_orders = 0
+
+    def poll(self, force: bool = False) -> int:
+        """Invalidate the users of orders changed since the last poll; returns how many orders changed"""
+        if not force and time.monotonic() - self._last_poll < self.interval:
+            return 0
+        if not self._lock.acquire(blocking=False):
+            return 0  # another request is polling
+        try:
+            self._last_poll = time.monotonic()
+            self.polls += 1
+            if not self._started:
+                newest = safe_read_sql("SELECT MAX(updated_at) AS updated_at FROM slice_order")['updated_at'].iloc[0]
+                self._watermark = None if pd.isna(newest) else newest
+                self._started = True
+                return 0
+            if self._watermark is None:
+                changed = safe_read_sql(
+                    "SELECT user_id, updated_at FROM slice_order WHERE user_id IS NOT NULL")
+            else:
+                watermark = self._watermark
+                if hasattr(watermark, 'to_pydatetime'):
+                    watermark = watermark.to_pydatetime()
+                changed = safe_read_sql(
+                    "SELECT user_id, updated_at FROM slice_order WHERE user_id IS NOT NULL AND updated_at > %s",
+                    (watermark,))
+            if changed.empty:
+                return 0
+            for user_id in set(changed['user_id'].tolist()):
+                self.cache.invalidate_user(int(user_id))
+            self._watermark = changed['updated_at'].max()
+            self.changed_orders += len(changed)
+            return len(changed)
+        except Exception as e:
+            logger.error(f"Could not poll for changed orders: {e}")
+            return 0
+        finally:
+            self._lock.release()
+
+    def stats(self) -> dict:
+        return {
+            'interval_seconds': self.interval,
+            'polls': self.polls,
+            'changed_orders': self.changed_orders,
+            'watermark': None if self._watermark is None else str(self._watermark),
+        }
+
+
+class _Call:
+    __slots__ = ('done', 'value', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SingleFlight:
+    """Runs one computation per key at a time; concurrent callers share its outcome.
+
+    The value is handed to every caller as is, so it should be immutable
+    (``SmartRecommender`` passes pickled bytes). An exception raised by the
+    computation is raised in every waiting caller too.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.executions = 0
+        self.coalesced = 0
+        self.failures = 0
+
+    def do(self, key, fn):
+        """``(fn(), shared)``, where ``shared`` is True when another caller ran ``fn``"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+                self.executions += 1
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.value, True
+
+        try:
+            call.value = fn()
+        except BaseException as error:
+            call.error = error
+            with self._lock:
+                self.failures += 1
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.value, False
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.executions + self.coalesced
+            return {
+                'in_flight': len(self._calls),
+                'executions': self.executions,
+                'coalesced': self.coalesced,
+                'coalesced_rate': self.coalesced / requests if requests else 0.0,
+                'failures': self.failures,
+            }
+
+
+class AsyncSingleFlight:
+    """:class:`SingleFlight` for coroutines running on one event loop.
+
+    Followers await the leader's task instead of blocking a worker thread,
+    so a burst of identical requests takes one slot on the lanes the
+    computation uses. The task is shielded: a leader whose client goes away
+    does not cancel the computation the followers are waiting for.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self.executions = 0
+        self.coalesced = 0
+        self.failures = 0
+
+    def _finished(self, key, task):
+        del self._calls[key]
+        if not task.cancelled() and task.exception() is not None:
+            self.failures += 1
+
+    async def do(self, key, fn):
+        """``(await fn(), shared)``, where ``shared`` is True when another caller ran ``fn``"""
+        task = self._calls.get(key)
+        shared = task is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            task = self._calls[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda done: self._finished(key, done))
+            self.executions += 1
+        return await asyncio.shield(task), shared
+
+    def stats(self) -> dict:
+        requests = self.executions + self.coalesced
+        return {
+            'in_flight': len(self._calls),
+            'executions': self.executions,
+            'coalesced': self.coalesced,
+            'coalesced_rate': self.coalesced / requests if requests else 0.0,
+            'failures': self.failures,
+        }
@@ -9,11 +9,16 @@ from typing import Dict, List, Optional, Any
 from datetime import datetime, timedelta
 import json
 import logging
+import pickle
+import threading
 
 logger = logging.getLogger(__name__)
 
-from src.core.hybrid import recommend_hybrid as base_recommend
+from src.core.hybrid import recommend_hybrid as base_recommend, recommend_hybrid_batch
 from src.core.contextual import Context
+from src.core.rerank import PairwiseSimilarity, cf_pairwise_similarity, rerank
+from src.data_loader import recommender_setting
+from src.recommendation_cache import OrderChangeWatcher, RecommendationCache, SingleFlight
 from .utils import print_df, season_of
 
 
@@ -22,37 +27,153 @@ class SmartRecommender:
     
     def __init__(self):
         self.user_preferences = {}  # Cache user preferences
-        self.recommendation_cache = {}  # Simple in-memory cache
+        self.recommendation_cache = RecommendationCache()
+        self.in_flight = SingleFlight()  # coalesces concurrent misses on the same cache key
+        # New or edited orders invalidate the user's cached recommendations
+        self.order_changes = None
+        if recommender_setting('ORDER_SNAPSHOT', False):
+            from src.order_snapshot import get_order_snapshot
+            get_order_snapshot().subscribe(self.recommendation_cache)
+        else:
+            self.order_changes = OrderChangeWatcher(self.recommendation_cache)
+            self.order_changes.poll()
         self.feedback_data = []  # Store user feedback
         self.impression_count = 0
         
+    def cached_recommendations(self, user_id: int, top_k: int, context: Context, user_query: str = None,
+                               include_explanation: bool = False) -> Optional[Dict[str, Any]]:
+        """The cached response for these arguments, or None (``context`` must be ensured)"""
+        self._poll_order_changes()
+        cached_result = self.recommendation_cache.get(
+            self._cache_key(user_id, top_k, context, user_query, include_explanation))
+        if cached_result is not None:
+            cached_result['metadata']['from_cache'] = True
+            cached_result['metadata']['processing_time_seconds'] = 0.001
+        return cached_result
+
     def get_recommendations(self, user_id: int, top_k: int = 10, 
                           context: Context = None, user_query: str = None,
-                          include_explanation: bool = False) -> Dict[str, Any]:
-        """Get smart recommendations with impressive features"""
+                          include_explanation: bool = False, data: tuple = None,
+                          lookup_cache: bool = True, generation: tuple = None) -> Dict[str, Any]:
+        """Get smart recommendations with impressive features
+
+        ``data`` is the ``load_all(user_id=user_id)`` result when the caller
+        has already loaded it (only used on a cache miss), and ``generation``
+        the cache's :meth:`RecommendationCache.generation` token taken before
+        loading it. Pass ``lookup_cache=False`` when the caller has just
+        missed in :meth:`cached_recommendations`, so the miss is not counted
+        twice.
+        """
         
         start_time = datetime.now()
         
-        # Check cache first
-        cache_key = f"{user_id}_{context.time_of_day if context else 'default'}_{context.budget_level if context else 'default'}"
-        if cache_key in self.recommendation_cache:
-            cached_result = self.recommendation_cache[cache_key]
-            cached_result['metadata']['from_cache'] = True
-            cached_result['metadata']['processing_time_seconds'] = 0.001
-            return cached_result
-        
         # Generate context if not provided
         if not context:
-            context = Context(user_id=user_id, now=datetime.now()).ensure()
+            context = Context(user_id=user_id, now=datetime.now())
+        context.ensure()
+        
+        # Check cache first
+        if lookup_cache:
+            cached_result = self.cached_recommendations(user_id, top_k, context, user_query, include_explanation)
+            if cached_result is not None:
+                return cached_result
+        cache_key = self._cache_key(user_id, top_k, context, user_query, include_explanation)
+        if generation is None:
+            generation = self.recommendation_cache.generation(user_id)
+        
+        # Concurrent misses on the same key share one computation; the result
+        # travels pickled so every caller unpickles its own copy
+        payload, shared = self.in_flight.do(
+            cache_key,
+            lambda: self._compute_recommendations(cache_key, user_id, top_k, context, user_query,
+                                                  include_explanation, start_time, data=data,
+                                                  generation=generation))
+        result = pickle.loads(payload)
+        if shared:
+            result['metadata']['coalesced'] = True
+            result['metadata']['processing_time_seconds'] = (datetime.now() - start_time).total_seconds()
+        return result
+    
+    def get_recommendations_batch(self, requests: List[Dict[str, Any]], user_query: str = None,
+                                  include_explanation: bool = False, data: tuple = None,
+                                  lookup_cache: bool = True) -> List[Dict[str, Any]]:
+        """Smart recommendations for many users at once.
+
+        ``requests`` holds dicts with ``user_id``, ``top_k`` and ``context``,
+        plus the ``generation`` token when ``data`` was loaded by the caller.
+        Cached responses are served as in :meth:`get_recommendations`; the
+        base recommendations of the rest come from one
+        ``recommend_hybrid_batch`` call. Returns one response per request, in
+        order; a request that failed gets ``{'error': message}`` instead.
+        ``data`` is passed on to ``recommend_hybrid_batch``; ``lookup_cache``
+        is as in :meth:`get_recommendations`.
+        """
+        start_time = datetime.now()
+        results = [None] * len(requests)
+        keys = []
+        misses = []
+        for i, request in enumerate(requests):
+            context = request.get('context') or Context(user_id=request['user_id'], now=datetime.now())
+            context.ensure()
+            generation = request.get('generation') or self.recommendation_cache.generation(request['user_id'])
+            request = dict(request, context=context, generation=generation)
+            key = self._cache_key(request['user_id'], request['top_k'], context, user_query, include_explanation)
+            keys.append(key)
+            cached_result = None
+            if lookup_cache:
+                cached_result = self.cached_recommendations(request['user_id'], request['top_k'], context,
+                                                            user_query, include_explanation)
+            if cached_result is not None:
+                results[i] = cached_result
+            else:
+                misses.append((i, request))
+        
+        base = recommend_hybrid_batch([(r['user_id'], r['top_k'] * 2, r['context']) for _, r in misses], data=data)
+        similarity = cf_pairwise_similarity() if misses else None
+        for (i, request), base_recs in zip(misses, base):
+            if isinstance(base_recs, Exception):
+                results[i] = {'error': str(base_recs)}
+                continue
+            try:
+                payload = self._compute_recommendations(keys[i], request['user_id'], request['top_k'],
+                                                        request['context'], user_query, include_explanation,
+                                                        start_time, base_recs=base_recs,
+                                                        generation=request['generation'], similarity=similarity)
+                results[i] = pickle.loads(payload)
+            except Exception as e:
+                logger.error(f"Error generating recommendations for user {request['user_id']}: {e}")
+                results[i] = {'error': str(e)}
+        return results
+    
+    def _poll_order_changes(self):
+        """Without the order snapshot, drop cached responses of users whose orders changed"""
+        if self.order_changes is not None:
+            self.order_changes.poll()
+
+    def _compute_recommendations(self, cache_key: tuple, user_id: int, top_k: int, context: Context,
+                                 user_query: Optional[str], include_explanation: bool,
+                                 start_time: datetime, base_recs: pd.DataFrame = None, data: tuple = None,
+                                 generation: tuple = None, similarity: PairwiseSimilarity = None) -> bytes:
+        """Run the recommendation pipeline; returns the pickled response, which is also cached.
+
+        ``base_recs`` are the user's ``top_k * 2`` hybrid recommendations when
+        the caller already has them; otherwise they are ranked from ``data``
+        (loaded here when None). ``similarity`` is the MMR item similarity,
+        resolved here when None. The response is not cached if the user was
+        invalidated after ``generation`` was taken: it may predate their
+        latest order.
+        """
         
         # Process user query for smart filtering
         search_filters = self._process_user_query(user_query) if user_query else {}
         
         # Get base recommendations
-        base_recs = base_recommend(user_id, top_k * 2, context)
+        if base_recs is None:
+            base_recs = base_recommend(user_id, top_k * 2, context, data=data)
         
         if base_recs.empty:
-            return self._format_response(pd.DataFrame(), context, False, 0.001)
+            return pickle.dumps(self._format_response(pd.DataFrame(), context, False, 0.001),
+                                protocol=pickle.HIGHEST_PROTOCOL)
         
         # Apply smart filters
         filtered_recs = self._apply_smart_filters(base_recs, search_filters)
@@ -61,7 +182,9 @@ class SmartRecommender:
         personalized_recs = self._apply_personalization_boost(filtered_recs, user_id)
         
         # Apply diversity enhancement
-        diverse_recs = self._apply_diversity_enhancement(personalized_recs, top_k)
+        if similarity is None:
+            similarity = cf_pairwise_similarity()
+        diverse_recs = self._apply_diversity_enhancement(personalized_recs, top_k, similarity)
         
         # Add smart scoring
         smart_recs = self._add_smart_scoring(diverse_recs, context)
@@ -72,12 +195,20 @@ class SmartRecommender:
         # Cache results
         processing_time = (datetime.now() - start_time).total_seconds()
         result = self._format_response(final_recs, context, include_explanation, processing_time)
-        self.recommendation_cache[cache_key] = result.copy()
+        payload = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+        self.recommendation_cache.put_pickled(cache_key, payload, generation)
         
         # Track impressions
         self.impression_count += 1
         
-        return result
+        return payload
+    
+    @staticmethod
+    def _cache_key(user_id: int, top_k: int, context: Context, user_query: Optional[str],
+                   include_explanation: bool) -> tuple:
+        """Every input that changes the response; the user_id comes first for invalidation"""
+        return (user_id, top_k, context.time_of_day, context.budget_level,
+                (user_query or '').strip().lower(), bool(include_explanation))
     
     def _process_user_query(self, query: str) -> Dict[str, Any]:
         """Process natural language query for smart filtering"""
@@ -222,26 +353,10 @@ class SmartRecommender:
         
         return boosted
     
-    def _apply_diversity_enhancement(self, recommendations: pd.DataFrame, top_k: int) -> pd.DataFrame:
+    def _apply_diversity_enhancement(self, recommendations: pd.DataFrame, top_k: int,
+                                     similarity: PairwiseSimilarity = None) -> pd.DataFrame:
         """Apply diversity enhancement to ensure variety"""
-        if recommendations.empty:
-            return recommendations
-        
-        diversified = []
-        category_counts = {}
-        max_per_category = max(1, top_k // 3)  # Max 1/3 of recommendations per category
-        
-        for _, row in recommendations.iterrows():
-            category = row.get('category', 'unknown')
-            count = category_counts.get(category, 0)
-            
-            if count < max_per_category:
-                diversified.append(row)
-                category_counts[category] = count + 1
-            elif len(diversified) < top_k:  # Allow some overflow
-                diversified.append(row)
-        
-        return pd.DataFrame(diversified) if diversified else recommendations.head(top_k)
+        return rerank(recommendations, top_k, 'score', similarity=similarity)
     
     def _add_smart_scoring(self, recommendations: pd.DataFrame, context: Context) -> pd.DataFrame:
         """Add smart scoring based on multiple factors"""
@@ -293,6 +408,7 @@ class SmartRecommender:
                 'budget_level': context.budget_level,
                 'total_recommendations': len(recommendations),
                 'from_cache': False,
+                'coalesced': False,
                 'processing_time_seconds': processing_time,
                 'timestamp': datetime.now().isoformat(),
                 'system_version': '2.0.0'
@@ -340,6 +456,7 @@ class SmartRecommender:
     def set_user_preferences(self, user_id: int, preferences: Dict[str, Any]):
         """Set user preferences for personalization"""
         self.user_preferences[user_id] = preferences
+        self.invalidate_user(user_id)
         logger.info(f"Updated preferences for user {user_id}")
     
     def record_feedback(self, user_id: int, item_id: int, rating: float, feedback_type: str = 'rating'):
@@ -352,13 +469,23 @@ class SmartRecommender:
             'timestamp': datetime.now()
         }
         self.feedback_data.append(feedback)
+        self.invalidate_user(user_id)
         logger.info(f"Recorded {feedback_type} feedback for user {user_id}, item {item_id}")
     
+    def invalidate_user(self, user_id: int):
+        """Drop the user's cached recommendations (call after they order or give feedback)"""
+        dropped = self.recommendation_cache.invalidate_user(user_id)
+        if dropped:
+            logger.info(f"Invalidated {dropped} cached recommendations for user {user_id}")
+    
     def get_system_stats(self) -> Dict[str, Any]:
         """Get system statistics"""
         return {
             'total_impressions': self.impression_count,
             'cached_recommendations': len(self.recommendation_cache),
+            'recommendation_cache': self.recommendation_cache.stats(),
+            'request_coalescing': self.in_flight.stats(),
+            'order_changes': self.order_changes.stats() if self.order_changes is not None else None,
             'users_with_preferences': len(self.user_preferences),
             'total_feedback': len(self.feedback_data),
             'system_version': '2.0.0'
@@ -367,11 +494,14 @@ class SmartRecommender:
 
 # Global instance
 _smart_recommender = None
+_smart_recommender_lock = threading.Lock()
 
 def get_smart_recommender() -> SmartRecommender:
     """Get global smart recommender instance"""
     global _smart_recommender
     if _smart_recommender is None:
-        _smart_recommender = SmartRecommender()
+        with _smart_recommender_lock:
+            if _smart_recommender is None:
+                _smart_recommender = SmartRecommender()
     return _smart_recommender
 
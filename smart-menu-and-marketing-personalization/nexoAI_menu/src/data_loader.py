@@ -1,6 +1,12 @@
+import json
+import os
+import shutil
+import time
 import pandas as pd
 from datetime import datetime
-from typing import Tuple
+from typing import Optional, Tuple
+
+SNAPSHOT_FRAMES = ("users", "items", "orders")
 
 
 def load_users(path: str = "data/raw/users.csv") -> pd.DataFrame:
@@ -61,10 +67,103 @@ def load_orders(orders_path: str = "data/raw/orders.csv",
     return complete_orders
 
 
-def load_all() -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
-    return load_users(), load_items(), load_orders()
+def _list_columns(df: pd.DataFrame) -> list:
+    return [c for c in df.columns
+            if df[c].dtype == object and len(df) and df[c].map(lambda v: isinstance(v, list)).all()]
+
+
+def _list_values(column) -> list:
+    """Python lists for an Arrow list column, sliced from its offsets"""
+    column = column.combine_chunks()
+    if column.null_count:
+        return [v if v is not None else [] for v in column.to_pylist()]
+    offsets = column.offsets.to_numpy()
+    values = column.values.to_numpy(zero_copy_only=False).tolist()
+    return [values[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def save_snapshot(users: pd.DataFrame, items: pd.DataFrame, orders: pd.DataFrame,
+                  snapshot_dir: str = "data/snapshot", keep: int = 3) -> str:
+    """Write the parsed frames as uncompressed Feather files and make them current.
+
+    Each call writes a new version directory; the ``CURRENT`` pointer is
+    swapped atomically so readers never see a partial snapshot. Only the
+    newest ``keep`` versions are kept.
+    """
+    import pyarrow.feather as feather
 
+    # Sortable by name: UTC second, nanoseconds within it, then the writer's pid
+    now = time.time_ns()
+    version = time.strftime("%Y%m%dT%H%M%S", time.gmtime(now // 10**9)) + f"-{now % 10**9:09d}-{os.getpid()}"
+    staging = os.path.join(snapshot_dir, f".{version}.tmp")
+    os.makedirs(staging)
+    meta = {"version": version, "created_at": time.time(), "list_columns": {}}
+    for name, df in zip(SNAPSHOT_FRAMES, (users, items, orders)):
+        feather.write_feather(df.reset_index(drop=True), os.path.join(staging, f"{name}.feather"),
+                              compression="uncompressed")
+        meta["list_columns"][name] = _list_columns(df)
+    with open(os.path.join(staging, "meta.json"), "w") as f:
+        json.dump(meta, f)
 
+    os.replace(staging, os.path.join(snapshot_dir, version))
+    pointer = os.path.join(snapshot_dir, f".CURRENT.{version}.tmp")
+    with open(pointer, "w") as f:
+        f.write(version)
+    os.replace(pointer, os.path.join(snapshot_dir, "CURRENT"))
 
+    versions = sorted(v for v in os.listdir(snapshot_dir)
+                      if not v.startswith(".") and os.path.isdir(os.path.join(snapshot_dir, v)))
+    for old in versions[:-keep] if keep > 0 else []:
+        if old != version:
+            shutil.rmtree(os.path.join(snapshot_dir, old), ignore_errors=True)
+    return os.path.join(snapshot_dir, version)
 
 
+def load_snapshot(snapshot_dir: str = "data/snapshot",
+                  max_age_seconds: Optional[float] = None) -> Optional[Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]]:
+    """Memory-map the current snapshot, or None if none has been published
+    (or it is older than ``max_age_seconds``).
+
+    Fixed-width columns stay backed by the memory map. List columns
+    (ingredients, tags, ...) are stored as Arrow lists but come back as
+    Python lists, so they take ordinary heap memory like a CSV load does.
+    """
+    try:
+        with open(os.path.join(snapshot_dir, "CURRENT")) as f:
+            path = os.path.join(snapshot_dir, f.read().strip())
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+    except FileNotFoundError:
+        return None
+    if max_age_seconds is not None and time.time() - meta.get("created_at", 0) > max_age_seconds:
+        return None
+
+    import pyarrow.feather as feather
+
+    frames = []
+    for name in SNAPSHOT_FRAMES:
+        table = feather.read_table(os.path.join(path, f"{name}.feather"), memory_map=True)
+        list_columns = meta["list_columns"][name]
+        plain = [c for c in table.column_names if c not in list_columns]
+        df = table.select(plain).to_pandas(split_blocks=True, self_destruct=False)
+        for col in list_columns:
+            df[col] = pd.Series(_list_values(table.column(col)), dtype=object)
+        frames.append(df[table.column_names])
+    return tuple(frames)
+
+
+def load_all(snapshot_dir: Optional[str] = None,
+             max_age_seconds: Optional[float] = 300) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """Load users, items and orders; from ``snapshot_dir`` when a snapshot exists there.
+
+    A snapshot older than ``max_age_seconds`` (None: never too old) is
+    replaced: the CSV files are parsed again and published as a new version.
+    """
+    if snapshot_dir:
+        snapshot = load_snapshot(snapshot_dir, max_age_seconds)
+        if snapshot is not None:
+            return snapshot
+        frames = load_users(), load_items(), load_orders()
+        save_snapshot(*frames, snapshot_dir=snapshot_dir)
+        return frames
+    return load_users(), load_items(), load_orders()